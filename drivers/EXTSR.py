@@ -58,6 +58,7 @@ class EXTSR(FileSR.FileSR):
 
     def load(self, sr_uuid):
         self.ops_exclusive = FileSR.OPS_EXCLUSIVE
+        self.ops_shared = FileSR.OPS_SHARED
         self.lock = Lock(vhdutil.LOCK_TYPE_SR, self.uuid)
         self.sr_vditype = SR.DEFAULT_TAP
         if not self.dconf.has_key('device') or not self.dconf['device']:
@@ -17,7 +17,7 @@
 #
 # FileSR: local-file storage repository
 
-import SR, VDI, SRCommand, util, scsiutil, vhdutil
+import SR, VDI, SRCommand, util, scsiutil, vhdutil, vhdcache
 import lvhdutil
 import os, re
 import errno
@@ -64,8 +64,11 @@ JOURNAL_FILE_PREFIX = ".journal-"
 
 OPS_EXCLUSIVE = [
         "sr_create", "sr_delete", "sr_probe", "sr_attach", "sr_detach",
-        "sr_scan", "vdi_init", "vdi_create", "vdi_delete", "vdi_attach",
-        "vdi_detach", "vdi_resize_online", "vdi_snapshot", "vdi_clone" ]
+        "sr_scan", "vdi_create", "vdi_delete", "vdi_resize_online",
+        "vdi_snapshot", "vdi_clone" ]
+
+# operations that only read the SR metadata: they hold the SR lock shared
+OPS_SHARED = [ "vdi_init", "vdi_attach", "vdi_detach" ]
 
 DRIVER_CONFIG = {"ATTACH_FROM_CONFIG_WITH_TAPDISK": True}
 
@@ -96,6 +99,7 @@ class FileSR(SR.SR):
 
     def load(self, sr_uuid):
         self.ops_exclusive = OPS_EXCLUSIVE
+        self.ops_shared = OPS_SHARED
         self.lock = Lock(vhdutil.LOCK_TYPE_SR, self.uuid)
         self.sr_vditype = vhdutil.VDI_TYPE_VHD
         if not self.dconf.has_key('location') or  not self.dconf['location']:
@@ -261,10 +265,11 @@ class FileSR(SR.SR):
         if self.vdis:
             return
 
-        pattern = os.path.join(self.path, "*%s" % vhdutil.FILE_EXTN_VHD)
+        cache = vhdcache.VHDCache(os.path.basename(self.path))
         try:
-            self.vhds = vhdutil.getAllVHDs(pattern, FileVDI.extractUuid)
-        except util.CommandException, inst:
+            self.vhds = vhdcache.getFileVHDs(self.path, FileVDI.extractUuid,
+                    cache)
+        except (util.CommandException, OSError), inst:
             raise xs_errors.XenError('SRScan', opterr="error VHD-scanning " \
                     "path %s (%s)" % (self.path, inst))
         for uuid in self.vhds.iterkeys():
@@ -26,6 +26,7 @@ import lvutil
 import lvmcache
 import vhdutil
 import lvhdutil
+import vhdcache
 import scsiutil
 import time
 import os, sys
@@ -78,9 +79,16 @@ PARAM_RAW = "raw"
 
 OPS_EXCLUSIVE = [
         "sr_create", "sr_delete", "sr_attach", "sr_detach", "sr_scan",
-        "sr_update", "vdi_create", "vdi_delete", "vdi_resize", "vdi_snapshot",
+        "vdi_create", "vdi_delete", "vdi_resize", "vdi_snapshot",
         "vdi_clone" ]
 
+# sr_update only refreshes the SR stats and the SR name in the metadata (which
+# concurrent updates write alike): it holds the SR lock shared
+OPS_SHARED = [ "sr_update" ]
+
+# concurrent VDI introductions when recovering VDIs from the metadata
+INTRODUCE_THREADS = 4
+
 
 class LVHDSR(SR.SR):
     DRIVER_TYPE = 'lvhd'
@@ -154,6 +162,7 @@ class LVHDSR(SR.SR):
 
     def load(self, sr_uuid):
         self.ops_exclusive = OPS_EXCLUSIVE
+        self.ops_shared = OPS_SHARED
         if not self.dconf.has_key('device') or not self.dconf['device']:
             raise xs_errors.XenError('ConfigDeviceMissing',)
         self.root = self.dconf['device']
@@ -299,13 +308,14 @@ class LVHDSR(SR.SR):
         try:
             # if a VDI is present in the metadata but not in the storage
             # then delete it from the metadata
-            vdi_info = LVMMetadataHandler(self.mdpath, False).getMetadata()[1]
+            mdHandler = LVMMetadataHandler(self.mdpath)
+            mdHandler.startBatch()
+            vdi_info = mdHandler.getMetadata()[1]
             for vdi in vdi_info.keys():
                 update_map = {}
                 if not vdi_info[vdi][UUID_TAG] in set(self.storageVDIs.keys()):
                     # delete this from metadata
-                    LVMMetadataHandler(self.mdpath).\
-                        deleteVdiFromMetadata(vdi_info[vdi][UUID_TAG])
+                    mdHandler.deleteVdiFromMetadata(vdi_info[vdi][UUID_TAG])
                 else:
                     # search for this in the metadata, compare types
                     # self.storageVDIs is a map of vdi_uuid to vdi_type
@@ -317,11 +327,11 @@ class LVHDSR(SR.SR):
                         update_map[UUID_TAG] = vdi_info[vdi][UUID_TAG] 
                         update_map[VDI_TYPE_TAG] = \
                             self.storageVDIs[vdi_info[vdi][UUID_TAG]]
-                        LVMMetadataHandler(self.mdpath)\
-                            .updateMetadata(update_map)
+                        mdHandler.updateMetadata(update_map)
                     else:
                         # This should never happen
                         pass
+            mdHandler.flush()
             
         except Exception, e:
             raise xs_errors.XenError('MetadataError', \
@@ -330,8 +340,9 @@ class LVHDSR(SR.SR):
     def syncMetadataAndXapi(self):
         try:
             # get metadata
-            (sr_info, vdi_info) = \
-                LVMMetadataHandler(self.mdpath, False).getMetadata()
+            mdHandler = LVMMetadataHandler(self.mdpath)
+            mdHandler.startBatch()
+            (sr_info, vdi_info) = mdHandler.getMetadata()
 
             # First synch SR parameters
             self.update(self.uuid)
@@ -360,8 +371,8 @@ class LVHDSR(SR.SR):
                     update_map[UUID_TAG] = vdi_info[vdi_offset][UUID_TAG]
                     update_map[NAME_LABEL_TAG] = new_name_label
                     update_map[NAME_DESCRIPTION_TAG] = new_name_description
-                    LVMMetadataHandler(self.mdpath)\
-                        .updateMetadata(update_map)
+                    mdHandler.updateMetadata(update_map)
+            mdHandler.flush()
         except Exception, e:
             raise xs_errors.XenError('MetadataError', \
                 opterr='Error synching SR Metadata and XAPI: %s' % str(e))
@@ -778,9 +789,8 @@ class LVHDSR(SR.SR):
         super(LVHDSR, self).forget_vdi(uuid)
 
     def scan(self, uuid):
+        activatedLVs = []
         try:
-            lvname = ''
-            activated = True
             util.SMlog("LVHDSR.scan for %s" % self.uuid)
             if not self.isMaster:
                 util.SMlog('sr_scan blocked for non-master')
@@ -797,110 +807,141 @@ class LVHDSR(SR.SR):
             # Now check if there are any VDIs in the metadata, which are not in 
             # XAPI
             if self.mdexists:
-                vdiToSnaps = {}
-                # get VDIs from XAPI
-                vdis = self.session.xenapi.SR.get_VDIs(self.sr_ref)
-                vdi_uuids = set([])
-                for vdi in vdis:
-                    vdi_uuids.add(self.session.xenapi.VDI.get_uuid(vdi))
-                
-                Dict = LVMMetadataHandler(self.mdpath, False).getMetadata()[1]
-                
-                for vdi in Dict.keys():
-                    vdi_uuid = Dict[vdi][UUID_TAG]
-                    if bool(int(Dict[vdi][IS_A_SNAPSHOT_TAG])):
-                        if vdiToSnaps.has_key(Dict[vdi][SNAPSHOT_OF_TAG]):
-                            vdiToSnaps[Dict[vdi][SNAPSHOT_OF_TAG]].append(vdi_uuid)
-                        else:
-                            vdiToSnaps[Dict[vdi][SNAPSHOT_OF_TAG]] = [vdi_uuid]
-                            
-                    if vdi_uuid not in vdi_uuids:
-                        util.SMlog("Introduce VDI %s as it is present in " \
-                                   "metadata and not in XAPI." % vdi_uuid)
-                        sm_config = {}
-                        sm_config['vdi_type'] = Dict[vdi][VDI_TYPE_TAG]
-                        lvname = "%s%s" % \
-                            (lvhdutil.LV_PREFIX[sm_config['vdi_type']],vdi_uuid)
-                        self.lvmCache.activateNoRefcount(lvname)
-                        activated = True
-                        lvPath = os.path.join(self.path, lvname)
-                            
-                        if Dict[vdi][VDI_TYPE_TAG] == vhdutil.VDI_TYPE_RAW:
-                            size = self.lvmCache.getSize( \
-                                lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_RAW] + \
-                                    vdi_uuid)
-                            utilisation = \
-                                        util.roundup(lvutil.LVM_SIZE_INCREMENT,
-                                                       long(size))
-                        else:
-                            parent = \
-                                vhdutil._getVHDParentNoCheck(lvPath)
-                            
-                            if parent != None:
-                                sm_config['vhd-parent'] = parent[len( \
-                                    lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_VHD]):]
-                            size = vhdutil.getSizeVirt(lvPath)
-                            if self.provision == "thin":
-                                utilisation = \
-                                    util.roundup(lvutil.LVM_SIZE_INCREMENT,
-                                      vhdutil.calcOverheadEmpty(lvhdutil.MSIZE))
-                            else:
-                                # We show the VHD size for both xlvhd and thick.
-                                utilisation = lvhdutil.calcSizeVHDLV(long(size))
-                        
-                        vdi_ref = self.session.xenapi.VDI.db_introduce(
-                                        vdi_uuid,
-                                        Dict[vdi][NAME_LABEL_TAG],
-                                        Dict[vdi][NAME_DESCRIPTION_TAG],
-                                        self.sr_ref,
-                                        Dict[vdi][TYPE_TAG],
-                                        False,
-                                        bool(int(Dict[vdi][READ_ONLY_TAG])),
-                                        {},
-                                        vdi_uuid,
-                                        {}, 
-                                        sm_config)
-
-                        self.session.xenapi.VDI.set_managed(vdi_ref,
-                                                    bool(int(Dict[vdi][MANAGED_TAG])))
-                        self.session.xenapi.VDI.set_virtual_size(vdi_ref,
-                                                                 str(size))
-                        self.session.xenapi.VDI.set_physical_utilisation( \
-                            vdi_ref, str(utilisation))
-                        self.session.xenapi.VDI.set_is_a_snapshot( \
-                            vdi_ref, bool(int(Dict[vdi][IS_A_SNAPSHOT_TAG])))
-                        if bool(int(Dict[vdi][IS_A_SNAPSHOT_TAG])):
-                            self.session.xenapi.VDI.set_snapshot_time( \
-                                vdi_ref, DateTime(Dict[vdi][SNAPSHOT_TIME_TAG]))
-                        if Dict[vdi][TYPE_TAG] == 'metadata':
-                            self.session.xenapi.VDI.set_metadata_of_pool( \
-                                vdi_ref, Dict[vdi][METADATA_OF_POOL_TAG])
-                        
-                # Now set the snapshot statuses correctly in XAPI
-                for srcvdi in vdiToSnaps.keys():
-                    try:
-                        srcref = self.session.xenapi.VDI.get_by_uuid(srcvdi)
-                    except:
-                        # the source VDI no longer exists, continue
-                        continue
-                    
-                    for snapvdi in vdiToSnaps[srcvdi]:
-                        try:
-                            # this might fail in cases where its already set
-                            snapref = \
-                                self.session.xenapi.VDI.get_by_uuid(snapvdi)
-                            self.session.xenapi.VDI.set_snapshot_of(snapref, srcref)
-                        except Exception, e:
-                            util.SMlog("Setting snapshot failed. "\
-                                       "Error: %s" % str(e))
+                self._introduceFromMetadata(activatedLVs)
 
             ret = super(LVHDSR, self).scan(uuid)
             self._kickGC()
             return ret
 
         finally:
-            if lvname != '' and activated:
-                self.lvmCache.deactivateNoRefcount(lvname)
+            self.lvmCache.deactivateManyNoRefcount(activatedLVs)
+
+    def _introduceFromMetadata(self, activatedLVs):
+        """Introduce the VDIs present in the metadata and not in XAPI, and
+        set the snapshot_of fields of the snapshots in the metadata. The VHD
+        info of all the VDIs to introduce is read in one batch (their LVs
+        are activated, and added to activatedLVs, for that) before any is
+        introduced, and the introductions are then run concurrently"""
+        vdiToSnaps = {}
+        # get VDIs from XAPI
+        refs = {}
+        snapshotOf = {}
+        for ref, rec in util.list_VDI_records_in_sr(self).iteritems():
+            refs[rec['uuid']] = ref
+            snapshotOf[ref] = rec['snapshot_of']
+
+        Dict = LVMMetadataHandler(self.mdpath, False).getMetadata()[1]
+
+        vdisToIntroduce = []
+        for vdi in Dict.keys():
+            vdi_uuid = Dict[vdi][UUID_TAG]
+            if bool(int(Dict[vdi][IS_A_SNAPSHOT_TAG])):
+                if vdiToSnaps.has_key(Dict[vdi][SNAPSHOT_OF_TAG]):
+                    vdiToSnaps[Dict[vdi][SNAPSHOT_OF_TAG]].append(vdi_uuid)
+                else:
+                    vdiToSnaps[Dict[vdi][SNAPSHOT_OF_TAG]] = [vdi_uuid]
+
+            if not refs.has_key(vdi_uuid):
+                vdisToIntroduce.append(vdi)
+
+        # activate all the LVs to introduce first so that their VHD
+        # info can be read in one batch
+        vhdPaths = []
+        lvnames = []
+        for vdi in vdisToIntroduce:
+            lvname = "%s%s" % (lvhdutil.LV_PREFIX[ \
+                    Dict[vdi][VDI_TYPE_TAG]], Dict[vdi][UUID_TAG])
+            lvnames.append(lvname)
+            if Dict[vdi][VDI_TYPE_TAG] == vhdutil.VDI_TYPE_VHD:
+                vhdPaths.append(os.path.join(self.path, lvname))
+        activatedLVs.extend(lvnames)
+        self.lvmCache.activateManyNoRefcount(lvnames)
+        vhdInfos = vhdutil.queryMany(vhdPaths,
+                [vhdutil.QUERY_SIZE_VIRT, vhdutil.QUERY_PARENT_NOCHECK],
+                lvhdutil.extractUuid)
+
+        introduceArgs = {}
+        for vdi in vdisToIntroduce:
+            util.SMlog("Introduce VDI %s as it is present in " \
+                       "metadata and not in XAPI." % Dict[vdi][UUID_TAG])
+            introduceArgs[vdi] = self._introduceArgs(Dict[vdi], vhdInfos,
+                    refs)
+
+        # every field is set by db_introduce itself
+        results = util.xapi_map(self.session,
+                lambda xapi, vdi: xapi.xenapi.VDI.db_introduce(
+                        *introduceArgs[vdi]),
+                vdisToIntroduce, INTRODUCE_THREADS)
+        for vdi in vdisToIntroduce:
+            if isinstance(results[vdi], Exception):
+                raise results[vdi]
+            vdi_ref = results[vdi]
+            refs[Dict[vdi][UUID_TAG]] = vdi_ref
+            snapshotOf[vdi_ref] = introduceArgs[vdi][-1]
+
+        # Now set the snapshot statuses correctly in XAPI
+        for srcvdi in vdiToSnaps.keys():
+            srcref = refs.get(srcvdi)
+            if not srcref:
+                # the source VDI no longer exists, continue
+                continue
+
+            for snapvdi in vdiToSnaps[srcvdi]:
+                snapref = refs.get(snapvdi)
+                if not snapref or snapshotOf[snapref] == srcref:
+                    continue
+                try:
+                    self.session.xenapi.VDI.set_snapshot_of(snapref, srcref)
+                except Exception, e:
+                    util.SMlog("Setting snapshot failed. "\
+                               "Error: %s" % str(e))
+
+    def _introduceArgs(self, info, vhdInfos, refs):
+        """The db_introduce arguments of the VDI of metadata info"""
+        vdi_uuid = info[UUID_TAG]
+        sm_config = {}
+        sm_config['vdi_type'] = info[VDI_TYPE_TAG]
+        lvname = "%s%s" % \
+            (lvhdutil.LV_PREFIX[sm_config['vdi_type']],vdi_uuid)
+        lvPath = os.path.join(self.path, lvname)
+
+        if info[VDI_TYPE_TAG] == vhdutil.VDI_TYPE_RAW:
+            size = self.lvmCache.getSize( \
+                lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_RAW] + vdi_uuid)
+            utilisation = util.roundup(lvutil.LVM_SIZE_INCREMENT, long(size))
+        else:
+            vhdInfo = vhdInfos[lvPath]
+            if vhdInfo.error:
+                raise util.SMException("Failed to read VHD " \
+                        "%s: %s" % (lvPath, vhdInfo.error))
+            if vhdInfo.parentUuid:
+                sm_config['vhd-parent'] = vhdInfo.parentUuid
+            size = vhdInfo.sizeVirt
+            if self.provision == "thin":
+                utilisation = \
+                    util.roundup(lvutil.LVM_SIZE_INCREMENT,
+                      vhdutil.calcOverheadEmpty(lvhdutil.MSIZE))
+            else:
+                # We show the VHD size for both xlvhd and thick.
+                utilisation = lvhdutil.calcSizeVHDLV(long(size))
+
+        is_a_snapshot = bool(int(info[IS_A_SNAPSHOT_TAG]))
+        snapshot_time = "19700101T00:00:00Z"
+        snapshot_of = "OpaqueRef:NULL"
+        if is_a_snapshot:
+            snapshot_time = info[SNAPSHOT_TIME_TAG]
+            # set later if the source is introduced along
+            snapshot_of = refs.get(info[SNAPSHOT_OF_TAG], snapshot_of)
+        metadata_of_pool = "OpaqueRef:NULL"
+        if info[TYPE_TAG] == 'metadata':
+            metadata_of_pool = info[METADATA_OF_POOL_TAG]
+
+        return (vdi_uuid, info[NAME_LABEL_TAG], info[NAME_DESCRIPTION_TAG],
+                self.sr_ref, info[TYPE_TAG], False,
+                bool(int(info[READ_ONLY_TAG])), {}, vdi_uuid, {}, sm_config,
+                bool(int(info[MANAGED_TAG])), str(size), str(utilisation),
+                metadata_of_pool, is_a_snapshot, DateTime(snapshot_time),
+                snapshot_of)
 
     def update(self, uuid):
         if not lvutil._checkVG(self.vgname):
@@ -954,7 +995,10 @@ class LVHDSR(SR.SR):
 
     def _loadvdis(self):
         self.virtual_allocation = 0
-        self.vdiInfo = lvhdutil.getVDIInfo(self.lvmCache)
+        vhdCache = None
+        if self.isMaster:
+            vhdCache = vhdcache.VHDCache(self.vgname)
+        self.vdiInfo = lvhdutil.getVDIInfo(self.lvmCache, vhdCache)
         self.allVDIs = {}
 
         for uuid, info in self.vdiInfo.iteritems():
@@ -1324,15 +1368,12 @@ class LVHDSR(SR.SR):
                 "uuid3"  : baseUuid}
 
         masterRef = util.get_this_host_ref(self.session)
-        for hostRef in hostRefs:
-            if hostRef == masterRef:
-                continue
+        slaves = filter(lambda x: x != masterRef, hostRefs)
+        for hostRef in slaves:
             util.SMlog("Updating %s, %s, %s on slave %s" % \
                     (origOldLV, origLV, baseLV, hostRef))
-            rv = eval(self.session.xenapi.host.call_plugin(
-                    hostRef, self.PLUGIN_ON_SLAVE, "multi", args))
-            util.SMlog("call-plugin returned: %s" % rv)
-            if not rv:
+        for text in lvhdutil.multiOnSlaves(self.session, slaves, args):
+            if not eval(text):
                 raise Exception('plugin %s failed' % self.PLUGIN_ON_SLAVE)
 
     def _cleanup(self, skipLockCleanup = False):
@@ -1427,6 +1468,7 @@ class LVHDSR(SR.SR):
                 devices = self.root.split(',')
                 # Change LVM metadata string from standard LVM to xenvm
                 util.pread2(['xenvm', 'upgrade', self.vgname, '--pvpath', devices[0]])
+                lvutil.invalidate_sr_alloc(self.vgname)
 
                 # Check allocation-quantum
                 aq = long (self.srcmd.params['allocation_quantum'])
@@ -1546,6 +1588,7 @@ class LVHDSR(SR.SR):
                 # Change LVM metadata string from xenvm to standard lvm
                 devices = self.root.split(',')
                 util.pread2(['xenvm', 'downgrade', self.vgname, '--pvpath', devices[0]])
+                lvutil.invalidate_sr_alloc(self.vgname)
             except:
                 util.SMlog("Failed to change LVM metadata string while"
                            "  downgrading SR: %s" % uuid)
@@ -1588,6 +1631,7 @@ class LVHDSR(SR.SR):
             vginfo_path + '.xenvm-local-allocator.config',
             lvutil.config_dir + scsi_id 
         ])
+        lvutil.invalidate_sr_alloc()
 
 
     def _symlink_xenvm_conf(self):
@@ -1621,6 +1665,7 @@ class LVHDSR(SR.SR):
             vginfo_path,
             lvutil.config_dir + scsi_id
         ])
+        lvutil.invalidate_sr_alloc()
         
 class LVHDVDI(VDI.VDI):
 
@@ -2281,8 +2326,11 @@ class LVHDVDI(VDI.VDI):
         # Introduce any new VDI records & update the existing one
         type = self.session.xenapi.VDI.get_type( \
                                     self.sr.srcmd.params['vdi_ref'])
+        # the new records are written together, once both are introduced
+        mdHandler = LVMMetadataHandler(self.sr.mdpath)
+        mdHandler.startBatch()
         if snapVDI2:
-            LVMMetadataHandler(self.sr.mdpath).ensureSpaceIsAvailableForVdis(1)
+            mdHandler.ensureSpaceIsAvailableForVdis(1)
             vdiRef = snapVDI2._db_introduce()
             if cloneOp:
                 vdi_info = { UUID_TAG: snapVDI2.uuid,
@@ -2321,12 +2369,12 @@ class LVHDVDI(VDI.VDI):
                                 METADATA_OF_POOL_TAG: ''
                 }
 
-            LVMMetadataHandler(self.sr.mdpath).addVdi(vdi_info)
+            mdHandler.addVdi(vdi_info)
             util.SMlog("vdi_clone: introduced 2nd snap VDI: %s (%s)" % \
                        (vdiRef, snapVDI2.uuid))
 
         if basePresent:
-            LVMMetadataHandler(self.sr.mdpath).ensureSpaceIsAvailableForVdis(1)
+            mdHandler.ensureSpaceIsAvailableForVdis(1)
             vdiRef = self._db_introduce()
             vdi_info = { UUID_TAG: self.uuid,
                                 NAME_LABEL_TAG: self.label,
@@ -2341,9 +2389,10 @@ class LVHDVDI(VDI.VDI):
                                 METADATA_OF_POOL_TAG: ''
             }
 
-            LVMMetadataHandler(self.sr.mdpath).addVdi(vdi_info)
+            mdHandler.addVdi(vdi_info)
             util.SMlog("vdi_clone: introduced base VDI: %s (%s)" % \
                     (vdiRef, self.uuid))
+        mdHandler.flush()
 
         # Update the original record
         vdi_ref = self.sr.srcmd.params['vdi_ref']
@@ -2481,17 +2530,19 @@ class LVHDVDI(VDI.VDI):
         if self.vdi_type == vhdutil.VDI_TYPE_VHD:
             vdiList = vhdutil.getParentChain(self.lvname,
                     lvhdutil.extractUuid, self.sr.vgname)
+        lvs = []
         for uuid, lvName in vdiList.iteritems():
             binaryParam = binary
             if uuid != self.uuid:
                 binaryParam = False # binary param only applies to leaf nodes
-            if active:
-                self.sr.lvActivator.activate(uuid, lvName, binaryParam,
-                        persistent)
-            else:
-                # just add the LVs for deactivation in the final (cleanup) 
-                # step. The LVs must not have been activated during the current 
-                # operation
+            lvs.append((uuid, lvName, binaryParam))
+        if active:
+            self.sr.lvActivator.activateMany(lvs, persistent)
+        else:
+            # just add the LVs for deactivation in the final (cleanup) 
+            # step. The LVs must not have been activated during the current 
+            # operation
+            for uuid, lvName, binaryParam in lvs:
                 self.sr.lvActivator.add(uuid, lvName, binaryParam)
 
     def _failClone(self, uuid, jval, msg):
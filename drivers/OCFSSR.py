@@ -71,6 +71,7 @@ class OCFSSR(FileSR.FileSR):
         self.uuid = sr_uuid
 
         self.ops_exclusive = FileSR.OPS_EXCLUSIVE
+        self.ops_shared = FileSR.OPS_SHARED
         self.lock = Lock(vhdutil.LOCK_TYPE_SR, self.uuid)
         self.sr_vditype = SR.DEFAULT_TAP
         self.driver_config = DRIVER_CONFIG
@@ -31,6 +31,9 @@ DEFAULT_TAP = 'vhd'
 TAPDISK_UTIL = '/usr/sbin/td-util'
 MASTER_LVM_CONF = '/etc/lvm/master'
 
+# concurrent VDI record updates in ScanRecord.synchronise_existing
+SCAN_UPDATE_THREADS = 4
+
 # LUN per VDI key for XenCenter
 LUNPERVDI = "LUNperVDI"
 
@@ -136,6 +139,7 @@ class SR(object):
         self._mpathinit()
         self.direct = False
         self.ops_exclusive = []
+        self.ops_shared = []
         self.driver_config = {}
 
         self.load(sr_uuid)
@@ -589,12 +593,23 @@ class ScanRecord:
                    raise
 
     def synchronise_existing(self):
-        """Update existing XenAPI records"""
+        """Update existing XenAPI records. Only the fields that differ from
+        the records fetched at construction are written, for several VDIs
+        at once"""
         for location in self.existing:
             vdi = self.get_sm_vdi(location)
-            
             util.SMlog("Updating VDI with location=%s uuid=%s" % (vdi.location, vdi.uuid))
-            vdi._db_update()
+
+        def update(xapi, location):
+            ref = self.__xenapi_locations[location]
+            self.get_sm_vdi(location)._db_update_from_record(xapi, ref,
+                    self.__xenapi_records[ref])
+
+        results = util.xapi_map(self.sr.session, update, self.existing,
+                SCAN_UPDATE_THREADS)
+        for location in self.existing:
+            if isinstance(results[location], Exception):
+                raise results[location]
             
     def synchronise(self):
         """Perform the default SM -> xenapi synchronisation; ought to be good enough
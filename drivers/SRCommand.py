@@ -135,17 +135,28 @@ class SRCommand:
     def _run_locked(self, sr):
         lockSR = False
         lockInitOnly = False
+        shared = False
         rv = None
         e = None
         if self.cmd in sr.ops_exclusive:
             lockSR = True
-        elif self.cmd in NEEDS_VDI_OBJECT and "vdi_init" in sr.ops_exclusive:
-            lockInitOnly = True
+        elif self.cmd in sr.ops_shared:
+            lockSR = True
+            shared = True
+        elif self.cmd in NEEDS_VDI_OBJECT:
+            if "vdi_init" in sr.ops_exclusive:
+                lockInitOnly = True
+            elif "vdi_init" in sr.ops_shared:
+                lockInitOnly = True
+                shared = True
 
         target = None
         acquired = False
         if lockSR or lockInitOnly:
-            sr.lock.acquire()
+            if shared:
+                sr.lock.acquireShared()
+            else:
+                sr.lock.acquire()
             acquired = True
         try:
             try:
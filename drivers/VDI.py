@@ -328,8 +328,14 @@ class VDI(object):
                 del sm_config[key]
 
     def _db_update_sm_config(self, ref, sm_config):
-        import cleanup
         current_sm_config = self.sr.session.xenapi.VDI.get_sm_config(ref)
+        self._db_write_sm_config(self.sr.session, ref, sm_config,
+                current_sm_config)
+
+    def _db_write_sm_config(self, session, ref, sm_config, current_sm_config):
+        """Bring the sm_config of ref from current_sm_config to sm_config,
+        key by key, leaving alone the keys that others maintain"""
+        import cleanup
         for key, val in sm_config.iteritems():
             if key.startswith("host_") or \
                 key in ["paused", cleanup.VDI.DB_VHD_BLOCKS]:
@@ -337,8 +343,10 @@ class VDI(object):
             if sm_config.get(key) != current_sm_config.get(key):
                 util.SMlog("_db_update_sm_config: %s sm-config:%s %s->%s" % \
                         (self.uuid, key, current_sm_config.get(key), val))
-                self.sr.session.xenapi.VDI.remove_from_sm_config(ref, key)
-                self.sr.session.xenapi.VDI.add_to_sm_config(ref, key, val)
+                # current_sm_config may be stale (a ScanRecord): the key may
+                # have been added since
+                session.xenapi.VDI.remove_from_sm_config(ref, key)
+                session.xenapi.VDI.add_to_sm_config(ref, key, val)
 
         for key in current_sm_config.keys():
             if key.startswith("host_") or \
@@ -348,7 +356,7 @@ class VDI(object):
             if not sm_config.get(key):
                 util.SMlog("_db_update_sm_config: %s del sm-config:%s" % \
                         (self.uuid, key))
-                self.sr.session.xenapi.VDI.remove_from_sm_config(ref, key)
+                session.xenapi.VDI.remove_from_sm_config(ref, key)
 
     def _db_update(self):
         vdi = self.sr.session.xenapi.VDI.get_by_uuid(self.uuid)
@@ -358,6 +366,21 @@ class VDI(object):
         sm_config = util.default(self, "sm_config", lambda: {})
         self._override_sm_config(sm_config)
         self._db_update_sm_config(vdi, sm_config)
+
+    def _db_update_from_record(self, session, ref, record):
+        """Like _db_update, given the XAPI record of the VDI (and its ref),
+        fetched beforehand: only the fields that differ from the record are
+        written, through session"""
+        if str(self.size) != record['virtual_size']:
+            session.xenapi.VDI.set_virtual_size(ref, str(self.size))
+        if str(self.utilisation) != record['physical_utilisation']:
+            session.xenapi.VDI.set_physical_utilisation(ref,
+                    str(self.utilisation))
+        if self.read_only != record['read_only']:
+            session.xenapi.VDI.set_read_only(ref, self.read_only)
+        sm_config = util.default(self, "sm_config", lambda: {})
+        self._override_sm_config(sm_config)
+        self._db_write_sm_config(session, ref, sm_config, record['sm_config'])
         
     def in_sync_with_xenapi_record(self, x):
         """Returns true if this VDI is in sync with the supplied XenAPI record"""
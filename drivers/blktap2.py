@@ -23,16 +23,16 @@ import os
 import re
 import time
 import copy
-from lock import Lock
+from lock import Lock, LockSet
 import util
 import lvutil
 import xmlrpclib
 import httplib
 import errno
-import subprocess
 import syslog as _syslog
 import glob
 import json
+from StringIO import StringIO
 import xs_errors
 import XenAPI
 import scsiutil
@@ -140,10 +140,11 @@ class TapCtl(object):
 
     PATH = "/usr/sbin/tap-ctl"
 
-    def __init__(self, cmd, p):
-        self.cmd    = cmd
-        self._p     = p
-        self.stdout = p.stdout
+    def __init__(self, cmd, status, stdout, stderr):
+        self.cmd     = cmd
+        self._status = status
+        self._stderr = stderr
+        self.stdout  = StringIO(stdout)
 
     class CommandFailure(Exception):
         """TapCtl cmd failure."""
@@ -239,7 +240,8 @@ class TapCtl(object):
     @classmethod
     def _call(cls, args, quiet = False):
         """
-        Spawn a tap-ctl process. Return a TapCtl invocation.
+        Run a tap-ctl process (through util.doexec) to completion. Return
+        a TapCtl invocation.
         Raises a TapCtl.CommandFailure if subprocess creation failed.
         """
         cmd = cls._mkcmd(args)
@@ -247,31 +249,31 @@ class TapCtl(object):
         if not quiet:
             util.SMlog(cmd)
         try:
-            p = subprocess.Popen(cmd,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
+            status, stdout, stderr = util.doexec(cmd)
         except OSError, e:
             raise cls.CommandFailure(cmd, errno=e.errno)
+        except util.CommandException, e:
+            # timed out
+            raise cls.CommandFailure(cmd, errno=e.code)
 
-        return cls(cmd, p)
+        return cls(cmd, status, stdout, stderr)
 
     def _errmsg(self):
-        output = map(str.rstrip, self._p.stderr)
+        output = map(str.rstrip, self._stderr.splitlines())
         return "; ".join(output)
 
     def _wait(self, quiet = False):
         """
-        Reap the child tap-ctl process of this invocation.
+        Check the exit status of the tap-ctl process of this invocation.
         Raises a TapCtl.CommandFailure on non-zero exit status.
         """
-        status = self._p.wait()
+        status = self._status
         if not quiet:
             util.SMlog(" = %d" % status)
 
         if status == 0: return
 
-        info = { 'errmsg'   : self._errmsg(),
-                 'pid'      : self._p.pid }
+        info = { 'errmsg'   : self._errmsg() }
 
         if status < 0:
             info['signal'] = -status
@@ -1349,14 +1351,18 @@ class VDI(object):
         vdi_ref = session.xenapi.VDI.get_by_uuid(vdi_uuid)
         session.xenapi.VDI.add_to_sm_config(vdi_ref, 'paused', 'true')
         sm_config = session.xenapi.VDI.get_sm_config(vdi_ref)
-        for key in filter(lambda x: x.startswith('host_'), sm_config.keys()):
-            host_ref = key[len('host_'):]
-            util.SMlog("Calling tap-pause on host %s" % host_ref)
-            if not cls.call_pluginhandler(session, host_ref,
-                    sr_uuid, vdi_uuid, "pause", failfast=failfast):
-                # Failed to pause node
-                session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'paused')
-                return False
+        host_refs = cls._attached_hosts(sm_config)
+        results = cls.call_pluginhandler_on_hosts(session, host_refs,
+                sr_uuid, vdi_uuid, "pause", failfast=failfast)
+        if not cls._all_succeeded(results):
+            # Failed to pause some node: unpause the others (including those
+            # that did not answer in time, but may have paused since)
+            paused = filter(lambda x: results[x] is not False, host_refs)
+            if paused:
+                cls.call_pluginhandler_on_hosts(session, paused, sr_uuid,
+                        vdi_uuid, "unpause")
+            session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'paused')
+            return False
         return True
 
     @classmethod
@@ -1365,13 +1371,12 @@ class VDI(object):
         util.SMlog("Unpause request for %s secondary=%s" % (vdi_uuid, secondary))
         vdi_ref = session.xenapi.VDI.get_by_uuid(vdi_uuid)
         sm_config = session.xenapi.VDI.get_sm_config(vdi_ref)
-        for key in filter(lambda x: x.startswith('host_'), sm_config.keys()):
-            host_ref = key[len('host_'):]
-            util.SMlog("Calling tap-unpause on host %s" % host_ref)
-            if not cls.call_pluginhandler(session, host_ref,
-                    sr_uuid, vdi_uuid, "unpause", secondary, activate_parents):
-                # Failed to unpause node
-                return False
+        results = cls.call_pluginhandler_on_hosts(session,
+                cls._attached_hosts(sm_config), sr_uuid, vdi_uuid, "unpause",
+                secondary, activate_parents)
+        if not cls._all_succeeded(results):
+            # Failed to unpause some node
+            return False
         session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'paused')
         return True
 
@@ -1380,26 +1385,42 @@ class VDI(object):
         util.SMlog("Refresh request for %s" % vdi_uuid)
         vdi_ref = session.xenapi.VDI.get_by_uuid(vdi_uuid)
         sm_config = session.xenapi.VDI.get_sm_config(vdi_ref)
-        for key in filter(lambda x: x.startswith('host_'), sm_config.keys()):
-            host_ref = key[len('host_'):]
-            util.SMlog("Calling tap-refresh on host %s" % host_ref)
-            if not cls.call_pluginhandler(session, host_ref,
-                    sr_uuid, vdi_uuid, "refresh", None, activate_parents):
-                # Failed to refresh node
+        results = cls.call_pluginhandler_on_hosts(session,
+                cls._attached_hosts(sm_config), sr_uuid, vdi_uuid, "refresh",
+                None, activate_parents)
+        # Failed to refresh some node?
+        return cls._all_succeeded(results)
+
+    @staticmethod
+    def _attached_hosts(sm_config):
+        return map(lambda x: x[len('host_'):],
+                filter(lambda x: x.startswith('host_'), sm_config.keys()))
+
+    @staticmethod
+    def _all_succeeded(results):
+        for ret in results.values():
+            if ret is not True:
                 return False
         return True
 
+    @staticmethod
+    def _pluginhandler_args(sr_uuid, vdi_uuid, secondary, activate_parents,
+            failfast):
+        args = {"sr_uuid":sr_uuid, "vdi_uuid":vdi_uuid,
+                "failfast": str(failfast)}
+        if secondary:
+            args["secondary"] = secondary
+        if activate_parents:
+            args["activate_parents"] = "true"
+        return args
+
     @classmethod
     def call_pluginhandler(cls, session, host_ref, sr_uuid, vdi_uuid, action,
             secondary = None, activate_parents = False, failfast=False):
         """Optionally, activate the parent LV before unpausing"""
         try:
-            args = {"sr_uuid":sr_uuid, "vdi_uuid":vdi_uuid,
-                    "failfast": str(failfast)}
-            if secondary:
-                args["secondary"] = secondary
-            if activate_parents:
-                args["activate_parents"] = "true"
+            args = cls._pluginhandler_args(sr_uuid, vdi_uuid, secondary,
+                    activate_parents, failfast)
             ret = session.xenapi.host.call_plugin(
                     host_ref, PLUGIN_TAP_PAUSE, action,
                     args)
@@ -1408,6 +1429,29 @@ class VDI(object):
             util.logException("BLKTAP2:call_pluginhandler %s" % e)
             return False
 
+    @classmethod
+    def call_pluginhandler_on_hosts(cls, session, host_refs, sr_uuid,
+            vdi_uuid, action, secondary = None, activate_parents = False,
+            failfast=False):
+        """call_pluginhandler on each of host_refs concurrently. Return a dict
+        of host_ref -> True if the action succeeded, False if it failed, or
+        None if the host did not answer in time"""
+        for host_ref in host_refs:
+            util.SMlog("Calling tap-%s on host %s" % (action, host_ref))
+        args = cls._pluginhandler_args(sr_uuid, vdi_uuid, secondary,
+                activate_parents, failfast)
+        results = {}
+        for host_ref, ret in util.call_plugin_on_hosts(session, host_refs,
+                PLUGIN_TAP_PAUSE, action, args).iteritems():
+            if isinstance(ret, util.TimeoutException):
+                results[host_ref] = None
+            elif isinstance(ret, Exception):
+                util.SMlog("BLKTAP2:call_pluginhandler %s on host %s: %s" % \
+                        (action, host_ref, ret))
+                results[host_ref] = False
+            else:
+                results[host_ref] = ret == "True"
+        return results
 
     def _add_tag(self, vdi_uuid, writable):
         util.SMlog("Adding tag to: %s" % vdi_uuid)
@@ -1597,6 +1641,7 @@ class VDI(object):
             # Needed to avoid race with lvchange -p which is
             # now taking the same lock
             # This is a fix for CA-155766
+            chainLocks = None
             if hasattr(self.target.vdi.sr, 'DRIVER_TYPE') and \
                self.target.vdi.sr.DRIVER_TYPE == 'lvhd' and \
                self.target.get_vdi_type() == vhdutil.VDI_TYPE_VHD:
@@ -1605,22 +1650,18 @@ class VDI(object):
                 util.SMlog("Locking all chain before tap-ctl open")
                 vdiList = vhdutil.getParentChain(lvname,
                                                  lvhdutil.extractUuid, vgname)
-                lock_list = []
-                for uuid, lvName in vdiList.iteritems():
-                    lock = Lock(uuid, lvhdutil.NS_PREFIX_LVM + sr_uuid)
-                    lock_list.append(lock)
-                    lock.acquire()
-            
-            # Activate the physical node            
-            dev_path = self._activate(sr_uuid, vdi_uuid, options)
-
-            # Release Lock for all chain
-            if hasattr(self.target.vdi.sr, 'DRIVER_TYPE') and \
-               self.target.vdi.sr.DRIVER_TYPE == 'lvhd' and \
-               self.target.get_vdi_type() == vhdutil.VDI_TYPE_VHD:
-                util.SMlog("Unlocking all chain after tap-ctl open")
-                for lock in lock_list[::-1]:
-                    lock.release()
+                chainLocks = LockSet(vdiList.keys(),
+                                     lvhdutil.NS_PREFIX_LVM + sr_uuid)
+                chainLocks.acquire()
+
+            try:
+                # Activate the physical node
+                dev_path = self._activate(sr_uuid, vdi_uuid, options)
+            finally:
+                # Release Lock for all chain (the lock files stay open)
+                if chainLocks:
+                    util.SMlog("Unlocking all chain after tap-ctl open")
+                    chainLocks.release()
 
         except:
             util.SMlog("Exception in activate/attach")
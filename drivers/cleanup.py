@@ -22,31 +22,42 @@ import os
 import sys
 import time
 import signal
-import subprocess
 import getopt
 import datetime
 import exceptions
 import traceback
 import base64
 import zlib
+import fcntl
 import errno
+import binascii
+import threading
+import select
+import json
 
 import XenAPI
 import util
 import lvutil
 import vhdutil
 import lvhdutil
+import vhdcache
 import lvmcache
 import journaler
 import fjournaler
 import lock
+import flock
 import blktap2
 from refcounter import RefCounter
-from ipc import IPCFlag
+from ipc import IPCFlag, IPCEvent
 from lvmanager import LVActivator
 import blktap2
 from srmetadata import LVMMetadataHandler
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Disable automatic leaf-coalescing. Online leaf-coalesce is currently not 
 # possible due to lvhd_stop_using_() not working correctly. However, we leave 
 # this option available through the explicit LEAFCLSC_FORCE flag in the VDI 
@@ -67,10 +78,25 @@ lockRunning = None
 LOCK_TYPE_GC_ACTIVE = "gc_active"
 lockActive = None
 
+# lock namespace prefix for the per-VHD-tree locks taken by parallel coalesce
+# workers (the lock name being the UUID of the tree root)
+NS_PREFIX_COALESCE_TREE = "coalesce-tree-"
+
 # Default coalesce error rate limit, in messages per minute. A zero value
 # disables throttling, and a negative value disables error reporting.
 DEFAULT_COALESCE_ERR_RATE = 1.0/60
 
+# GC wakeup event (an IPCEvent in namespace NS_PREFIX_GC_EVENT + SR UUID),
+# through which an active GC is told about SR operations that may have created
+# work for it (EVENT_SR_OP) and about aborts (EVENT_ABORT)
+NS_PREFIX_GC_EVENT = "gc-event-"
+GC_EVENT = "wakeup"
+EVENT_SR_OP = "o"
+EVENT_ABORT = "a"
+
+# directory of the per-SR GC state files (see GCState)
+GC_STATE_DIR = "/var/run/sm/gc"
+
 COALESCE_LAST_ERR_TAG = 'last-coalesce-error'
 COALESCE_ERR_RATE_TAG = 'coalesce-error-rate'
 
@@ -90,6 +116,16 @@ class Util:
 
     PREFIX = {"G": 1024 * 1024 * 1024, "M": 1024 * 1024, "K": 1024}
 
+    # number of bits set in each byte value
+    BITS_SET = [bin(i).count("1") for i in range(256)]
+
+    # seconds an aborted runAbortable child gets to kill the process groups it
+    # runs in turn, before it is killed
+    KILL_GRACE = 5
+
+    # the process groups of the runAbortable children of this process
+    childGroups = set()
+
     def log(text):
         util.SMlog(text, ident="SMGC")
     log = staticmethod(log)
@@ -111,16 +147,7 @@ class Util:
 
     def doexec(args, expectedRC, inputtext=None, ret=None, log=True):
         "Execute a subprocess, then return its return code, stdout, stderr"
-        proc = subprocess.Popen(args,
-                                stdin=subprocess.PIPE,\
-                                stdout=subprocess.PIPE,\
-                                stderr=subprocess.PIPE,\
-                                shell=True,\
-                                close_fds=True)
-        (stdout, stderr) = proc.communicate(inputtext)
-        stdout = str(stdout)
-        stderr = str(stderr)
-        rc = proc.returncode
+        (rc, stdout, stderr) = util.doexec(args, inputtext, shell=True)
         if log:
             Util.log("`%s`: %s" % (args, rc))
         if type(expectedRC) != type([]):
@@ -139,33 +166,58 @@ class Util:
         return stdout
     doexec = staticmethod(doexec)
 
-    def runAbortable(func, ret, ns, abortTest, pollInterval, timeOut):
+    def runAbortable(func, ret, ns, abortTest, pollInterval, timeOut,
+            monitor = None):
         """execute func in a separate thread and kill it if abortTest signals
-        so"""
+        so. If monitor is given, it is called with the process group ID of the
+        thread on every poll (e.g. to pace its I/O, see IOThrottle). The
+        completion of the thread is noticed right away, through the closing of
+        a pipe, rather than at the next poll"""
         abortSignaled = abortTest() # check now before we clear resultFlag
         resultFlag = IPCFlag(ns)
         resultFlag.clearAll()
+        readFd, writeFd = os.pipe()
         pid = os.fork()
         if pid:
-            startTime = time.time()
-            while True:
-                if resultFlag.test("success"):
-                    Util.log("  Child process completed successfully")
-                    resultFlag.clear("success")
-                    return
-                if resultFlag.test("failure"):
-                    resultFlag.clear("failure")
-                    raise util.SMException("Child process exited with error")
-                if abortTest() or abortSignaled:
-                    os.killpg(pid, signal.SIGKILL)
-                    raise AbortException("Aborting due to signal")
-                if timeOut and time.time() - startTime > timeOut:
-                    os.killpg(pid, signal.SIGKILL)
-                    resultFlag.clearAll()
-                    raise util.SMException("Timed out")
-                time.sleep(pollInterval)
+            os.close(writeFd)
+            Util.childGroups.add(pid)
+            try:
+                startTime = time.time()
+                exited = False
+                while True:
+                    if resultFlag.test("success"):
+                        Util.log("  Child process completed successfully")
+                        resultFlag.clear("success")
+                        return
+                    if resultFlag.test("failure"):
+                        resultFlag.clear("failure")
+                        raise util.SMException("Child process exited with error")
+                    if exited:
+                        raise util.SMException("Child process exited " \
+                                "without a result")
+                    if abortTest() or abortSignaled:
+                        Util.killGroup(pid)
+                        raise AbortException("Aborting due to signal")
+                    if timeOut and time.time() - startTime > timeOut:
+                        Util.killGroup(pid)
+                        resultFlag.clearAll()
+                        raise util.SMException("Timed out")
+                    if monitor:
+                        monitor(pid)
+                    exited = Util.waitForEOF(readFd, pollInterval)
+            finally:
+                Util.childGroups.discard(pid)
+                os.close(readFd)
         else:
+            os.close(readFd)
+            # keep the processes func runs from holding the pipe open
+            fcntl.fcntl(writeFd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
             os.setpgrp()
+            # func may run abortable children of its own (e.g. in a parallel
+            # coalesce worker), in process groups of their own: kill them too
+            # when killed by killGroup (the groups of the parent are not ours)
+            Util.childGroups = set()
+            signal.signal(signal.SIGTERM, Util._killChildGroups)
             try:
                 if func() == ret:
                     resultFlag.set("success")
@@ -177,6 +229,68 @@ class Util:
             os._exit(0)
     runAbortable = staticmethod(runAbortable)
 
+    def killGroup(pgid):
+        """Kill the process group pgid of a runAbortable child, giving the
+        child KILL_GRACE seconds to kill the process groups of its own
+        runAbortable children first"""
+        try:
+            os.killpg(pgid, signal.SIGTERM)
+        except OSError:
+            return
+        deadline = time.time() + Util.KILL_GRACE
+        while time.time() < deadline:
+            try:
+                if os.waitpid(pgid, os.WNOHANG)[0]:
+                    break
+            except OSError:
+                break
+            time.sleep(0.1)
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except OSError:
+            pass
+    killGroup = staticmethod(killGroup)
+
+    def _killChildGroups(signum, frame):
+        for pgid in list(Util.childGroups):
+            try:
+                os.killpg(pgid, signal.SIGKILL)
+            except OSError:
+                pass
+        os._exit(1)
+    _killChildGroups = staticmethod(_killChildGroups)
+
+    def waitForEOF(fd, timeOut):
+        """Wait for up to timeOut seconds for the write end of the pipe fd to
+        be closed. Return True if it was"""
+        try:
+            if not select.select([fd], [], [], timeOut)[0]:
+                return False
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                return False
+            raise
+        return not os.read(fd, 4096)
+    waitForEOF = staticmethod(waitForEOF)
+
+    def parseTimeOfDay(text):
+        """Parse "HH:MM" into minutes since midnight"""
+        hours, minutes = text.strip().split(":")
+        hours = int(hours)
+        minutes = int(minutes)
+        if not (0 <= hours < 24 and 0 <= minutes < 60):
+            raise ValueError("Invalid time of day: %s" % text)
+        return hours * 60 + minutes
+    parseTimeOfDay = staticmethod(parseTimeOfDay)
+
+    def isAlive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno != errno.ESRCH
+        return True
+    isAlive = staticmethod(isAlive)
+
     def num2str(number):
         for prefix in ("G", "M", "K"):
             if number >= Util.PREFIX[prefix]:
@@ -185,34 +299,31 @@ class Util:
     num2str = staticmethod(num2str)
 
     def numBits(val):
-        count = 0
-        while val:
-            count += val & 1
-            val = val >> 1
-        return count
+        if val < 256:
+            return Util.BITS_SET[val]
+        return bin(val).count("1")
     numBits = staticmethod(numBits)
 
     def countBits(bitmap1, bitmap2):
         """return bit count in the bitmap produced by ORing the two bitmaps"""
-        len1 = len(bitmap1)
-        len2 = len(bitmap2)
-        lenLong = len1
-        lenShort = len2
-        bitmapLong = bitmap1
-        if len2 > len1:
-            lenLong = len2
-            lenShort = len1
-            bitmapLong = bitmap2
-
-        count = 0
-        for i in range(lenShort):
-            val = ord(bitmap1[i]) | ord(bitmap2[i])
-            count += Util.numBits(val)
-
-        for i in range(i + 1, lenLong):
-            val = ord(bitmapLong[i])
-            count += Util.numBits(val)
-        return count
+        if len(bitmap1) < len(bitmap2):
+            bitmap1, bitmap2 = bitmap2, bitmap1
+        if not bitmap1:
+            return 0
+
+        if numpy:
+            union = numpy.frombuffer(bitmap1, dtype=numpy.uint8).copy()
+            if bitmap2:
+                union[:len(bitmap2)] |= numpy.frombuffer(bitmap2,
+                        dtype=numpy.uint8)
+            return int(numpy.unpackbits(union).sum())
+
+        # without NumPy, OR the bitmaps as (arbitrary-precision) integers,
+        # which still does the work in C rather than bit by bit
+        bitmap2 += '\0' * (len(bitmap1) - len(bitmap2))
+        union = long(binascii.hexlify(bitmap1), 16) | \
+                long(binascii.hexlify(bitmap2), 16)
+        return bin(union).count("1")
     countBits = staticmethod(countBits)
 
     def getThisScript():
@@ -223,6 +334,287 @@ class Util:
     getThisScript = staticmethod(getThisScript)
 
 
+class IOStats:
+    """I/O accounting of a process group (such as a process started with
+    Util.runAbortable), from /proc/<pid>/io: the bytes and the calls of read()
+    and write() of every process in the group"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.writeBytes = 0
+        self.ops = 0
+        self.startTime = None
+        self._counters = dict()
+
+    def sample(self, pgid):
+        """Account the I/O done by the process group pgid since the last
+        call"""
+        if self.startTime is None:
+            self.startTime = time.time()
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                f = open("/proc/%s/stat" % name)
+                try:
+                    stat = f.read()
+                finally:
+                    f.close()
+                # the fields following "pid (comm)" are: state ppid pgrp ...
+                if int(stat[stat.rfind(")") + 1:].split()[2]) != pgid:
+                    continue
+                counters = dict()
+                f = open("/proc/%s/io" % name)
+                try:
+                    for line in f:
+                        key, val = line.split(":")
+                        counters[key] = int(val)
+                finally:
+                    f.close()
+            except (IOError, ValueError, IndexError):
+                continue # exited meanwhile
+            nwrite = counters["wchar"]
+            nbytes = counters["rchar"] + nwrite
+            nops = counters["syscr"] + counters["syscw"]
+            prevBytes, prevWrite, prevOps = \
+                    self._counters.get(name, (0, 0, 0))
+            self.bytes += max(nbytes - prevBytes, 0)
+            self.writeBytes += max(nwrite - prevWrite, 0)
+            self.ops += max(nops - prevOps, 0)
+            self._counters[name] = (nbytes, nwrite, nops)
+
+    def getElapsed(self):
+        if self.startTime is None:
+            return 0
+        return time.time() - self.startTime
+
+    def __str__(self):
+        elapsed = self.getElapsed()
+        rate = ""
+        if elapsed > 0:
+            rate = " (%s/s, %d IOPS)" % \
+                    (Util.num2str(self.bytes / elapsed), self.ops / elapsed)
+        return "%s in %d I/Os%s" % (Util.num2str(self.bytes), self.ops, rate)
+
+
+class IOThrottle(IOStats):
+    """Caps the I/O rate of a process group to a bandwidth and/or an IOPS
+    budget, by stopping the group whenever it gets ahead of its budget"""
+
+    def __init__(self, maxBytesPerSec = 0, maxOpsPerSec = 0):
+        IOStats.__init__(self)
+        self.maxBytesPerSec = maxBytesPerSec
+        self.maxOpsPerSec = maxOpsPerSec
+        self.stoppedTime = 0
+
+    def pace(self, pgid, maxDelay):
+        """Account the I/O done by the process group pgid since the last call
+        and, if it is over budget, stop it for up to maxDelay seconds"""
+        self.sample(pgid)
+        elapsed = self.getElapsed()
+        delay = 0
+        if self.maxBytesPerSec:
+            delay = max(delay, self.bytes / float(self.maxBytesPerSec) - elapsed)
+        if self.maxOpsPerSec:
+            delay = max(delay, self.ops / float(self.maxOpsPerSec) - elapsed)
+        if delay <= 0:
+            return
+        delay = min(delay, maxDelay)
+        try:
+            os.killpg(pgid, signal.SIGSTOP)
+        except OSError:
+            return # the group is gone
+        try:
+            time.sleep(delay)
+        finally:
+            try:
+                os.killpg(pgid, signal.SIGCONT)
+            except OSError:
+                pass
+        self.stoppedTime += delay
+
+    def __str__(self):
+        return "%s, stopped for %ds" % (IOStats.__str__(self), self.stoppedTime)
+
+
+class QuietPeriod:
+    """The quiet period the GC waits for before starting: until no SR
+    operation has been notified (see EVENT_SR_OP) for a while, that while
+    growing with the number of operations notified recently, so that the GC
+    keeps out of the way of a busy SR but starts within seconds on an idle
+    one. An abort (EVENT_ABORT) ends the quiet period right away"""
+
+    MIN_LENGTH = 10 # seconds
+    MAX_LENGTH = 5 * 60
+    LENGTH_PER_OP = 10
+    RATE_WINDOW = 5 * 60
+
+    def __init__(self, event):
+        self.event = event
+        self.opTimes = []
+
+    def getLength(self, now):
+        """The length of the quiet period given the operations notified over
+        the last RATE_WINDOW seconds"""
+        self.opTimes = [t for t in self.opTimes if now - t < self.RATE_WINDOW]
+        return min(self.MIN_LENGTH + self.LENGTH_PER_OP * len(self.opTimes),
+                self.MAX_LENGTH)
+
+    def wait(self):
+        """Wait for the quiet period to end, counting the operation that
+        started the GC. Return False if it was ended by an abort"""
+        lastOp = time.time()
+        self.opTimes.append(lastOp)
+        while True:
+            now = time.time()
+            end = lastOp + self.getLength(now)
+            if now >= end:
+                return True
+            codes = self.event.wait(end - now)
+            if EVENT_ABORT in codes:
+                return False
+            for i in range(codes.count(EVENT_SR_OP)):
+                lastOp = time.time()
+                self.opTimes.append(lastOp)
+
+
+class GCState:
+    """The per-SR GC state file, through which the GC publishes what it is
+    doing for get_progress() (and cleanup.py --state/--progress): the
+    coalesce operations in progress (one per coalesce worker, keyed by VDI
+    UUID) and the lifetime coalesce totals. Every change is a read-modify-write
+    under an fcntl lock, and the file is replaced atomically, so readers never
+    need to lock"""
+
+    def __init__(self, srUuid):
+        self.path = os.path.join(GC_STATE_DIR, srUuid)
+
+    def read(self):
+        state = {"coalesce": dict(), "totals": {"coalesced": 0, "failed": 0,
+                "bytes": 0, "seconds": 0}, "last": None}
+        try:
+            f = open(self.path, 'r')
+            try:
+                state.update(json.load(f))
+            finally:
+                f.close()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                Util.log("Failed to read %s: %s" % (self.path, e))
+        except ValueError, e:
+            Util.log("Discarding corrupt %s: %s" % (self.path, e))
+        return state
+
+    def update(self, func):
+        """Apply func to the state (a dict as returned by read()) and write
+        the result back. Errors are logged and ignored: the state file is
+        informational only"""
+        try:
+            if not os.path.isdir(GC_STATE_DIR):
+                os.makedirs(GC_STATE_DIR)
+            lockFile = open(self.path + ".lock", 'a')
+        except (IOError, OSError), e:
+            Util.log("Failed to open %s: %s" % (self.path, e))
+            return
+        try:
+            fileLock = flock.WriteLock(lockFile.fileno())
+            fileLock.lock()
+            try:
+                state = self.read()
+                func(state)
+                state["updated"] = time.time()
+                tmpPath = "%s.%d" % (self.path, os.getpid())
+                f = open(tmpPath, 'w')
+                try:
+                    json.dump(state, f)
+                finally:
+                    f.close()
+                os.rename(tmpPath, self.path)
+            finally:
+                fileLock.unlock()
+        except (IOError, OSError), e:
+            Util.log("Failed to update %s: %s" % (self.path, e))
+        finally:
+            lockFile.close()
+
+
+class CoalesceProgress:
+    """Publishes the progress of the coalesce of a VDI in the GC state file of
+    its SR. The amount of data to copy is the size of the allocated blocks of
+    the VDI, and the amount copied so far is estimated from the bytes written
+    by the coalesce process (from its IOStats)"""
+
+    UPDATE_INTERVAL = 5 # seconds
+
+    def __init__(self, vdi, stats):
+        self.state = GCState(vdi.sr.uuid)
+        self.stats = stats
+        self.uuid = vdi.uuid
+        self.chain = []
+        node = vdi.parent
+        while node:
+            self.chain.append(node.uuid)
+            node = node.parent
+        try:
+            self.total = vdi._getCopySizeForCoalescing()
+        except Exception, e:
+            Util.log("Failed to get the coalesce size of %s: %s" % (vdi, e))
+            self.total = 0
+        self.startTime = time.time()
+        self.lastUpdate = 0
+
+    def getEntry(self):
+        """The progress record of this coalesce"""
+        now = time.time()
+        elapsed = now - self.startTime
+        done = self.stats.writeBytes
+        if self.total:
+            done = min(done, self.total)
+        remaining = max(self.total - done, 0)
+        rate = 0
+        eta = None
+        if elapsed > 0:
+            rate = done / elapsed
+        if rate > 0:
+            eta = int(remaining / rate)
+        blockSize = vhdutil.VHD_BLOCK_SIZE
+        return {"vdi": self.uuid, "parent": self.chain[0],
+                "chain": self.chain, "pid": os.getpid(),
+                "started": self.startTime, "updated": now,
+                "bytes_total": self.total, "bytes_done": done,
+                "blocks_remaining": (remaining + blockSize - 1) / blockSize,
+                "rate": rate, "eta": eta}
+
+    def update(self, force = False):
+        """Publish the current progress, unless it was published less than
+        UPDATE_INTERVAL ago"""
+        now = time.time()
+        if not force and now - self.lastUpdate < self.UPDATE_INTERVAL:
+            return
+        self.lastUpdate = now
+        entry = self.getEntry()
+        def _update(state):
+            state["coalesce"][self.uuid] = entry
+        self.state.update(_update)
+
+    def finish(self, success):
+        """Remove the progress record and account the coalesce in the
+        totals"""
+        entry = self.getEntry()
+        entry["success"] = success
+        def _finish(state):
+            state["coalesce"].pop(self.uuid, None)
+            totals = state["totals"]
+            if success:
+                totals["coalesced"] += 1
+            else:
+                totals["failed"] += 1
+            totals["bytes"] += self.stats.writeBytes
+            totals["seconds"] += time.time() - self.startTime
+            state["last"] = entry
+        self.state.update(_finish)
+
+
 ################################################################################
 #
 #  XAPI
@@ -544,14 +936,44 @@ class VDI:
         return util.is_attached_rw(
                 self.sr.xapi.session.xenapi.VDI.get_sm_config(self.getRef()))
 
-    def getVHDBlocks(self):
+    def getVHDBlocks(self, refresh = False):
+        """Get the VHD block allocation bitmap. If refresh is set, any bitmap
+        stored in the VDI record is considered stale and the VHD is queried
+        again, unless the bitmap for the current VHD size is in the cache.
+        If the SR is read-only, the bitmap stored in the VDI record is used
+        even if stale, and SMException raised if there is none"""
+        if self.sr.readOnly:
+            val = self.getConfig(VDI.DB_VHD_BLOCKS)
+            if not val:
+                raise util.SMException("No block info for %s" % self)
+            return zlib.decompress(base64.b64decode(val))
+        key = self._getBlocksKey()
+        bitmap = self.sr.blockBitmaps.getBitmap(key)
+        if bitmap is not None:
+            return bitmap
+        if refresh:
+            self.delConfig(VDI.DB_VHD_BLOCKS)
         val = self.getConfig(VDI.DB_VHD_BLOCKS)
         if not val:
             self.updateBlockInfo()
             val = self.getConfig(VDI.DB_VHD_BLOCKS)
         bitmap = zlib.decompress(base64.b64decode(val))
+        self.sr.blockBitmaps.putBitmap(key, bitmap)
         return bitmap
 
+    def _getBlocksKey(self):
+        if self.sr.readOnly:
+            # the size of a VHD may take activating its LV to get (LVHD)
+            return None
+        if not self.children:
+            # a leaf may be attached and written to, with its size in the
+            # VDI trees going stale until the next full scan: never cache it
+            return None
+        size = self.getSizeVHD()
+        if size <= 0:
+            return None
+        return (self.uuid, size)
+
     def isCoalesceable(self):
         """A VDI is coalesceable if it has no siblings and is not a leaf"""
         return not self.scanError and \
@@ -621,6 +1043,23 @@ class VDI:
 
         return maxChildHeight + 1
 
+    def getChainLength(self):
+        """Get the length of the longest VHD chain (from the tree root down to
+        a leaf) that self is part of"""
+        depth = 1
+        vdi = self
+        while vdi.parent:
+            depth += 1
+            vdi = vdi.parent
+        return depth + self.getTreeHeight() - 1
+
+    def hasAttachedLeaf(self):
+        "Is any leaf in the subtree rooted at self attached read-write?"
+        for leaf in self.getAllLeaves():
+            if leaf.isAttachedRW():
+                return True
+        return False
+
     def getAllLeaves(self):
         "Get all leaf nodes in the subtree rooted at self"
         if len(self.children) == 0:
@@ -642,6 +1081,8 @@ class VDI:
         oldUuid = self.uuid
         self.uuid = uuid
         self.children = []
+        self.sr.blockBitmaps.forget(oldUuid)
+        self.sr.blockBitmaps.forget(self.uuid)
         # updating the children themselves is the responsiblity of the caller
         del self.sr.vdis[oldUuid]
         self.sr.vdis[self.uuid] = self
@@ -693,7 +1134,7 @@ class VDI:
         self.parent.validate(True)
         self.parent._increaseSizeVirt(self.sizeVirt)
         self.sr._updateSlavesOnResize(self.parent)
-        self._coalesceVHD(0)
+        self._coalesceVHD(0, self.sr.getCoalesceThrottle())
         self.parent.validate(True)
         #self._verifyContents(0)
         self.parent.updateBlockInfo()
@@ -702,7 +1143,7 @@ class VDI:
         Util.log("  Coalesce verification on %s" % self)
         abortTest = lambda:IPCFlag(self.sr.uuid).test(FLAG_TYPE_ABORT)
         Util.runAbortable(lambda: self._runTapdiskDiff(), True,
-                self.sr.uuid, abortTest, VDI.POLL_INTERVAL, timeOut)
+                self.sr.ipcNs, abortTest, VDI.POLL_INTERVAL, timeOut)
         Util.log("  Coalesce verification succeeded")
 
     def _runTapdiskDiff(self):
@@ -783,12 +1224,28 @@ class VDI:
             raise
     _doCoalesceVHD = staticmethod(_doCoalesceVHD)
 
-    def _coalesceVHD(self, timeOut):
+    def _coalesceVHD(self, timeOut, throttle = None):
         Util.log("  Running VHD coalesce on %s" % self)
         abortTest = lambda:IPCFlag(self.sr.uuid).test(FLAG_TYPE_ABORT)
+        stats = throttle or IOStats()
+        progress = CoalesceProgress(self, stats)
+        def monitor(pgid):
+            if throttle:
+                throttle.pace(pgid, VDI.POLL_INTERVAL)
+            else:
+                stats.sample(pgid)
+            progress.update()
+        success = False
         try:
-            Util.runAbortable(lambda: VDI._doCoalesceVHD(self), None,
-                    self.sr.uuid, abortTest, VDI.POLL_INTERVAL, timeOut)
+            try:
+                progress.update(True)
+                Util.runAbortable(lambda: VDI._doCoalesceVHD(self), None,
+                        self.sr.ipcNs, abortTest, VDI.POLL_INTERVAL, timeOut,
+                        monitor)
+                success = True
+            finally:
+                Util.log("  Coalesce I/O: %s" % stats)
+                progress.finish(success)
         except:
             #exception at this phase could indicate a failure in vhd coalesce
             # or a kill of vhd coalesce by runAbortable due to  timeOut
@@ -916,10 +1373,13 @@ class VDI:
         upper bound)"""
         # make sure we don't use stale BAT info from vdi_rec since the child 
         # was writable all this time
-        self.delConfig(VDI.DB_VHD_BLOCKS)
-        blocksChild = self.getVHDBlocks()
-        blocksParent = self.parent.getVHDBlocks()
-        numBlocks = Util.countBits(blocksChild, blocksParent)
+        keys = (self._getBlocksKey(), self.parent._getBlocksKey())
+        numBlocks = self.sr.blockBitmaps.getCount(keys)
+        if numBlocks is None:
+            blocksChild = self.getVHDBlocks(refresh = True)
+            blocksParent = self.parent.getVHDBlocks()
+            numBlocks = Util.countBits(blocksChild, blocksParent)
+            self.sr.blockBitmaps.putCount(keys, numBlocks)
         Util.log("Num combined blocks = %d" % numBlocks)
         sizeData = numBlocks * vhdutil.VHD_BLOCK_SIZE
         assert(sizeData <= self.sizeVirt)
@@ -932,6 +1392,17 @@ class VDI:
         Util.log("Coalesced size = %s" % Util.num2str(sizeCoalesced))
         return sizeCoalesced - self.parent.getSizeVHD()
 
+    def _calcSpaceReclaimedByCoalescing(self):
+        """How much space in the SR coalescing this VDI frees up once it is
+        deleted, net of the growth of the parent"""
+        return self.getSizeVHD() - self._calcExtraSpaceForCoalescing()
+
+    def _getCopySizeForCoalescing(self):
+        """How much data coalescing this VDI copies: all of its allocated
+        blocks"""
+        return Util.countBits(self.getVHDBlocks(), "") * \
+                vhdutil.VHD_BLOCK_SIZE
+
     def _calcExtraSpaceForLeafCoalescing(self):
         """How much extra space in the SR will be required to
         [live-]leaf-coalesce this VDI"""
@@ -1215,10 +1686,12 @@ class LVHDVDI(VDI):
         self.sr.lvActivator.activate(self.uuid, self.fileName, False)
 
     def _activateChain(self):
+        lvs = []
         vdi = self
         while vdi:
-            vdi._activate()
+            lvs.append((vdi.uuid, vdi.fileName, False))
             vdi = vdi.parent
+        self.sr.lvActivator.activateMany(lvs)
 
     def _deactivate(self):
         self.sr.lvActivator.deactivate(self.uuid, False)
@@ -1255,7 +1728,7 @@ class LVHDVDI(VDI):
         Util.log("  Zeroing %s: from %d, %dB" % (self.path, offset, length))
         abortTest = lambda:IPCFlag(self.sr.uuid).test(FLAG_TYPE_ABORT)
         func = lambda: util.zeroOut(self.path, offset, length)
-        Util.runAbortable(func, True, self.sr.uuid, abortTest,
+        Util.runAbortable(func, True, self.sr.ipcNs, abortTest,
                 VDI.POLL_INTERVAL, 0)
         self.sr.journaler.remove(self.JRN_ZERO, self.uuid)
 
@@ -1283,6 +1756,9 @@ class LVHDVDI(VDI):
         Util.log("Coalesced size = %s" % Util.num2str(sizeCoalesced))
         return sizeCoalesced - self.parent.sizeLV
 
+    def _calcSpaceReclaimedByCoalescing(self):
+        return self.sizeLV - self._calcExtraSpaceForCoalescing()
+
     def _calcExtraSpaceForLeafCoalescing(self):
         """How much extra space in the SR will be required to
         [live-]leaf-coalesce this VDI"""
@@ -1296,6 +1772,165 @@ class LVHDVDI(VDI):
 
 
 
+################################################################################
+#
+# BlockBitmapCache
+#
+class BlockBitmapCache:
+    """Decompressed VHD block bitmaps, and the block counts of coalesced VHD
+    pairs, keyed by (VDI UUID, VHD physical size). VHD blocks are only ever
+    allocated at the end of the file, so the bitmap of a VHD cannot change
+    without its physical size changing as well. A None key (that of a leaf,
+    or of any VDI of a read-only SR, see VDI._getBlocksKey) is never
+    cached."""
+
+    def __init__(self):
+        self.bitmaps = dict()
+        self.counts = dict()
+
+    def getBitmap(self, key):
+        if key is None:
+            return None
+        return self.bitmaps.get(key)
+
+    def putBitmap(self, key, bitmap):
+        if key is None:
+            return
+        self.forget(key[0])
+        self.bitmaps[key] = bitmap
+
+    def getCount(self, keys):
+        if None in keys:
+            return None
+        return self.counts.get(keys)
+
+    def putCount(self, keys, count):
+        if None in keys:
+            return
+        self.counts[keys] = count
+
+    def forget(self, uuid):
+        for key in self.bitmaps.keys():
+            if key[0] == uuid:
+                del self.bitmaps[key]
+        for keys in self.counts.keys():
+            if keys[0][0] == uuid or keys[1][0] == uuid:
+                del self.counts[keys]
+
+
+################################################################################
+#
+# Coalesce scheduling
+#
+class CoalesceScheduler:
+    """Decides in which order coalesce candidates are tried. This scheduler
+    keeps the traditional order: VDIs in the tallest trees first. The
+    scheduler of an SR is chosen by name in the SR other-config"""
+
+    NAME = "height"
+
+    def __init__(self, sr):
+        self.sr = sr
+
+    def getInstance(sr):
+        name = sr.xapi.srRecord["other_config"].get(SR.DB_COALESCE_SCHEDULER)
+        if not name:
+            return CoalesceScheduler(sr)
+        for cls in COALESCE_SCHEDULERS:
+            if cls.NAME == name:
+                return cls(sr)
+        Util.log("Unknown coalesce scheduler %s, using %s" % \
+                (name, CoalesceScheduler.NAME))
+        return CoalesceScheduler(sr)
+    getInstance = staticmethod(getInstance)
+
+    def rank(self, candidates):
+        """Return the coalesce plan for candidates: a list of (score, vdi,
+        reason) tuples, best first"""
+        plan = []
+        for vdi in candidates:
+            height = vdi.getTreeRoot().getTreeHeight()
+            plan.append((height, vdi, "tree height %d" % height))
+        plan.sort(key = lambda entry: entry[0], reverse = True)
+        return plan
+
+
+class CostCoalesceScheduler(CoalesceScheduler):
+    """Ranks candidates by the benefit of coalescing them per byte copied.
+    The benefit combines the space reclaimed and the urgency of shortening
+    the chain through the VDI, which grows quadratically as the chain gets
+    close to vhdutil.MAX_CHAIN_SIZE. The cost is the data copied, as counted
+    in the block bitmap of the VDI. VDIs with attached leaves are penalized,
+    as coalescing them competes with guest I/O and requires refreshing the
+    tapdisks. The weights of the factors can be set in the SR other-config,
+    e.g. "reclaim=1,depth=4,copy=1,attached=0.5" """
+
+    NAME = "cost"
+
+    DEFAULT_WEIGHTS = {
+            "reclaim": 1.0,     # per GiB reclaimed
+            "depth": 4.0,       # for a chain at MAX_CHAIN_SIZE
+            "copy": 1.0,        # per GiB copied
+            "attached": 0.5     # score multiplier if any leaf is attached
+    }
+
+    def __init__(self, sr):
+        CoalesceScheduler.__init__(self, sr)
+        self.weights = self._getWeights()
+
+    def rank(self, candidates):
+        plan = []
+        for vdi in candidates:
+            try:
+                score, reason = self._score(vdi)
+            except (util.SMException, XenAPI.Failure), e:
+                Util.log("Failed to estimate the cost of coalescing %s: %s" % \
+                        (vdi, e))
+                score, reason = 0, "cost unknown"
+            plan.append((score, vdi, reason))
+        plan.sort(key = lambda entry: entry[0], reverse = True)
+        return plan
+
+    def _score(self, vdi):
+        gib = float(Util.PREFIX["G"])
+        copied = vdi._getCopySizeForCoalescing()
+        reclaimed = max(vdi._calcSpaceReclaimedByCoalescing(), 0)
+        chainLength = vdi.getChainLength()
+        attached = vdi.hasAttachedLeaf()
+
+        urgency = (float(chainLength) / vhdutil.MAX_CHAIN_SIZE) ** 2
+        benefit = self.weights["reclaim"] * reclaimed / gib + \
+                self.weights["depth"] * urgency
+        score = benefit / (1 + self.weights["copy"] * copied / gib)
+        reason = "copy %s, reclaim %s, chain %d/%d" % \
+                (Util.num2str(copied), Util.num2str(reclaimed), chainLength,
+                        vhdutil.MAX_CHAIN_SIZE)
+        if attached:
+            score *= self.weights["attached"]
+            reason += ", attached"
+        return score, reason
+
+    def _getWeights(self):
+        weights = self.DEFAULT_WEIGHTS.copy()
+        val = self.sr.xapi.srRecord["other_config"].get(SR.DB_COALESCE_WEIGHTS)
+        if not val:
+            return weights
+        for item in val.split(","):
+            try:
+                key, weight = item.split("=")
+                key = key.strip()
+                if not weights.has_key(key):
+                    raise ValueError(key)
+                weights[key] = float(weight)
+            except ValueError:
+                Util.log("Invalid %s item: %s" % \
+                        (SR.DB_COALESCE_WEIGHTS, item))
+        return weights
+
+
+COALESCE_SCHEDULERS = [CoalesceScheduler, CostCoalesceScheduler]
+
+
 ################################################################################
 #
 # SR
@@ -1358,6 +1993,16 @@ class SR:
     LOCK_RETRY_ATTEMPTS_LOCK = 100
 
     SCAN_RETRY_ATTEMPTS = 3
+    FULL_SCAN_INTERVAL = 10 * 60 # max seconds between full scans in update()
+
+    DB_COALESCE_WORKERS = "coalesce-workers" # SR other-config key
+    MAX_COALESCE_WORKERS = 8
+    DB_COALESCE_SCHEDULER = "coalesce-scheduler" # SR other-config key
+    DB_COALESCE_WEIGHTS = "coalesce-scheduler-weights" # SR other-config key
+    DB_COALESCE_RATE_LIMIT = "coalesce-rate-limit" # MB/s, SR other-config key
+    DB_COALESCE_IOPS_LIMIT = "coalesce-iops-limit" # SR other-config key
+    DB_GC_WINDOWS = "gc-windows" # SR other-config key
+    GC_WINDOW_POLL_INTERVAL = 5 * 60
 
     JRN_CLONE = "clone" # journal entry type for the clone operation (from SM)
     TMP_RENAME_PREFIX = "OLD_"
@@ -1378,11 +2023,22 @@ class SR:
     def __init__(self, uuid, xapi, createLock, force):
         self.logFilter = self.LogFilter(self)
         self.uuid = uuid
+        # IPC namespace for the result flags of the processes we run through
+        # Util.runAbortable (distinct in each parallel coalesce worker)
+        self.ipcNs = uuid
         self.path = ""
         self.name = ""
         self.vdis = {}
         self.vdiTrees = []
         self.journaler = None
+        self.blockBitmaps = BlockBitmapCache()
+        # set to only inspect the SR (see get_coalesce_plan): the VHD block
+        # bitmaps then come from the VDI records, never queried nor stored
+        self.readOnly = False
+        self.changeLog = None
+        self._changeLogPos = None
+        self._lastFullScan = 0
+        self._touched = set()
         self.xapi = xapi
         self._locked = 0
         self._srLock = None
@@ -1425,6 +2081,47 @@ class SR:
         finally:
             self.unlock()
 
+    def update(self):
+        """Bring the VDI trees up to date like scan(), but only reload the
+        VDIs that we modified ourselves (see touch()), that are recorded as
+        modified in the VHD change log, or whose LV changed. Fall back to a
+        full scan every FULL_SCAN_INTERVAL, or if the changes since the last
+        scan cannot be accounted for (e.g. a VDI appeared that was not created
+        from this host). Must be called with the SR locked"""
+        names = None
+        if self._lastFullScan and \
+                time.time() - self._lastFullScan < self.FULL_SCAN_INTERVAL:
+            names, changeLogPos = self.changeLog.read(self._changeLogPos)
+        if names is None:
+            self.scan()
+            return
+
+        # if anything goes wrong, we can no longer trust the VDI trees
+        lastFullScan = self._lastFullScan
+        self._lastFullScan = 0
+        if not self._update(names):
+            Util.log("Unexpected changes since the last scan, rescanning")
+            self.scan()
+            return
+        self._buildTree(False)
+        self._changeLogPos = changeLogPos
+        self._lastFullScan = lastFullScan
+        self._touched = set()
+        self.logFilter.logState()
+        self._handleInterruptedCoalesceLeaf()
+
+    def updateLocked(self):
+        self.lock()
+        try:
+            self.update()
+        finally:
+            self.unlock()
+
+    def touch(self, vdi):
+        """Have the next update() reload all the VDIs in the tree of vdi"""
+        for node in vdi.getTreeRoot()._getAllSubtree():
+            self._touched.add(node.uuid)
+
     def getVDI(self, uuid):
         return self.vdis.get(uuid)
 
@@ -1458,33 +2155,139 @@ class SR:
             if vdi and vdi not in self._failedCoalesceTargets:
                 return vdi
 
+        freeSpace = self.getFreeSpace()
+        for c in self._getCoalesceCandidates():
+            spaceNeeded = c._calcExtraSpaceForCoalescing()
+            if spaceNeeded <= freeSpace:
+                Util.log("Coalesce candidate: %s (tree height %d)" % \
+                        (c, c.getTreeRoot().getTreeHeight()))
+                return c
+            else:
+                Util.log("No space to coalesce %s (free space: %d)" % \
+                        (c, freeSpace))
+        return None
+
+    def findCoalesceableMany(self, maxCount):
+        """Find up to maxCount coalesceable VDIs, each in a different VHD
+        tree, whose combined space requirements fit in the SR free space.
+        Candidates are considered in the same order as in findCoalesceable.
+        Return an empty list if a relink is pending: that must be finished
+        by findCoalesceable & coalesce first"""
+        srSwitch = self.xapi.srRecord["other_config"].get(VDI.DB_COALESCE)
+        if srSwitch == "false":
+            Util.log("Coalesce disabled for this SR")
+            return []
+        if self.journaler.getAll(VDI.JRN_RELINK):
+            return []
+
+        chosen = []
+        roots = set()
+        freeSpace = self.getFreeSpace()
+        for c in self._getCoalesceCandidates():
+            root = c.getTreeRoot()
+            if root in roots:
+                continue
+            spaceNeeded = c._calcExtraSpaceForCoalescing()
+            if spaceNeeded > freeSpace:
+                Util.log("No space to coalesce %s (free space left: %d)" % \
+                        (c, freeSpace))
+                continue
+            Util.log("Coalesce candidate: %s (tree height %d)" % \
+                    (c, root.getTreeHeight()))
+            freeSpace -= spaceNeeded
+            roots.add(root)
+            chosen.append(c)
+            if len(chosen) >= maxCount:
+                break
+        return chosen
+
+    def getCoalescePlan(self):
+        """Rank all coalesceable VDIs with the coalesce scheduler of the SR.
+        Return a list of (score, vdi, reason) tuples, best candidate first"""
+        candidates = []
         for vdi in self.vdis.values():
             if vdi.isCoalesceable() and vdi not in self._failedCoalesceTargets:
                 candidates.append(vdi)
                 Util.log("%s is coalescable" % vdi.uuid)
 
-        # pick one in the tallest tree
-        treeHeight = dict()
-        for c in candidates:
-            height = c.getTreeRoot().getTreeHeight()
-            if treeHeight.get(height):
-                treeHeight[height].append(c)
+        scheduler = CoalesceScheduler.getInstance(self)
+        plan = scheduler.rank(candidates)
+        if plan:
+            Util.log("Coalesce plan (%s scheduler):" % scheduler.NAME)
+            for score, vdi, reason in plan:
+                Util.log("  %s: %.3f (%s)" % (vdi, score, reason))
+        return plan
+
+    def _getCoalesceCandidates(self):
+        """All coalesceable VDIs, in the order of the coalesce plan"""
+        return [vdi for score, vdi, reason in self.getCoalescePlan()]
+
+    def getCoalesceWorkers(self):
+        """The number of VHD trees to coalesce concurrently, as set in the SR
+        other-config (default: 1, i.e. no parallel coalesce)"""
+        val = self.xapi.srRecord["other_config"].get(SR.DB_COALESCE_WORKERS)
+        if not val:
+            return 1
+        try:
+            workers = int(val)
+        except ValueError:
+            Util.log("Invalid %s: %s" % (SR.DB_COALESCE_WORKERS, val))
+            return 1
+        return max(1, min(workers, SR.MAX_COALESCE_WORKERS))
+
+    def getCoalesceThrottle(self):
+        """The IOThrottle to coalesce with, as configured in the SR
+        other-config (None if coalesce is not throttled). Leaf-coalesce is
+        never throttled, as the VDI is paused meanwhile"""
+        maxRate = self._getConfigNumber(SR.DB_COALESCE_RATE_LIMIT)
+        maxIOPS = self._getConfigNumber(SR.DB_COALESCE_IOPS_LIMIT)
+        if not maxRate and not maxIOPS:
+            return None
+        Util.log("Coalesce throttled to %s MB/s, %s IOPS" % \
+                (maxRate or "unlimited", maxIOPS or "unlimited"))
+        return IOThrottle(maxRate * Util.PREFIX["M"], maxIOPS)
+
+    def getGCWindowDelay(self, now = None):
+        """How long (in seconds) until the GC may run according to the time
+        windows in the SR other-config, given as "HH:MM-HH:MM[,...]" in local
+        time (windows may span midnight). Return 0 if the GC may run now"""
+        val = self.xapi.srRecord["other_config"].get(SR.DB_GC_WINDOWS)
+        if not val:
+            return 0
+        if now is None:
+            now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        wait = None
+        for window in val.split(","):
+            try:
+                start, end = window.split("-")
+                start = Util.parseTimeOfDay(start)
+                end = Util.parseTimeOfDay(end)
+            except ValueError:
+                Util.log("Invalid %s window: %s" % (SR.DB_GC_WINDOWS, window))
+                continue
+            if start <= end:
+                inside = start <= minute < end
             else:
-                treeHeight[height] = [c]
-
-        freeSpace = self.getFreeSpace()
-        heights = treeHeight.keys()
-        heights.sort(reverse=True)
-        for h in heights:
-            for c in treeHeight[h]:
-                spaceNeeded = c._calcExtraSpaceForCoalescing()
-                if spaceNeeded <= freeSpace:
-                    Util.log("Coalesce candidate: %s (tree height %d)" % (c, h))
-                    return c
-                else:
-                    Util.log("No space to coalesce %s (free space: %d)" % \
-                            (c, freeSpace))
-        return None
+                inside = minute >= start or minute < end
+            if inside:
+                return 0
+            untilStart = (start - minute) % (24 * 60)
+            if wait is None or untilStart < wait:
+                wait = untilStart
+        if wait is None:
+            return 0 # no valid window: do not hold the GC back
+        return wait * 60 - now.tm_sec
+
+    def _getConfigNumber(self, key):
+        val = self.xapi.srRecord["other_config"].get(key)
+        if not val:
+            return 0
+        try:
+            return max(float(val), 0)
+        except ValueError:
+            Util.log("Invalid %s: %s" % (key, val))
+            return 0
 
     def findLeafCoalesceable(self):
         """Find leaf-coalesceable VDIs in each VHD tree"""
@@ -1543,6 +2346,7 @@ class SR:
         if dryRun:
             return
 
+        parent = vdi.parent
         try:
             self._coalesce(vdi)
         except util.SMException, e:
@@ -1553,7 +2357,51 @@ class SR:
                 self._failedCoalesceTargets.append(vdi)
                 Util.logException("coalesce")
                 Util.log("Coalesce failed, skipping")
+        self.touch(parent)
+        self.cleanup()
+
+    def coalesceParallel(self, vdis, dryRun):
+        """Coalesce each of vdis (which must be in disjoint VHD trees) onto its
+        parent concurrently. Each coalesce runs in its own worker process
+        through Util.runAbortable, so that an abort request kills them all"""
+        for vdi in vdis:
+            Util.log("Coalescing %s -> %s (in parallel)" % (vdi, vdi.parent))
+        if dryRun:
+            return
+
+        # release our LV activations: the workers may delete those LVs
         self.cleanup()
+        for vdi in vdis:
+            self.touch(vdi)
+        abortTest = lambda:IPCFlag(self.uuid).test(FLAG_TYPE_ABORT)
+        errors = dict()
+
+        def runWorker(slot, vdi):
+            func = lambda: _coalesceWorker(self, vdi.uuid,
+                    vdi.getTreeRoot().uuid, slot)
+            try:
+                Util.runAbortable(func, True, "%s-gc%d" % (self.uuid, slot),
+                        abortTest, VDI.POLL_INTERVAL, 0)
+            except Exception, e:
+                errors[vdi] = e
+
+        threads = []
+        for slot, vdi in enumerate(vdis):
+            thread = threading.Thread(target = runWorker, args = (slot, vdi))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        aborted = False
+        for vdi, e in errors.iteritems():
+            if isinstance(e, AbortException):
+                aborted = True
+            else:
+                self._failedCoalesceTargets.append(vdi)
+                Util.log("Coalesce of %s failed (%s), skipping" % (vdi, e))
+        if aborted:
+            raise AbortException("Aborting due to signal")
 
     def coalesceLeaf(self, vdi, dryRun):
         """Leaf-coalesce vdi onto parent"""
@@ -1569,6 +2417,7 @@ class SR:
             finally:
                 vdi = self.getVDI(uuid)
                 if vdi:
+                    self.touch(vdi)
                     vdi.delConfig(vdi.DB_LEAFCLSC)
         except (util.SMException, XenAPI.Failure), e:
             if isinstance(e, AbortException):
@@ -1605,6 +2454,7 @@ class SR:
     def deleteVDI(self, vdi):
         assert(len(vdi.children) == 0)
         del self.vdis[vdi.uuid]
+        self.blockBitmaps.forget(vdi.uuid)
         if vdi.parent:
             vdi.parent.children.remove(vdi)
         if vdi in self.vdiTrees:
@@ -1747,7 +2597,8 @@ class SR:
 
         self.lock()
         try:
-            self.scan()
+            self.touch(vdi)
+            self.update()
             vdi._relinkSkip()
         finally:
             self.unlock()
@@ -1785,7 +2636,8 @@ class SR:
                 Util.log("The VDI appears to have been concurrently deleted")
                 return False
             raise
-        self.scanLocked()
+        self.touch(vdi)
+        self.updateLocked()
         tempSnap = vdi.parent
         if not tempSnap.isCoalesceable():
             Util.log("The VDI appears to have been concurrently snapshotted")
@@ -1802,7 +2654,8 @@ class SR:
         util.fistpoint.activate("LVHDRT_coaleaf_delay_3", self.uuid)
         self.lock()
         try:
-            self.scan()
+            self.touch(vdi)
+            self.update()
             if not self.getVDI(vdi.uuid):
                 Util.log("The VDI appears to have been deleted meanwhile")
                 return False
@@ -1929,6 +2782,32 @@ class SR:
                 Util.log("VDI %s disappeared since last scan" % \
                         self.vdis[uuid])
                 del self.vdis[uuid]
+                self.blockBitmaps.forget(uuid)
+
+    def _update(self, names):
+        """Reload the VDIs that changed since the last scan for update(), given
+        the names logged in the VHD change log since. Return False if a full
+        scan is needed instead"""
+        pass # abstract
+
+    def _removeVanishedVDIs(self, uuidsPresent, changed):
+        """_removeStaleVDIs for _update(): refuse (returning False) if a VDI
+        that still had children vanished unexpectedly, since that means its
+        tree was changed behind our back"""
+        present = set(uuidsPresent)
+        for uuid, vdi in self.vdis.iteritems():
+            if not uuid in present and not uuid in changed and vdi.children:
+                Util.log("VDI %s disappeared unexpectedly" % vdi)
+                return False
+        self._removeStaleVDIs(uuidsPresent)
+        return True
+
+    def _scanDone(self, changeLogPos):
+        """Note the completion of a full scan, started when the VHD change log
+        was at changeLogPos"""
+        self._changeLogPos = changeLogPos
+        self._lastFullScan = time.time()
+        self._touched = set()
 
     def _handleInterruptedCoalesceLeaf(self):
         """An interrupted leaf-coalesce operation may leave the VHD tree in an 
@@ -1940,6 +2819,9 @@ class SR:
 
     def _buildTree(self, force):
         self.vdiTrees = []
+        for vdi in self.vdis.values():
+            vdi.parent = None
+            vdi.children = []
         for vdi in self.vdis.values():
             if vdi.parentUuid:
                 parent = self.getVDI(vdi.parentUuid)
@@ -1974,6 +2856,8 @@ class FileSR(SR):
         SR.__init__(self, uuid, xapi, createLock, force)
         self.path = "/var/run/sr-mount/%s" % self.uuid
         self.journaler = fjournaler.Journaler(self.path)
+        self.vhdCache = vhdcache.VHDCache(self.uuid)
+        self.changeLog = vhdcache.ChangeLog(self.uuid)
 
     def findLeafCoalesceable(self):
         """Disable leaf-coalesce for File-based SRs"""
@@ -1982,6 +2866,7 @@ class FileSR(SR):
     def scan(self, force = False):
         if not util.pathexists(self.path):
             raise util.SMException("directory %s not found!" % self.uuid)
+        changeLogPos = self.changeLog.position()
         vhds = self._scan(force)
         for uuid, vhdInfo in vhds.iteritems():
             vdi = self.getVDI(uuid)
@@ -2005,6 +2890,7 @@ class FileSR(SR):
         self._buildTree(force)
         self.logFilter.logState()
         self._handleInterruptedCoalesceLeaf()
+        self._scanDone(changeLogPos)
 
     def getFreeSpace(self):
         return util.get_fs_size(self.path) - util.get_fs_utilisation(self.path)
@@ -2096,8 +2982,9 @@ class FileSR(SR):
     def _scan(self, force):
         for i in range(SR.SCAN_RETRY_ATTEMPTS):
             error = False
-            pattern = os.path.join(self.path, "*%s" % vhdutil.FILE_EXTN_VHD)
-            vhds = vhdutil.getAllVHDs(pattern, FileVDI.extractUuid)
+            self.vhdCache.bypass = force
+            vhds = vhdcache.getFileVHDs(self.path, FileVDI.extractUuid,
+                    self.vhdCache)
             for uuid, vhdInfo in vhds.iteritems():
                 if vhdInfo.error:
                     error = True
@@ -2109,6 +2996,39 @@ class FileSR(SR):
             return vhds
         raise util.SMException("Scan error")
 
+    def _update(self, names):
+        changed = set(self._touched)
+        for name in names:
+            uuid = FileVDI.extractUuid(name)
+            if uuid:
+                changed.add(uuid)
+        uuidsPresent = []
+        for name in os.listdir(self.path):
+            uuid = FileVDI.extractUuid(name)
+            raw = name.endswith(vhdutil.FILE_EXTN_RAW)
+            if not uuid or (not raw and name.startswith('.')):
+                continue
+            uuidsPresent.append(uuid)
+            vdi = self.getVDI(uuid)
+            if not uuid in changed:
+                if vdi:
+                    continue
+                Util.log("VDI %s appeared unexpectedly" % uuid)
+                return False
+            if not vdi:
+                self.logFilter.logNewVDI(uuid)
+                vdi = FileVDI(self, uuid, raw)
+                self.vdis[uuid] = vdi
+            if raw:
+                continue
+            vhdInfo = vhdutil.getScanInfo(os.path.join(self.path, name),
+                    FileVDI.extractUuid)
+            if not vhdInfo or vhdInfo.error:
+                Util.log("Failed to read the VHD info of %s" % name)
+                return False
+            vdi.load(vhdInfo)
+        return self._removeVanishedVDIs(uuidsPresent, changed)
+
     def deleteVDI(self, vdi):
         self._checkSlaves(vdi)
         SR.deleteVDI(self, vdi)
@@ -2212,6 +3132,8 @@ class LVHDSR(SR):
         self.lvmCache = lvmcache.LVMCache(self.vgName)
         self.lvActivator = LVActivator(self.uuid, self.lvmCache)
         self.journaler = journaler.Journaler(self.lvmCache)
+        self.vhdCache = vhdcache.VHDCache(self.vgName)
+        self.changeLog = vhdcache.ChangeLog(self.vgName)
 
     def deleteVDI(self, vdi):
         if self.lvActivator.get(vdi.uuid, False):
@@ -2256,6 +3178,7 @@ class LVHDSR(SR):
             self.cleanup()
 
     def scan(self, force = False):
+        changeLogPos = self.changeLog.position()
         vdis = self._scan(force)
         for uuid, vdiInfo in vdis.iteritems():
             vdi = self.getVDI(uuid)
@@ -2269,12 +3192,14 @@ class LVHDSR(SR):
         self._buildTree(force)
         self.logFilter.logState()
         self._handleInterruptedCoalesceLeaf()
+        self._scanDone(changeLogPos)
 
     def _scan(self, force):
         for i in range(SR.SCAN_RETRY_ATTEMPTS):
             error = False
             self.lvmCache.refresh()
-            vdis = lvhdutil.getVDIInfo(self.lvmCache)
+            self.vhdCache.bypass = force
+            vdis = lvhdutil.getVDIInfo(self.lvmCache, self.vhdCache)
             for uuid, vdiInfo in vdis.iteritems():
                 if vdiInfo.scanError:
                     error = True
@@ -2286,12 +3211,48 @@ class LVHDSR(SR):
             return vdis
         raise util.SMException("Scan error")
 
+    def _update(self, names):
+        changed = set(self._touched)
+        for name in names:
+            vdiType, uuid = lvhdutil.matchLV(name)
+            if uuid:
+                changed.add(uuid)
+        self.lvmCache.refresh()
+        lvs = lvhdutil.getLVInfo(self.lvmCache)
+        uuidsLoad = []
+        for uuid, lvInfo in lvs.iteritems():
+            vdi = self.getVDI(uuid)
+            if not vdi:
+                if not uuid in changed:
+                    Util.log("VDI %s appeared unexpectedly" % uuid)
+                    return False
+                uuidsLoad.append(uuid)
+            elif uuid in changed or vdi.sizeLV != lvInfo.size or \
+                    vdi.lvActive != lvInfo.active or \
+                    vdi.lvOpen != lvInfo.open or \
+                    vdi.lvReadonly != lvInfo.readonly or \
+                    (vdi.raw and vdi.hidden != lvInfo.hidden):
+                uuidsLoad.append(uuid)
+        vdis = lvhdutil.getVDIInfoSubset(self.lvmCache, uuidsLoad)
+        for uuid, vdiInfo in vdis.iteritems():
+            if vdiInfo.scanError:
+                return False
+            vdi = self.getVDI(uuid)
+            if not vdi:
+                self.logFilter.logNewVDI(uuid)
+                vdi = LVHDVDI(self, uuid,
+                        vdiInfo.vdiType == vhdutil.VDI_TYPE_RAW)
+                self.vdis[uuid] = vdi
+            vdi.load(vdiInfo)
+        return self._removeVanishedVDIs(lvs.keys(), changed)
+
     def _removeStaleVDIs(self, uuidsPresent):
         for uuid in self.vdis.keys():
             if not uuid in uuidsPresent:
                 Util.log("VDI %s disappeared since last scan" % \
                         self.vdis[uuid])
                 del self.vdis[uuid]
+                self.blockBitmaps.forget(uuid)
                 if self.lvActivator.get(uuid, False):
                     self.lvActivator.remove(uuid, False)
 
@@ -2466,9 +3427,7 @@ class LVHDSR(SR):
         for slave in slaves:
             Util.log("Updating %s, %s, %s on slave %s" % \
                     (tmpName, child.fileName, parent.fileName, slave))
-            text = self.xapi.session.xenapi.host.call_plugin( \
-                    slave, self.xapi.PLUGIN_ON_SLAVE, "multi", args)
-            Util.log("call-plugin returned: '%s'" % text)
+        lvhdutil.multiOnSlaves(self.xapi.session, slaves, args)
 
     def _updateSlavesOnRename(self, vdi, oldNameLV):
         slaves = util.get_slaves_attached_on(self.xapi.session, [vdi.uuid])
@@ -2484,9 +3443,7 @@ class LVHDSR(SR):
         for slave in slaves:
             Util.log("Updating %s to %s on slave %s" % \
                     (oldNameLV, vdi.fileName, slave))
-            text = self.xapi.session.xenapi.host.call_plugin( \
-                    slave, self.xapi.PLUGIN_ON_SLAVE, "multi", args)
-            Util.log("call-plugin returned: '%s'" % text)
+        lvhdutil.multiOnSlaves(self.xapi.session, slaves, args)
 
     def _updateSlavesOnResize(self, vdi):
         uuids = map(lambda x: x.uuid, vdi.getAllLeaves())
@@ -2541,21 +3498,40 @@ def _gcLoop(sr, dryRun):
     if not lockActive.acquireNoblock():
         Util.log("Another GC instance already active, exiting")
         return
+    event = IPCEvent(NS_PREFIX_GC_EVENT + sr.uuid, GC_EVENT)
     try:
-        # TODO: make the delay configurable
+        try:
+            event.listen()
+        except util.SMException, e:
+            Util.log("Failed to listen for GC wakeups: %s" % e)
         Util.log("GC active, about to go quiet")
-        time.sleep(5 * 60)
+        if not QuietPeriod(event).wait():
+            Util.log("Abort requested during the quiet period, exiting")
+            return
         Util.log("GC active, quiet period ended")
 
         while True:
             if not sr.xapi.isPluggedHere():
                 Util.log("SR no longer attached, exiting")
                 break
-            sr.scanLocked()
+            sr.updateLocked()
             if not sr.hasWork():
                 Util.log("No work, exiting")
                 break
 
+            # refreshes the SR record, for the time windows below
+            if not sr.gcEnabled():
+                break
+            delay = sr.getGCWindowDelay()
+            if delay:
+                Util.log("Outside the GC time windows, next one opens in " \
+                        "%d seconds" % delay)
+                if EVENT_ABORT in event.wait(min(delay,
+                        SR.GC_WINDOW_POLL_INTERVAL)):
+                    Util.log("Abort requested, exiting")
+                    break
+                continue
+
             if not lockRunning.acquireNoblock():
                 Util.log("Unable to acquire GC running lock.")
                 return
@@ -2563,7 +3539,7 @@ def _gcLoop(sr, dryRun):
                 if not sr.gcEnabled():
                     break
                 sr.cleanupCoalesceJournals()
-                sr.scanLocked()
+                sr.updateLocked()
                 sr.updateBlockInfo()
 
                 howmany = len(sr.findGarbage())
@@ -2572,6 +3548,14 @@ def _gcLoop(sr, dryRun):
                     sr.garbageCollect(dryRun)
                     sr.xapi.srUpdate()
 
+                workers = sr.getCoalesceWorkers()
+                if workers > 1:
+                    candidates = sr.findCoalesceableMany(workers)
+                    if len(candidates) > 1:
+                        sr.coalesceParallel(candidates, dryRun)
+                        sr.xapi.srUpdate()
+                        continue
+
                 candidate = sr.findCoalesceable()
                 if candidate:
                     util.fistpoint.activate(
@@ -2590,8 +3574,45 @@ def _gcLoop(sr, dryRun):
                 lockRunning.release()
     finally:
         Util.log("GC process exiting, no work left")
+        event.close()
         lockActive.release()
 
+def _coalesceWorker(sr, vdiUuid, rootUuid, slot):
+    """Body of a parallel coalesce worker process (see SR.coalesceParallel):
+    coalesce VDI vdiUuid, while holding the lock of its VHD tree. sr is the
+    copy, in the worker process, of the SR object of the GC: it gets a private
+    XAPI session, and only the VHD tree of vdiUuid is reloaded (through
+    update()) rather than the whole SR rescanned"""
+    ns = NS_PREFIX_COALESCE_TREE + sr.uuid
+    treeLock = lock.Lock(rootUuid, ns)
+    if not treeLock.acquireNoblock():
+        Util.log("VHD tree %s is busy, skipping %s" % (rootUuid, vdiUuid))
+        return False
+    try:
+        # the session of the GC is not ours to log out
+        sr.xapi.sessionPrivate = False
+        sr.xapi = XAPI(None, sr.uuid)
+        sr.ipcNs = "%s-vhd%d" % (sr.uuid, slot)
+        sr._failedCoalesceTargets = []
+        # the other trees are coalesced concurrently by other workers: their
+        # changes show in the change log
+        sr._touched = set()
+        sr.touch(sr.getVDI(vdiUuid))
+        try:
+            sr.updateLocked()
+            vdi = sr.getVDI(vdiUuid)
+            if not vdi or not vdi.isCoalesceable():
+                Util.log("%s no longer coalesceable, skipping" % vdiUuid)
+                return False
+            sr.coalesce(vdi, False)
+            return vdi not in sr._failedCoalesceTargets
+        finally:
+            sr.cleanup()
+            del sr.xapi
+    finally:
+        treeLock.release()
+        lock.Lock.cleanup(rootUuid, ns)
+
 def _gc(session, srUuid, dryRun):
     init(srUuid)
     sr = SR.getInstance(srUuid, session)
@@ -2633,8 +3654,19 @@ def _abort(srUuid, soft=False):
         if not gotLock:
             raise util.CommandException(code=errno.ETIMEDOUT,
                     reason="SR %s: error aborting existing process" % srUuid)
+    # a GC still in its quiet period (or waiting for its time window) would
+    # otherwise only notice it cannot run when it gets to it
+    _notifyGC(srUuid, EVENT_ABORT)
     return True
 
+def _notifyGC(srUuid, code):
+    """Notify the active GC of SR srUuid, if any, of an event (EVENT_*)"""
+    try:
+        return IPCEvent(NS_PREFIX_GC_EVENT + srUuid, GC_EVENT).notify(code)
+    except util.SMException, e:
+        Util.log("Failed to notify the GC: %s" % e)
+        return False
+
 def init(srUuid):
     global lockRunning
     if not lockRunning:
@@ -2655,6 +3687,11 @@ Parameters:
                      max_age hours
     -a --abort       abort any currently running operation (GC or coalesce)
     -q --query       query the current state (GC'ing, coalescing or not running)
+    -p --plan        print the coalesce candidates in the order the GC would
+                     coalesce them in (see the coalesce-scheduler SR
+                     other-config key)
+    -s --state       print the GC state (coalesce progress and totals) as JSON
+       --progress    print the progress of the coalesce operations in progress
     -x --disable     disable GC/coalesce (will be in effect until you exit)
     -t --debug       see Debug below
 
@@ -2708,6 +3745,8 @@ def gc(session, srUuid, inBackground, dryRun = False):
     6. If there is something to coalesce, coalesce one pair, then goto 3
     """
     Util.log("=== SR %s: gc ===" % srUuid)
+    # an already active GC restarts its quiet period (and this one exits)
+    _notifyGC(srUuid, EVENT_SR_OP)
     if inBackground:
         if daemonize():
             # we are now running in the background. Catch & log any errors 
@@ -2766,21 +3805,48 @@ def get_state(srUuid):
         return False
     return True
 
+def get_progress(srUuid):
+    """Return the GC state of SR "srUuid" (see GCState): the coalesce
+    operations in progress with their progress (bytes done and total, blocks
+    remaining, rate in bytes per second, ETA in seconds, and the chain of
+    ancestors of the VDI), the last coalesce completed, the lifetime coalesce
+    totals, and whether GC/coalesce is currently running"""
+    state = GCState(srUuid).read()
+    for uuid, entry in state["coalesce"].items():
+        if not Util.isAlive(entry["pid"]):
+            del state["coalesce"][uuid]
+    state["running"] = get_state(srUuid)
+    return state
+
 def should_preempt(session, srUuid):
     sr = SR.getInstance(srUuid, session)
     entries = sr.journaler.getAll(VDI.JRN_COALESCE)
     if len(entries) == 0:
         return False
-    elif len(entries) > 1:
-        raise util.SMException("More than one coalesce entry: " + str(entries))
+    # one entry per coalesce in progress (several with parallel coalesce)
     sr.scan()
-    coalescedUuid = entries.popitem()[0]
     garbage = sr.findGarbage()
     for vdi in garbage:
-        if vdi.uuid == coalescedUuid:
+        if entries.has_key(vdi.uuid):
             return True
     return False
 
+def get_coalesce_plan(session, srUuid):
+    """Return the ranked coalesce plan of SR "srUuid" as a list of (VDI UUID,
+    parent UUID, score, reason) tuples, best candidate first. Nothing is
+    coalesced, and nothing written to the VDI records: the costs are
+    estimated from the block bitmaps already stored in them"""
+    sr = SR.getInstance(srUuid, session)
+    sr.readOnly = True
+    try:
+        sr.scanLocked()
+        plan = []
+        for score, vdi, reason in sr.getCoalescePlan():
+            plan.append((vdi.uuid, vdi.parent.uuid, score, reason))
+        return plan
+    finally:
+        sr.cleanup()
+
 def get_coalesceable_leaves(session, srUuid, vdiUuids):
     coalesceable = []
     sr = SR.getInstance(srUuid, session)
@@ -2837,9 +3903,10 @@ def main():
     dryRun     = False
     debug_cmd  = ""
     vdi_uuid   = ""
-    shortArgs  = "gGc:aqxu:bfdt:v:"
-    longArgs   = ["gc", "gc_force", "clean_cache", "abort", "query", "disable",
-            "uuid=", "background", "force", "dry-run", "debug=", "vdi_uuid="]
+    shortArgs  = "gGc:aqpsxu:bfdt:v:"
+    longArgs   = ["gc", "gc_force", "clean_cache", "abort", "query", "plan",
+            "state", "progress", "disable", "uuid=", "background", "force", "dry-run", "debug=",
+            "vdi_uuid="]
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], shortArgs, longArgs)
@@ -2857,6 +3924,12 @@ def main():
             action = "abort"
         if o in ("-q", "--query"):
             action = "query"
+        if o in ("-p", "--plan"):
+            action = "plan"
+        if o in ("-s", "--state"):
+            action = "state"
+        if o == "--progress":
+            action = "progress"
         if o in ("-x", "--disable"):
             action = "disable"
         if o in ("-u", "--uuid"):
@@ -2880,7 +3953,7 @@ def main():
             action != "debug" and (debug_cmd or vdi_uuid):
         usage()
 
-    if action != "query" and action != "debug":
+    if action not in ("query", "plan", "state", "progress", "debug"):
         print "All output goes to log"
 
     if action == "gc":
@@ -2893,6 +3966,30 @@ def main():
         abort(uuid)
     elif action == "query":
         print "Currently running: %s" % get_state(uuid)
+    elif action == "plan":
+        for vdiUuid, parentUuid, score, reason in get_coalesce_plan(None, uuid):
+            print "%s -> %s: %.3f (%s)" % (vdiUuid, parentUuid, score, reason)
+    elif action == "state":
+        print json.dumps(get_progress(uuid), indent=2, sort_keys=True)
+    elif action == "progress":
+        state = get_progress(uuid)
+        print "Currently running: %s" % state["running"]
+        for entry in state["coalesce"].values():
+            print "%s -> %s (chain of %d): %s of %s, %d blocks remaining, " \
+                    "%s/s, ETA %s" % (entry["vdi"], entry["parent"],
+                    len(entry["chain"]) + 1, Util.num2str(entry["bytes_done"]),
+                    Util.num2str(entry["bytes_total"]),
+                    entry["blocks_remaining"], Util.num2str(entry["rate"]),
+                    entry["eta"] is None and "unknown" or \
+                            "%ds" % entry["eta"])
+        totals = state["totals"]
+        rate = 0
+        if totals["seconds"]:
+            rate = totals["bytes"] / totals["seconds"]
+        print "Total: %d coalesced, %d failed, %s in %ds (%s/s)" % \
+                (totals["coalesced"], totals["failed"],
+                Util.num2str(totals["bytes"]), totals["seconds"],
+                Util.num2str(rate))
     elif action == "disable":
         print "Disabling GC/coalesce for %s" % uuid
         _abort(uuid)
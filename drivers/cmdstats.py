@@ -0,0 +1,120 @@
+#!/usr/bin/python
+#
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# External command statistics: a per-host ring buffer of the commands run by
+# util.doexec (recorded while STAMPFILE exists), and a CLI to summarize them
+# per binary
+#
+
+import os
+import time
+
+import statsring
+
+STAMPFILE = "/etc/xensource/sm_cmd_stats"
+STATS_FILE = "/var/run/sm/cmdstats"
+NUM_RECORDS = 8192
+
+# start time, duration, exit code, pid, binary
+RECORD_FORMAT = "=dfii32s"
+RECORD_FIELDS = ["time", "duration", "rc", "pid", "binary"]
+
+# upper bounds (in seconds) of the duration histogram buckets, the last
+# bucket takes the rest
+BUCKETS = [0.01, 0.1, 1, 10, 60]
+
+_ring = statsring.StatsRing(STATS_FILE, "SMCS", RECORD_FORMAT, RECORD_FIELDS,
+        NUM_RECORDS)
+
+
+def record(binary, started, duration, rc):
+    """Append a run of binary to the ring buffer. Never raises: the
+    statistics are best-effort"""
+    _ring.record((started, duration, rc, os.getpid(), binary))
+
+def read():
+    """Return the runs in the ring buffer (as dicts), oldest first"""
+    return _ring.read()
+
+def clear():
+    """Empty the ring buffer"""
+    _ring.clear()
+
+def bucket(duration):
+    """The index of the histogram bucket of duration"""
+    for i in range(len(BUCKETS)):
+        if duration < BUCKETS[i]:
+            return i
+    return len(BUCKETS)
+
+def summarize(records):
+    """Per-binary statistics: duration percentiles, duration histogram (a
+    count per bucket of BUCKETS) and exit code histogram, sorted by total
+    duration (most time spent first)"""
+    binaries = dict()
+    for rec in records:
+        if not binaries.has_key(rec["binary"]):
+            binaries[rec["binary"]] = {"binary": rec["binary"],
+                    "durations": [], "histogram": [0] * (len(BUCKETS) + 1),
+                    "rcs": dict(), "failed": 0}
+        entry = binaries[rec["binary"]]
+        entry["durations"].append(rec["duration"])
+        entry["histogram"][bucket(rec["duration"])] += 1
+        entry["rcs"][rec["rc"]] = entry["rcs"].get(rec["rc"], 0) + 1
+        if rec["rc"]:
+            entry["failed"] += 1
+    result = []
+    for entry in binaries.values():
+        durations = sorted(entry.pop("durations"))
+        entry["count"] = len(durations)
+        entry["total"] = sum(durations)
+        for p in [50, 95, 99]:
+            entry["p%d" % p] = statsring.percentile(durations, p)
+        entry["max"] = durations[-1]
+        result.append(entry)
+    result.sort(key = lambda entry: entry["total"], reverse = True)
+    return result
+
+def _bucketName(i):
+    if i == len(BUCKETS):
+        return ">=%gs" % BUCKETS[-1]
+    return "<%gs" % BUCKETS[i]
+
+
+def report(records, top):
+    print "%d commands since %s" % (len(records),
+            time.ctime(records[0]["time"]))
+    print "%-20s %7s %7s %9s %8s %8s %8s %8s  %s" % ("binary", "count",
+            "failed", "total", "p50", "p95", "p99", "max", "exit codes")
+    for entry in summarize(records)[:top]:
+        rcs = entry["rcs"].items()
+        rcs.sort(key = lambda x: x[1], reverse = True)
+        print "%-20s %7d %7d %9.3f %8.3f %8.3f %8.3f %8.3f  %s" % \
+                (entry["binary"], entry["count"], entry["failed"],
+                        entry["total"], entry["p50"], entry["p95"],
+                        entry["p99"], entry["max"],
+                        ", ".join(["%d(%d)" % x for x in rcs[:4]]))
+        print "%-20s %s" % ("", " ".join(["%s:%d" % (_bucketName(i), n)
+                for i, n in enumerate(entry["histogram"])]))
+
+def main():
+    statsring.main(_ring, "Summarize the external commands run by SM "
+            "(recorded while %s\nexists)" % STAMPFILE,
+            "show the N binaries SM spent most time in", "command", report)
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,9 @@
 import os
 import util
 import errno
+import fcntl
+import select
+import time
 
 class IPCFlagException(util.SMException):
     pass
@@ -93,6 +96,101 @@ class IPCFlag:
         except OSError:
             raise IPCFlagException("failed to remove %s" % path)
 
+class IPCEvent:
+    """Event notification for processes, through a named pipe: a listener
+    sleeps in wait() until another process calls notify() (or the timeout
+    expires). Notifications sent while nobody listens are dropped. Every
+    notification carries a one-character code (e.g. to tell apart the
+    reasons for waking the listener up)."""
+
+    BASE_DIR = IPCFlag.BASE_DIR
+
+    def __init__(self, ns, name):
+        self.ns = ns
+        self.path = os.path.join(self.BASE_DIR, ns, name + ".fifo")
+        self.fd = None
+
+    def listen(self):
+        """Start receiving notifications"""
+        if self.fd is not None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise IPCFlagException("failed to create %s: %s" % \
+                        (os.path.dirname(self.path), e))
+        try:
+            os.mkfifo(self.path, 0600)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise IPCFlagException("failed to create %s: %s" % \
+                        (self.path, e))
+        # opening for writing too keeps the pipe from signalling EOF (and
+        # from blocking the open) while there are no writers
+        try:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        except OSError, e:
+            raise IPCFlagException("failed to open %s: %s" % (self.path, e))
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFD)
+        fcntl.fcntl(self.fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def wait(self, timeout):
+        """Wait for up to timeout seconds for notifications. Return the codes
+        of the notifications received (an empty string on timeout). Without
+        listen(), just sleep"""
+        if timeout < 0:
+            timeout = 0
+        if self.fd is None:
+            time.sleep(timeout)
+            return ""
+        while True:
+            try:
+                ready = select.select([self.fd], [], [], timeout)[0]
+                break
+            except select.error, e:
+                if e[0] != errno.EINTR:
+                    raise
+                # the timeout is not adjusted: a signal is no notification
+        if not ready:
+            return ""
+        codes = ""
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not data:
+                break
+            codes += data
+        return codes
+
+    def notify(self, code):
+        """Wake up the listener, if any. Return True if there is one"""
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError, e:
+            if e.errno in (errno.ENOENT, errno.ENXIO):
+                return False
+            raise IPCFlagException("failed to open %s: %s" % (self.path, e))
+        try:
+            try:
+                os.write(fd, code)
+            except OSError, e:
+                if e.errno != errno.EAGAIN: # pipe full: the listener is late
+                    raise IPCFlagException("failed to notify %s: %s" % \
+                            (self.path, e))
+        finally:
+            os.close(fd)
+        return True
+
 def _runTests():
     flag = IPCFlag("A")
     flag.set("X")
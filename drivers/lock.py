@@ -21,9 +21,13 @@ import os, stat, errno
 import time
 import flock
 import util
+import lockstats
 
 VERBOSE = True
 
+# record the wait and hold times of every acquisition (see lockstats)
+LOCK_STATS = os.path.exists(lockstats.STAMPFILE)
+
 class LockException(util.SMException):
     pass
 
@@ -63,6 +67,7 @@ class Lock:
 
         fd = self.lockfile.fileno()
         self.lock = flock.WriteLock(fd)
+        self.readLock = flock.ReadLock(fd)
 
     def _open_lockfile(self):
         """Provide a seam, so extreme situations could be tested"""
@@ -90,6 +95,7 @@ class Lock:
 
     def __init__(self, name, ns=None):
         self.lockfile = None
+        self.stats = None
 
         self.ns = Lock._mknamespace(ns)
 
@@ -165,32 +171,205 @@ class Lock:
         """Blocking lock aquisition, with warnings. We don't expect to lock a
         lot. If so, not to collide. Coarse log statements should be ok
         and aid debugging."""
-        if not self.lock.trylock():
-            util.SMlog("Failed to lock %s on first attempt, " % self.lockpath
-                   + "blocked by PID %d" % self.lock.test())
-            self.lock.lock()
+        self._lockBlocking()
         if VERBOSE:
             util.SMlog("lock: acquired %s" % self.lockpath)
 
+    def acquireShared(self):
+        """Blocking lock acquisition in shared mode: any number of processes
+        may hold the lock shared at once, excluding (and excluded by) an
+        exclusive holder. A process holding the lock shared must not take it
+        exclusively through another Lock object: fcntl locks are per process,
+        so that would convert (and, on release, drop) the shared lock."""
+        self._lockBlocking(True)
+        if VERBOSE:
+            util.SMlog("lock: acquired %s (shared)" % self.lockpath)
+
     def acquireNoblock(self):
         """Acquire lock if possible, or return false if lock already held"""
         exists = os.path.exists(self.lockpath)
-        ret = self.lock.trylock()
+        ret = self._trylock()
         if VERBOSE:
             util.SMlog("lock: tried lock %s, acquired: %s (exists: %s)" % \
                     (self.lockpath, ret, exists))
         return ret
 
     def held(self):
-        """True if @self acquired the lock, False otherwise."""
-        return self.lock.held()
+        """True if @self acquired the lock (in either mode), False
+        otherwise."""
+        return self.lock.held() or self.readLock.held()
 
     def release(self):
         """Release a previously acquired lock."""
-        self.lock.unlock()
+        self._unlock()
         if VERBOSE:
             util.SMlog("lock: released %s" % self.lockpath)
 
+    def _flock(self, shared):
+        if shared:
+            return self.readLock
+        return self.lock
+
+    def _trylock(self, shared = False):
+        if self.held() or not self._flock(shared).trylock():
+            return False
+        if LOCK_STATS:
+            self.stats = (time.time(), 0, 0)
+        return True
+
+    def _lockBlocking(self, shared = False):
+        assert not self.held(), flock.FcntlLockBase.ERROR_ISLOCKED
+        if self._trylock(shared):
+            return
+        start = time.time()
+        lock = self._flock(shared)
+        holder = lock.test()
+        util.SMlog("Failed to lock %s on first attempt, " % self.lockpath
+               + "blocked by PID %d" % holder)
+        lock.lock()
+        if LOCK_STATS:
+            now = time.time()
+            self.stats = (now, now - start, max(holder, 0))
+
+    def _unlock(self):
+        self._flock(self.readLock.held()).unlock()
+        if self.stats:
+            acquired, wait, holder = self.stats
+            self.stats = None
+            holderCommand = ""
+            if holder:
+                holderCommand = lockstats.getCommand(holder)
+            lockstats.record(self.ns, self.name, acquired, wait,
+                    time.time() - acquired, holder, holderCommand)
+
+class LockSet:
+    """A set of named locks in a namespace, acquired together. The locks are
+    always acquired in the same (sorted) order, so that two sets sharing some
+    of their locks cannot deadlock, and are released in the reverse order.
+    The Lock objects, and so their open lock files, of the MAX_CACHED most
+    recently used locks are kept, so that re-acquiring a lock does not need
+    to create and open its lock file again; the least recently used ones
+    are closed beyond that, so that a long-running process going through
+    many locks (like the GC) does not run out of file descriptors. A lock
+    file found to have been removed since is closed and reopened."""
+
+    # (ns, name) -> Lock
+    _locks = dict()
+    # keys of _locks, least recently used first
+    _lru = []
+
+    MAX_CACHED = 256
+
+    BACKOFF_MIN = 0.01 # seconds
+    BACKOFF_MAX = 1
+
+    def __init__(self, names, ns=None):
+        self.ns = ns
+        self.names = list(set(names))
+        self.names.sort()
+        self.held = []
+
+    def acquire(self, timeout=None):
+        """Acquire all the locks. Without a timeout, block until they are all
+        held and return True. With a timeout (in seconds), all-or-nothing: if
+        any of the locks is busy, release those already taken, back off and
+        start over, until the timeout expires. Return False (with none of the
+        locks held) if it does"""
+        assert not self.held
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        backoff = LockSet.BACKOFF_MIN
+        while True:
+            if self._acquireAll(deadline is None):
+                util.SMlog("lock: acquired %d locks in %s" % \
+                        (len(self.held), self.ns))
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                util.SMlog("lock: timed out acquiring %d locks in %s" % \
+                        (len(self.names), self.ns))
+                return False
+            time.sleep(min(backoff, remaining))
+            backoff = min(backoff * 2, LockSet.BACKOFF_MAX)
+
+    def release(self):
+        """Release the locks, in the reverse order of acquisition"""
+        self._releaseHeld()
+        util.SMlog("lock: released %d locks in %s" % (len(self.names),
+                self.ns))
+
+    def _acquireAll(self, block):
+        try:
+            for name in self.names:
+                lock = self._acquireOne(name, block)
+                if not lock:
+                    self._releaseHeld()
+                    return False
+                self.held.append(lock)
+        except:
+            self._releaseHeld()
+            raise
+        return True
+
+    def _acquireOne(self, name, block):
+        """Acquire the named lock and return it (None if it is busy and
+        block is False)"""
+        key = (self.ns, name)
+        while True:
+            lock = LockSet._locks.get(key)
+            if lock:
+                LockSet._lru.remove(key)
+                LockSet._lru.append(key)
+            else:
+                lock = Lock(name, self.ns)
+                LockSet._locks[key] = lock
+                LockSet._lru.append(key)
+                LockSet._evict()
+            if block:
+                lock._lockBlocking()
+            elif not lock._trylock():
+                return None
+            if LockSet._isCurrent(lock):
+                return lock
+            # the lock file was removed (see Lock.cleanup) while we had it
+            # open: locking it excludes nobody
+            lock.stats = None
+            lock._unlock()
+            LockSet._forget(key)
+
+    def _evict():
+        """Close the least recently used locks beyond MAX_CACHED (except
+        those held)"""
+        excess = len(LockSet._lru) - LockSet.MAX_CACHED
+        for key in LockSet._lru[:]:
+            if excess <= 0:
+                break
+            if not LockSet._locks[key].held():
+                LockSet._forget(key)
+                excess -= 1
+    _evict = staticmethod(_evict)
+
+    def _forget(key):
+        LockSet._lru.remove(key)
+        LockSet._locks.pop(key)._close()
+    _forget = staticmethod(_forget)
+
+    def _isCurrent(lock):
+        try:
+            st = os.stat(lock.lockpath)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        return os.fstat(lock.lockfile.fileno()).st_ino == st.st_ino
+    _isCurrent = staticmethod(_isCurrent)
+
+    def _releaseHeld(self):
+        while self.held:
+            self.held.pop()._unlock()
+
+
 if __debug__:
     import sys
 
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+#
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Lock contention statistics: a per-host ring buffer of lock acquisitions
+# (recorded by lock.Lock while STAMPFILE exists), and a CLI to summarize them
+#
+
+import os
+import sys
+import time
+
+import statsring
+
+STAMPFILE = "/etc/xensource/sm_lock_stats"
+STATS_FILE = "/var/run/sm/lockstats"
+NUM_RECORDS = 4096
+
+# time of acquisition, wait time, hold time, pid, pid of the holder we
+# waited for (0 if none), command, command of the holder, namespace, name
+RECORD_FORMAT = "=dffii16s16s48s48s"
+RECORD_FIELDS = ["time", "wait", "hold", "pid", "holder", "command",
+        "holderCommand", "ns", "name"]
+
+_ring = statsring.StatsRing(STATS_FILE, "SMLS", RECORD_FORMAT, RECORD_FIELDS,
+        NUM_RECORDS)
+_command = None
+
+
+def getCommand(pid):
+    """The command name of process pid ("" if unknown)"""
+    try:
+        f = open("/proc/%d/comm" % pid, 'r')
+        try:
+            return f.read().strip()
+        finally:
+            f.close()
+    except IOError:
+        return ""
+
+def record(ns, name, acquired, wait, hold, holder = 0, holderCommand = ""):
+    """Append an acquisition of lock ns/name to the ring buffer. Never
+    raises: the statistics are best-effort"""
+    _ring.record((acquired, wait, hold, os.getpid(), holder,
+            _getOwnCommand(), holderCommand, ns, name))
+
+def read():
+    """Return the acquisitions in the ring buffer (as dicts), oldest first"""
+    return _ring.read()
+
+def clear():
+    """Empty the ring buffer"""
+    _ring.clear()
+
+def summarize(records):
+    """Per-lock statistics, sorted by total wait time (most contended
+    first)"""
+    locks = dict()
+    for rec in records:
+        key = (rec["ns"], rec["name"])
+        if not locks.has_key(key):
+            locks[key] = {"ns": rec["ns"], "name": rec["name"], "waits": [],
+                    "holds": [], "contended": 0, "holders": dict()}
+        entry = locks[key]
+        entry["waits"].append(rec["wait"])
+        entry["holds"].append(rec["hold"])
+        if rec["holder"]:
+            entry["contended"] += 1
+            holder = rec["holderCommand"] or str(rec["holder"])
+            entry["holders"][holder] = entry["holders"].get(holder, 0) + 1
+    result = []
+    for entry in locks.values():
+        waits = sorted(entry.pop("waits"))
+        holds = sorted(entry.pop("holds"))
+        entry["count"] = len(waits)
+        entry["totalWait"] = sum(waits)
+        for p in [50, 95, 99]:
+            entry["wait%d" % p] = statsring.percentile(waits, p)
+            entry["hold%d" % p] = statsring.percentile(holds, p)
+        entry["maxWait"] = waits[-1]
+        result.append(entry)
+    result.sort(key = lambda entry: entry["totalWait"], reverse = True)
+    return result
+
+def _getOwnCommand():
+    global _command
+    if _command is None:
+        _command = os.path.basename(sys.argv[0] or "python")
+    return _command
+
+
+def report(records, top):
+    print "%d acquisitions since %s" % (len(records),
+            time.ctime(records[0]["time"]))
+    print "%-40s %-12s %7s %7s %8s %8s %8s %8s %8s  %s" % ("namespace", "name",
+            "count", "waited", "total", "p50", "p99", "max", "hold p99",
+            "top holders")
+    for entry in summarize(records)[:top]:
+        holders = entry["holders"].items()
+        holders.sort(key = lambda x: x[1], reverse = True)
+        print "%-40s %-12s %7d %7d %8.3f %8.3f %8.3f %8.3f %8.3f  %s" % \
+                (entry["ns"], entry["name"], entry["count"],
+                        entry["contended"], entry["totalWait"],
+                        entry["wait50"], entry["wait99"], entry["maxWait"],
+                        entry["hold99"],
+                        ", ".join(["%s(%d)" % x for x in holders[:3]]))
+
+def main():
+    statsring.main(_ring, "Summarize SM lock contention (recorded while %s "
+            "exists)" % STAMPFILE, "show the N most contended locks", "lock",
+            report)
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,7 @@ import time
 
 import util
 import vhdutil
+import vhdcache
 import xs_errors
 from lock import Lock
 from refcounter import RefCounter
@@ -118,8 +119,10 @@ def getLVInfo(lvmCache, lvName = None):
         lvs[uuid] = lv
     return lvs
 
-def getVDIInfo(lvmCache):
-    """Load VDI info (both LV and if the VDI is not raw, VHD info)"""
+def getVDIInfo(lvmCache, vhdCache = None):
+    """Load VDI info (both LV and if the VDI is not raw, VHD info). If
+    vhdCache (a vhdcache.VHDCache for the VG) is given, the VHD scan is skipped
+    when the cached VHD info is still valid for all VHD LVs"""
     vdis = {}
     lvs = getLVInfo(lvmCache)
 
@@ -127,20 +130,10 @@ def getVDIInfo(lvmCache):
     for uuid, lvInfo in lvs.iteritems():
         if lvInfo.vdiType == vhdutil.VDI_TYPE_VHD:
             haveVHDs = True
-        vdiInfo = VDIInfo(uuid)
-        vdiInfo.vdiType    = lvInfo.vdiType
-        vdiInfo.lvName     = lvInfo.name
-        vdiInfo.sizeLV     = lvInfo.size
-        vdiInfo.sizeVirt   = lvInfo.size
-        vdiInfo.lvActive   = lvInfo.active
-        vdiInfo.lvOpen     = lvInfo.open
-        vdiInfo.lvReadonly = lvInfo.readonly
-        vdiInfo.hidden     = lvInfo.hidden
-        vdis[uuid]         = vdiInfo
+        vdis[uuid] = _getVDIInfoLV(uuid, lvInfo)
 
     if haveVHDs:
-        pattern = "%s*" % LV_PREFIX[vhdutil.VDI_TYPE_VHD]
-        vhds = vhdutil.getAllVHDs(pattern, extractUuid, lvmCache.vgName)
+        vhds = _getAllVHDs(lvmCache, vdis, vhdCache)
         uuids = vdis.keys()
         for uuid in uuids:
             vdi = vdis[uuid]
@@ -162,6 +155,81 @@ def getVDIInfo(lvmCache):
                     vdis[uuid].hidden     = vhds[uuid].hidden
     return vdis
 
+def getVDIInfoSubset(lvmCache, uuids):
+    """Load VDI info like getVDIInfo, but only for the VDIs in uuids (that
+    still exist), reading the VHD metadata of each VHD LV individually. This
+    is cheaper than getVDIInfo when uuids is a small part of a large VG"""
+    vdis = {}
+    lvs = getLVInfo(lvmCache)
+    for uuid in uuids:
+        lvInfo = lvs.get(uuid)
+        if not lvInfo:
+            continue
+        vdiInfo = _getVDIInfoLV(uuid, lvInfo)
+        vdis[uuid] = vdiInfo
+        if lvInfo.vdiType != vhdutil.VDI_TYPE_VHD:
+            continue
+        try:
+            vhdInfo = vhdutil.getVHDInfoLVM(lvInfo.name, extractUuid,
+                    lvmCache.vgName)
+        except util.CommandException, e:
+            util.SMlog("*** vhd-scan failed for %s: %s" % (uuid, e))
+            vhdInfo = None
+        if not vhdInfo or vhdInfo.error:
+            util.SMlog("*** vhd-scan error: %s" % uuid)
+            vdiInfo.scanError = True
+        else:
+            vdiInfo.sizeVirt   = vhdInfo.sizeVirt
+            vdiInfo.parentUuid = vhdInfo.parentUuid
+            vdiInfo.hidden     = vhdInfo.hidden
+    return vdis
+
+def _getVDIInfoLV(uuid, lvInfo):
+    vdiInfo = VDIInfo(uuid)
+    vdiInfo.vdiType    = lvInfo.vdiType
+    vdiInfo.lvName     = lvInfo.name
+    vdiInfo.sizeLV     = lvInfo.size
+    vdiInfo.sizeVirt   = lvInfo.size
+    vdiInfo.lvActive   = lvInfo.active
+    vdiInfo.lvOpen     = lvInfo.open
+    vdiInfo.lvReadonly = lvInfo.readonly
+    vdiInfo.hidden     = lvInfo.hidden
+    return vdiInfo
+
+def _getAllVHDs(lvmCache, vdis, vhdCache):
+    pattern = "%s*" % LV_PREFIX[vhdutil.VDI_TYPE_VHD]
+    if not vhdCache:
+        return vhdutil.getAllVHDs(pattern, extractUuid, lvmCache.vgName)
+
+    # read the seqno before scanning so that any concurrent LVM change
+    # invalidates what we are about to cache
+    try:
+        seqno = lvmCache.getVGSeqno()
+    except Exception, e:
+        util.SMlog("Failed to get the seqno of %s (%s), not using the VHD "
+                "cache" % (lvmCache.vgName, e))
+        return vhdutil.getAllVHDs(pattern, extractUuid, lvmCache.vgName)
+
+    vhdCache.load()
+    stamps = {}
+    vhds = {}
+    for uuid, vdi in vdis.iteritems():
+        if vdi.vdiType == vhdutil.VDI_TYPE_VHD:
+            stamps[uuid] = vhdcache.lvStamp(vdi.sizeLV, seqno)
+            vhdInfo = vhdCache.get(vdi.lvName, stamps[uuid])
+            if vhdInfo:
+                vhds[uuid] = vhdInfo
+
+    if len(vhds) < len(stamps):
+        # the VG seqno is shared by all LVs so a miss usually means all
+        # entries are stale: a single scan beats per-LV queries
+        vhds = vhdutil.getAllVHDs(pattern, extractUuid, lvmCache.vgName)
+        for uuid, stamp in stamps.iteritems():
+            if vhds.get(uuid):
+                vhdCache.put(vdis[uuid].lvName, stamp, vhds[uuid])
+    vhdCache.save()
+    return vhds
+
 def inflate(journaler, srUuid, vdiUuid, size):
     """Expand a VDI LV (and its VHD) to 'size'. If the LV is already bigger
     than that, it's a no-op. Does not change the virtual size of the VDI"""
@@ -298,8 +366,26 @@ def lvRefreshOnSlaves(session, srUuid, vgName, lvName, vdiUuid, slaves):
             "lvName3": lvName}
     for slave in slaves:
         util.SMlog("Refreshing %s on slave %s" % (lvName, slave))
-        text = session.xenapi.host.call_plugin(slave, "on-slave", "multi", args)
-        util.SMlog("call-plugin returned: '%s'" % text)
+    multiOnSlaves(session, slaves, args)
+
+def multiOnSlaves(session, slaves, args):
+    """Run the on-slave "multi" plugin call with args on all slaves at once.
+    Return the texts it returned, in the order of slaves, or raise the error
+    of the first slave on which it failed"""
+    results = util.call_plugin_on_hosts(session, slaves, "on-slave", "multi",
+            args)
+    error = None
+    for slave in slaves:
+        text = results[slave]
+        if isinstance(text, Exception):
+            util.SMlog("call-plugin on %s failed: %s" % (slave, text))
+            if not error:
+                error = text
+        else:
+            util.SMlog("call-plugin on %s returned: '%s'" % (slave, text))
+    if error:
+        raise error
+    return map(lambda x: results[x], slaves)
 
 def lvRefreshOnAllSlaves(session, srUuid, vgName, lvName, vdiUuid):
     slaves = util.get_all_slaves(session)
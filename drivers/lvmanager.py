@@ -62,6 +62,23 @@ class LVActivator:
         self.lvActivations[persistent][binary][uuid] = lvName
         self.lvmCache.activate(self.ns, uuid, lvName, binary)
 
+    def activateMany(self, lvs, persistent = False):
+        """Activate the LVs given as (uuid, lvName, binary) tuples with a
+        single LVM command (see LVMCache.activateMany)"""
+        toActivate = []
+        for uuid, lvName, binary in lvs:
+            if self.lvActivations[persistent][binary].get(uuid):
+                if persistent:
+                    raise LVManagerException("Double persistent " \
+                            "activation: %s" % uuid)
+                continue
+            toActivate.append((uuid, lvName, binary))
+        if not toActivate:
+            return
+        self.lvmCache.activateMany(self.ns, toActivate)
+        for uuid, lvName, binary in toActivate:
+            self.lvActivations[persistent][binary][uuid] = lvName
+
     def activateEnforce(self, uuid, lvName, lvPath):
         """incrementing the refcount is not enough to keep an LV activated if
         another party is unaware of refcounting. For example, blktap does 
@@ -89,26 +106,38 @@ class LVActivator:
     def deactivateAll(self):
         # this is the cleanup step that will be performed even if the original 
         # operation failed - don't throw exceptions here
-        success = True
+        lvs = []
         for persistent in [self.TEMPORARY, self.PERSISTENT]:
             for binary in [self.NORMAL, self.BINARY]:
-                uuids = self.lvActivations[persistent][binary].keys()
-                for uuid in uuids:
-                    try:
-                        self.deactivate(uuid, binary, persistent)
-                    except:
-                        success = False
-                        util.logException("_deactivateAll")
-        return success
+                for uuid, lvName in \
+                        self.lvActivations[persistent][binary].items():
+                    self._closeFile(uuid, lvName)
+                    lvs.append((uuid, lvName, binary))
+        if not lvs:
+            return True
+        try:
+            failed = self.lvmCache.deactivateMany(self.ns, lvs)
+        except:
+            util.logException("_deactivateAll")
+            return False
+        for persistent in [self.TEMPORARY, self.PERSISTENT]:
+            for binary in [self.NORMAL, self.BINARY]:
+                for uuid in self.lvActivations[persistent][binary].keys():
+                    if uuid not in failed:
+                        del self.lvActivations[persistent][binary][uuid]
+        return not failed
 
     def deactivate(self, uuid, binary, persistent = False):
         lvName = self.lvActivations[persistent][binary][uuid]
+        self._closeFile(uuid, lvName)
+        self.lvmCache.deactivate(self.ns, uuid, lvName, binary)
+        del self.lvActivations[persistent][binary][uuid]
+
+    def _closeFile(self, uuid, lvName):
         if self.openFiles.get(uuid):
             self.openFiles[uuid].close()
             del self.openFiles[uuid]
             self.lvmCache.changeOpen(lvName, -1)
-        self.lvmCache.deactivate(self.ns, uuid, lvName, binary)
-        del self.lvActivations[persistent][binary][uuid]
 
     def persist(self):
         """Only commit LV chain activations when all LVs have been successfully
@@ -19,13 +19,22 @@
 #
 
 import os
+import errno
+import json
 import util
 import lvutil
 import lvhdutil
-from lock import Lock
+from lock import Lock, LockSet
 from refcounter import RefCounter
 
-class LVInfo:
+# directory of the LVMCache snapshots shared by all processes (see
+# LVMCache.refresh)
+SNAPSHOT_DIR = "/var/run/sm/lvmcache"
+
+class LVInfo(object):
+    # there is one of these per LV in the VG
+    __slots__ = ["name", "size", "active", "open", "readonly", "tags"]
+
     def __init__(self, name):
         self.name = name
         self.size = 0
@@ -57,26 +66,44 @@ def lazyInit(op):
 
 class LVMCache:
     """Per-VG object to store LV information. Can be queried for cached LVM
-    information and refreshed"""
+    information and refreshed.
+    The LV metadata (sizes, permissions and tags) is shared between processes
+    through a snapshot file, stamped with the VG metadata seqno it is valid
+    for (LVM increments the seqno on every metadata change)."""
 
     def __init__(self, vgName):
         """Create a cache for VG vgName, but don't scan the VG yet"""
         self.vgName = vgName
         self.vgPath = "/dev/%s" % self.vgName
         self.lvs = dict()
-        self.tags = dict()
+        self.tags = dict() # tag -> set of the names of the LVs with it
         self.initialized = False
+        self.seqno = None
+        self.snapshotPath = os.path.join(SNAPSHOT_DIR, vgName)
         util.SMlog("LVMCache created for %s" % vgName)
 
     def refresh(self):
-        """Get the LV information for the VG using "lvs" """
+        """Get the LV information for the VG: from the snapshot if the VG
+        metadata has not changed since it was taken (with the activation
+        state of the LVs from device-mapper), using "lvs" otherwise"""
         util.SMlog("LVMCache: refreshing")
-        #cmd = lvutil.cmd_lvm([lvutil.CMD_LVS, "--noheadings", "--units",
-        #                    "b", "-o", "+lv_tags", self.vgPath])
-        #text = util.pread2(cmd)
-
-        cmd = [lvutil.CMD_LVS, "--noheadings", "--units",
-                               "b", "-o", "+lv_tags", self.vgPath]
+        xenvm = (lvutil.get_sr_alloc(self.vgName) == 'xlvhd')
+        seqno = None
+        # without a snapshot to check, the seqno comes with the lvs output.
+        # No snapshot for xenvm, whose VG seqno would cost a query of its own
+        if not xenvm and os.path.exists(self.snapshotPath):
+            seqno = self._getSeqno()
+            if seqno is not None and self._loadSnapshot(seqno):
+                return
+        if xenvm:
+            # xenvm lvs is only known to support the default columns, with
+            # the sizes suffixed and the fields separated by whitespace
+            cmd = [lvutil.CMD_LVS, "--noheadings", "--units", "b", "-o",
+                    "+lv_tags", self.vgPath]
+        else:
+            cmd = [lvutil.CMD_LVS, "--noheadings", "--units", "b",
+                    "--nosuffix", "--separator", ":", "-o",
+                    "lv_name,lv_attr,lv_size,vg_seq_no,lv_tags", self.vgPath]
 
         stateFileAttach = os.getenv('THIN_STATE_FILE_ATTACH', None)
         if stateFileAttach == "true":
@@ -86,22 +113,37 @@ class LVMCache:
         self.lvs.clear()
         self.tags.clear()
         for line in text.split('\n'):
+            line = line.strip()
             if not line:
                 continue
-            fields = line.split()
-            lvName = fields[0]
+            if xenvm:
+                fields = line.split()
+                lvName, attr = fields[0], fields[2]
+                size = fields[3].replace("B", "")
+                tags = ""
+                if len(fields) >= 5:
+                    tags = fields[4]
+            else:
+                # tags may contain the separator, so they go last
+                lvName, attr, size, vgSeqno, tags = line.split(':', 4)
+                if self._snapshotsEnabled():
+                    seqno = int(vgSeqno)
             lvInfo = LVInfo(lvName)
-            lvInfo.size = long(fields[3].replace("B",""))
-            lvInfo.active = (fields[2][4] == 'a')
-            if (fields[2][5] == 'o'):
+            lvInfo.size = long(size)
+            lvInfo.active = (attr[4] == 'a')
+            if attr[5] == 'o':
                 lvInfo.open = 1
-            lvInfo.readonly = (fields[2][1] == 'r')
+            lvInfo.readonly = (attr[1] == 'r')
             self.lvs[lvName] = lvInfo
-            if len(fields) >= 5:
-                tags = fields[4].split(',')
-                for tag in tags:
+            if tags:
+                for tag in tags.split(','):
                     self._addTag(lvName, tag)
         self.initialized = True
+        # the seqno was read with the LVs, or before them, in which case a
+        # change made meanwhile would only make the snapshot look out of date
+        self.seqno = seqno
+        if not xenvm:
+            self._saveSnapshot()
 
     #
     # lvutil functions
@@ -115,14 +157,16 @@ class LVMCache:
         self.lvs[lvName] = lvInfo
         if tag:
             self._addTag(lvName, tag)
+        self._updateSnapshot()
 
     @lazyInit
     def remove(self, lvName):
         path = self._getPath(lvName)
         lvutil.remove(path)
-        for tag in self.lvs[lvName].tags:
+        for tag in self.lvs[lvName].tags[:]:
             self._removeTag(lvName, tag)
         del self.lvs[lvName]
+        self._updateSnapshot()
 
     @lazyInit
     def rename(self, lvName, newName):
@@ -132,6 +176,10 @@ class LVMCache:
         del self.lvs[lvName]
         lvInfo.name = newName
         self.lvs[newName] = lvInfo
+        for tag in lvInfo.tags:
+            self.tags[tag].remove(lvName)
+            self.tags[tag].add(newName)
+        self._updateSnapshot()
 
     @lazyInit
     def setSize(self, lvName, newSize):
@@ -139,6 +187,7 @@ class LVMCache:
         size = self.getSize(lvName)
         lvutil.setSize(path, newSize, (newSize < size))
         self.lvs[lvName].size = newSize
+        self._updateSnapshot()
 
     @lazyInit
     def activate(self, ns, ref, lvName, binary):
@@ -198,6 +247,85 @@ class LVMCache:
         finally:
             lock.release()
 
+    @lazyInit
+    def activateMany(self, ns, lvs):
+        """Activate the LVs given as (ref, lvName, binary) tuples the way
+        activate() does, but holding the locks of all the refs at once and
+        activating all the LVs whose refcount goes to 1 with a single
+        lvchange. If that fails, none of the refcounts is changed"""
+        locks = self._lockRefs(ns, lvs)
+        try:
+            refs = [(ref, binary) for ref, lvName, binary in lvs]
+            counts = RefCounter.getMany(refs, ns)
+            lvNames = []
+            for (ref, lvName, binary), count in zip(lvs, counts):
+                if count == 1:
+                    lvNames.append(lvName)
+            try:
+                lvutil.activateManyNoRefcount(map(self._getPath, lvNames))
+            except:
+                RefCounter.putMany(refs, ns)
+                raise
+            # the LVs are active now: the refcounts stand whatever happens
+            self._setActive(lvNames)
+        finally:
+            locks.release()
+
+    @lazyInit
+    def deactivateMany(self, ns, lvs):
+        """Deactivate the LVs given as (ref, lvName, binary) tuples the way
+        deactivate() does, but holding the locks of all the refs at once and
+        deactivating all the LVs whose refcount drops to 0 with a single
+        lvchange (falling back to one LV at a time if that fails). Errors are
+        logged rather than raised: return the refs that could not be
+        deactivated"""
+        locks = self._lockRefs(ns, lvs)
+        try:
+            failed = []
+            toDeactivate = []
+            counts = RefCounter.putMany(
+                    [(ref, binary) for ref, lvName, binary in lvs], ns)
+            for (ref, lvName, binary), count in zip(lvs, counts):
+                if count > 0:
+                    continue
+                if not self.lvs.get(lvName):
+                    util.SMlog("LV info not found for %s" % ref)
+                    failed.append(ref)
+                    continue
+                toDeactivate.append((ref, lvName, binary))
+
+            if [x for x in toDeactivate if self.lvs[x[1]].open]:
+                # check again in case the cached values are stale
+                self.refresh()
+            for ref, lvName, binary in toDeactivate[:]:
+                info = self.lvs.get(lvName)
+                if info and info.open:
+                    # see deactivate()
+                    util.SMlog("WARNING: deactivate: LV %s open" % lvName)
+                    toDeactivate.remove((ref, lvName, binary))
+
+            try:
+                self.deactivateManyNoRefcount([x[1] for x in toDeactivate])
+                return failed
+            except util.CommandException, e:
+                util.SMlog("LVMCache.deactivateMany: %s, retrying one LV " \
+                        "at a time" % e)
+            self.refresh()
+            for ref, lvName, binary in toDeactivate:
+                info = self.lvs.get(lvName)
+                if not info or not info.active:
+                    continue
+                try:
+                    self.deactivateNoRefcount(lvName)
+                except util.CommandException:
+                    util.logException("LVMCache.deactivateMany")
+                    util.SMlog("Reverting the refcount change of %s" % ref)
+                    RefCounter.get(ref, binary, ns)
+                    failed.append(ref)
+            return failed
+        finally:
+            locks.release()
+
     @lazyInit
     def activateNoRefcount(self, lvName, refresh = False):
         path = self._getPath(lvName)
@@ -214,15 +342,47 @@ class LVMCache:
             util.SMlog("LVMCache.deactivateNoRefcount: no LV %s" % lvName)
             lvutil._lvmBugCleanup(path)
 
+    @lazyInit
+    def activateManyNoRefcount(self, lvNames):
+        lvutil.activateManyNoRefcount(map(self._getPath, lvNames))
+        self._setActive(lvNames)
+
+    def _setActive(self, lvNames):
+        """Mark the LVs just activated as active in the cache, reloading it
+        if any of them is missing (the cache is stale then)"""
+        for lvName in lvNames:
+            if not self.lvs.has_key(lvName):
+                util.SMlog("LVMCache: activated LV %s not cached" % lvName)
+                self.refresh()
+                return
+            self.lvs[lvName].active = True
+
+    @lazyInit
+    def deactivateManyNoRefcount(self, lvNames):
+        present = []
+        for lvName in lvNames:
+            if self.checkLV(lvName):
+                present.append(lvName)
+            else:
+                util.SMlog("LVMCache.deactivateManyNoRefcount: no LV %s" % \
+                        lvName)
+                lvutil._lvmBugCleanup(self._getPath(lvName))
+        lvutil.deactivateManyNoRefcount(map(self._getPath, present))
+        for lvName in present:
+            self.lvs[lvName].active = False
+
     @lazyInit
     def setHidden(self, lvName, hidden=True):
         path = self._getPath(lvName)
+        changed = (self.getHidden(lvName) != hidden)
         if hidden:
             lvutil.setHidden(path)
             self._addTag(lvName, lvutil.LV_TAG_HIDDEN)
         else:
             lvutil.setHidden(path, hidden=False)
             self._removeTag(lvName, lvutil.LV_TAG_HIDDEN)
+        # setting the tag an LV already has may not change the VG metadata
+        self._updateSnapshot(changed)
 
     @lazyInit
     def setReadonly(self, lvName, readonly):
@@ -235,6 +395,7 @@ class LVMCache:
             lvutil.setReadonly(path, readonly)
             lock.release()
             self.lvs[lvName].readonly = readonly
+            self._updateSnapshot()
 
     @lazyInit
     def changeOpen(self, lvName, inc):
@@ -269,6 +430,10 @@ class LVMCache:
             result[lvName] = lvutilInfo
         return result
 
+    def getVGSeqno(self):
+        """Not cached: always queries LVM"""
+        return lvutil.getVGSeqno(self.vgName)
+
     @lazyInit
     def getSize(self, lvName):
         return self.lvs[lvName].size
@@ -279,10 +444,10 @@ class LVMCache:
 
     @lazyInit
     def getTagged(self, tag):
-        lvList = self.tags.get(tag)
-        if not lvList:
+        lvNames = self.tags.get(tag)
+        if not lvNames:
             return []
-        return lvList
+        return list(lvNames)
 
     #
     # private
@@ -290,12 +455,132 @@ class LVMCache:
     def _getPath(self, lvName):
         return os.path.join(self.vgPath, lvName)
 
+    def _getDMName(self, lvName):
+        return "%s-%s" % (self.vgName.replace("-", "--"),
+                lvName.replace("-", "--"))
+
+    def _snapshotsEnabled(self):
+        return os.getenv('THIN_STATE_FILE_ATTACH', None) != "true"
+
+    def _getSeqno(self):
+        """The current VG seqno, or None if it cannot be used to validate
+        the snapshot"""
+        if not self._snapshotsEnabled():
+            return None
+        try:
+            return lvutil.getVGSeqno(self.vgName)
+        except Exception, e:
+            util.SMlog("LVMCache: failed to get the seqno of %s: %s" % \
+                    (self.vgName, e))
+            return None
+
+    def _getDMOpenCounts(self):
+        """The open counts of the device-mapper devices, by name"""
+        text = util.pread2([lvutil.CMD_DMSETUP, "info", "-c", "--noheadings",
+                "-o", "name,open", "--separator", ":"])
+        counts = dict()
+        for line in text.split("\n"):
+            fields = line.strip().split(":")
+            if len(fields) == 2 and fields[1].isdigit():
+                counts[fields[0]] = int(fields[1])
+        return counts
+
+    def _loadSnapshot(self, seqno):
+        """Load the LV information from the snapshot if it is valid for
+        seqno"""
+        try:
+            f = open(self.snapshotPath, 'r')
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+            if data["seqno"] != seqno:
+                return False
+            openCounts = self._getDMOpenCounts()
+            lvs = data["lvs"]
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                util.SMlog("LVMCache: failed to read %s: %s" % \
+                        (self.snapshotPath, e))
+            return False
+        except (ValueError, KeyError, TypeError), e:
+            util.SMlog("LVMCache: discarding corrupt %s: %s" % \
+                    (self.snapshotPath, e))
+            return False
+        except util.CommandException, e:
+            util.SMlog("LVMCache: failed to get the device-mapper state: " \
+                    "%s" % e)
+            return False
+
+        self.lvs.clear()
+        self.tags.clear()
+        for lvName, (size, readonly, tags) in lvs.iteritems():
+            lvName = str(lvName)
+            lvInfo = LVInfo(lvName)
+            lvInfo.size = long(size)
+            lvInfo.readonly = readonly
+            dmName = self._getDMName(lvName)
+            lvInfo.active = dmName in openCounts
+            if openCounts.get(dmName):
+                lvInfo.open = 1
+            self.lvs[lvName] = lvInfo
+            for tag in tags:
+                self._addTag(lvName, str(tag))
+        self.seqno = seqno
+        self.initialized = True
+        util.SMlog("LVMCache: loaded %d LVs from the snapshot at seqno %d" % \
+                (len(self.lvs), seqno))
+        return True
+
+    def _saveSnapshot(self):
+        if self.seqno is None:
+            return
+        lvs = dict()
+        for lvName, lvInfo in self.lvs.iteritems():
+            lvs[lvName] = [lvInfo.size, lvInfo.readonly, lvInfo.tags]
+        tmpPath = "%s.%d" % (self.snapshotPath, os.getpid())
+        try:
+            if not os.path.isdir(SNAPSHOT_DIR):
+                os.makedirs(SNAPSHOT_DIR)
+            f = open(tmpPath, 'w')
+            try:
+                json.dump({"seqno": self.seqno, "lvs": lvs}, f)
+            finally:
+                f.close()
+            os.rename(tmpPath, self.snapshotPath)
+        except (IOError, OSError), e:
+            util.SMlog("LVMCache: failed to save %s: %s" % \
+                    (self.snapshotPath, e))
+
+    def _updateSnapshot(self, changed = True):
+        """Write a metadata change just made by this process through to the
+        snapshot, as the state of the VG at the next seqno, without querying
+        LVM. If another process changed the VG meanwhile, the VG is past that
+        seqno already, so the snapshot is never found valid (and the next
+        refresh runs "lvs"). If the change may not have been committed (not
+        changed), the seqno is unknown: the snapshot is left as it is, valid
+        for the state before the change or not at all"""
+        if self.seqno is None:
+            return
+        if not changed:
+            self.seqno = None
+            return
+        self.seqno += 1
+        self._saveSnapshot()
+
+    def _lockRefs(self, ns, lvs):
+        """Acquire the locks of the refs of lvs (see lock.LockSet)"""
+        locks = LockSet([lv[0] for lv in lvs], ns)
+        locks.acquire()
+        return locks
+
     def _addTag(self, lvName, tag):
         self.lvs[lvName].tags.append(tag)
-        if self.tags.get(tag):
-            self.tags[tag].append(lvName)
+        lvNames = self.tags.get(tag)
+        if lvNames is None:
+            self.tags[tag] = set([lvName])
         else:
-            self.tags[tag] = [lvName]
+            lvNames.add(lvName)
 
     def _removeTag(self, lvName, tag):
         self.lvs[lvName].tags.remove(tag)
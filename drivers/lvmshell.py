@@ -0,0 +1,325 @@
+#!/usr/bin/python
+#
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Persistent lvm shell (for running LVM commands without starting, and
+# initializing, a new lvm process for every command)
+#
+
+import os
+import errno
+import fcntl
+import json
+import select
+import signal
+import threading
+import time
+
+import util
+
+PROMPT = "lvm> "
+REPORT_FD = 3
+
+START_TIMEOUT = 30 # seconds
+COMMAND_TIMEOUT = 10 * 60
+
+# status codes of LVM commands (as in the log report), see lvm2's errors.h
+ECMD_PROCESSED = 1
+
+# retry delays after a shell failed to start (doubled after each failure)
+START_BACKOFF_MIN = 1 # seconds
+START_BACKOFF_MAX = 5 * 60
+
+class LVMShellError(util.SMException):
+    """The shell cannot run a command. The command was not run, so the caller
+    can run it some other way"""
+    pass
+
+class LVMShellUnsupported(LVMShellError):
+    """The LVM at hand has no usable shell: it exited instead of prompting
+    for commands, or does not report their status"""
+    pass
+
+class _ShellExited(util.SMException):
+    pass
+
+
+class LVMShell:
+    """An lvm process in shell mode, fed commands on its stdin. The output of
+    a command is what the shell writes to stdout up to the next prompt, and
+    its status comes from the log report of the "lastlog" command, which the
+    shell writes to the report pipe (LVM_REPORT_FD). start() checks that the
+    LVM at hand provides all this, so that a shell that cannot tell the status
+    of a command is never used.
+    A shell may only be used by the process that started it. Not thread-safe
+    (see run() for the thread-safe entry point)."""
+
+    def __init__(self, lvmPath, env):
+        self.lvmPath = lvmPath
+        self.env = env
+        self.pid = None
+        self.owner = None
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+        self.report = None
+        self.reportData = ""
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the shell and probe it with a command. Raise
+        LVMShellUnsupported if the shell cannot be used at all, and
+        LVMShellError on other failures"""
+        fds = []
+        try:
+            for i in range(4):
+                fds.extend(os.pipe())
+        except OSError, e:
+            self._closeAll(fds)
+            raise LVMShellError("failed to create pipes: %s" % e)
+        inR, inW, outR, outW, errR, errW, repR, repW = fds
+        try:
+            pid = os.fork()
+        except OSError, e:
+            self._closeAll(fds)
+            raise LVMShellError("failed to fork: %s" % e)
+        if not pid:
+            try:
+                os.dup2(inR, 0)
+                os.dup2(outW, 1)
+                os.dup2(errW, 2)
+                os.dup2(repW, REPORT_FD)
+                os.closerange(REPORT_FD + 1, os.sysconf("SC_OPEN_MAX"))
+                env = dict(self.env)
+                env["LVM_REPORT_FD"] = str(REPORT_FD)
+                env["LC_ALL"] = "C"
+                os.execve(self.lvmPath, [self.lvmPath], env)
+            finally:
+                os._exit(127)
+
+        self._closeAll([inR, outW, errW, repW])
+        self.pid = pid
+        self.owner = os.getpid()
+        self.stdin = inW
+        self.stdout = outR
+        self.stderr = errR
+        self.report = repR
+        for fd in [inW, outR, errR, repR]:
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        for fd in [outR, errR, repR]:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        try:
+            self._read(START_TIMEOUT)
+            self._write("version\n")
+            self._read(START_TIMEOUT)
+            self._write("lastlog --reportformat json\n")
+            self._read(START_TIMEOUT)
+            status = self._getStatus()
+        except _ShellExited, e:
+            self.stop()
+            raise LVMShellUnsupported("failed to start the lvm shell: %s" % e)
+        except (OSError, util.SMException), e:
+            self.stop()
+            raise LVMShellError("failed to start the lvm shell: %s" % e)
+        if status is None:
+            self.stop()
+            raise LVMShellUnsupported("the lvm shell reports no status")
+        if status != ECMD_PROCESSED:
+            self.stop()
+            raise LVMShellError("the lvm shell probe failed (%d)" % status)
+        util.SMlog("LVMShell: started %s (pid %d)" % (self.lvmPath, pid))
+
+    def stop(self):
+        if self.pid is None:
+            return
+        self._closeAll([self.stdin, self.stdout, self.stderr, self.report])
+        self.stdin = self.stdout = self.stderr = self.report = None
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        self.pid = None
+
+    def isRunning(self):
+        return self.pid is not None and self.owner == os.getpid()
+
+    def execute(self, args, timeout = COMMAND_TIMEOUT):
+        """Run the LVM command args (a list, starting with the command name)
+        and return its stdout. Raise util.CommandException if it fails, and
+        LVMShellError if it could not be run"""
+        for arg in args:
+            if not arg or [c for c in arg if c.isspace() or c in "\"'\\#"]:
+                raise LVMShellError("argument not passable: %r" % arg)
+        try:
+            self._write(" ".join(args) + "\n")
+        except OSError, e:
+            self.stop()
+            raise LVMShellError("failed to send the command: %s" % e)
+        try:
+            stdout, stderr = self._read(timeout)
+            self._write("lastlog --reportformat json\n")
+            self._read(timeout)
+            status = self._getStatus()
+            if status is None:
+                raise util.SMException("no command status")
+        except (OSError, util.SMException), e:
+            # the command may or may not have been run
+            self.stop()
+            raise util.CommandException(errno.EIO, str(args),
+                    "lvm shell failure: %s" % e)
+        if status != ECMD_PROCESSED:
+            if not stderr.strip():
+                stderr = stdout
+            raise util.CommandException(status, str(args), stderr.strip())
+        return stdout
+
+    def _write(self, data):
+        while data:
+            n = os.write(self.stdin, data)
+            data = data[n:]
+
+    def _read(self, timeout):
+        """Read the output of the shell up to the next prompt. Return
+        (stdout, stderr)"""
+        stdout = ""
+        stderr = ""
+        deadline = time.time() + timeout
+        self.reportData = ""
+        while not stdout.endswith(PROMPT):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise util.SMException("lvm shell timed out")
+            try:
+                ready = select.select([self.stdout, self.stderr, self.report],
+                        [], [], remaining)[0]
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if fd == self.stdout:
+                    if not data:
+                        raise _ShellExited("lvm shell exited")
+                    stdout += data
+                elif fd == self.stderr:
+                    stderr += data
+                else:
+                    self.reportData += data
+        # the shell is done writing to the other pipes before it prompts
+        stderr += self._drain(self.stderr)
+        self.reportData += self._drain(self.report)
+        return stdout[:-len(PROMPT)], stderr
+
+    def _drain(self, fd):
+        data = ""
+        while True:
+            try:
+                chunk = os.read(fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return data
+                raise
+            if not chunk:
+                return data
+            data += chunk
+
+    def _getStatus(self):
+        """The status of the last command, from the lastlog report just read
+        by _read() (None if the report has none)"""
+        try:
+            report = json.loads(self.reportData)
+        except ValueError:
+            return None
+        status = None
+        for entry in report.get("log", []):
+            if entry.get("log_type") == "status" and \
+                    entry.get("log_context") == "shell":
+                status = int(entry["log_ret_code"])
+        return status
+
+    def _closeAll(self, fds):
+        for fd in fds:
+            if fd is None:
+                continue
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+_shells = dict()
+_shellsLock = threading.Lock()
+_unavailable = False
+# key -> (number of consecutive start failures, time of the next attempt)
+_startFailures = dict()
+
+def run(vgName, lvmPath, args):
+    """Run the LVM command args (a list, starting with the command name) on
+    VG vgName in the shell of the VG, started on first use (and restarted
+    after failures). Return its stdout, and raise util.CommandException if it
+    fails, like util.pread2. Raise LVMShellError if the shell cannot be used,
+    in which case the command was not run. A shell that failed to start is
+    only tried again after a backoff, and never again in this process if the
+    shell turned out to be unsupported"""
+    global _unavailable
+    if _unavailable:
+        raise LVMShellError("lvm shell unavailable")
+    key = (vgName, os.environ.get("LVM_SYSTEM_DIR"))
+    _shellsLock.acquire()
+    try:
+        shell = _shells.get(key)
+        if not shell or not shell.isRunning():
+            failures, nextAttempt = _startFailures.get(key, (0, 0))
+            if time.time() < nextAttempt:
+                raise LVMShellError("lvm shell failed to start, retrying " \
+                        "in %d seconds" % (nextAttempt - time.time()))
+            # a shell inherited from the parent process is left alone
+            shell = LVMShell(lvmPath, dict(os.environ))
+            try:
+                shell.start()
+            except LVMShellUnsupported:
+                _unavailable = True
+                raise
+            except LVMShellError:
+                delay = min(START_BACKOFF_MIN * 2 ** failures,
+                        START_BACKOFF_MAX)
+                _startFailures[key] = (failures + 1, time.time() + delay)
+                raise
+            _startFailures.pop(key, None)
+            _shells[key] = shell
+    finally:
+        _shellsLock.release()
+
+    shell.lock.acquire()
+    try:
+        util.SMlog(args)
+        started = time.time()
+        try:
+            stdout = shell.execute(args)
+        except util.CommandException, e:
+            util.recordCommand(args[0], started, e.code)
+            raise
+        util.recordCommand(args[0], started, 0)
+        util.SMlog("  lvm shell SUCCESS")
+        return stdout
+    finally:
+        shell.lock.release()
@@ -31,6 +31,7 @@ import xml.dom.minidom
 from lvhdutil import VG_LOCATION,VG_PREFIX
 from EXTSR import EXT_PREFIX
 import lvmcache
+import lvmshell
 import srmetadata
 import vhdutil
 from scsiutil import getSCSIid
@@ -61,6 +62,9 @@ LVM_SIZE_INCREMENT = 4 * 1024 * 1024
 LV_TAG_HIDDEN = "hidden"
 LVM_FAIL_RETRIES = 10
 
+# run LVM commands in a persistent lvm shell where possible (see lvmshell)
+USE_LVM_SHELL = True
+
 MASTER_LVM_CONF = '/etc/lvm/master'
 DEF_LVM_CONF = '/etc/lvm'
 
@@ -76,6 +80,13 @@ LV_COMMANDS = frozenset({CMD_LVS, CMD_LVDISPLAY, CMD_LVCREATE, CMD_LVREMOVE,
 
 LVM_COMMANDS = VG_COMMANDS.union(PV_COMMANDS, LV_COMMANDS)
 
+# per-process caches of cmd_lvm (see invalidate_sr_alloc)
+_sr_alloc_cache = dict() # VG name or SCSI id -> SR allocation type
+_sr_alloc_stamp = None # stamp of config_dir _sr_alloc_cache is valid for
+_scsi_id_cache = dict() # (device path, device number) -> SCSI id
+_vgname_cache = dict() # lvm argument -> VG name (or None)
+VGNAME_CACHE_SIZE = 1024
+
 def get_sr_alloc(filename):
     """Return the SR allocation type
 
@@ -108,6 +119,79 @@ def get_sr_alloc(filename):
     return sr_alloc
 
 
+def invalidate_sr_alloc(name=None):
+    """Forget the cached allocation type of 'name' (a VG name or SCSI id),
+    or everything cmd_lvm caches if 'name' is None
+
+        To be called whenever the allocation type of an SR may have
+        changed, i.e. when its file in <config_dir> is created or removed.
+    """
+
+    if name is None:
+        _sr_alloc_cache.clear()
+        _scsi_id_cache.clear()
+    else:
+        _sr_alloc_cache.pop(name, None)
+
+
+def _config_dir_stamp():
+    try:
+        st = os.stat(config_dir)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime)
+
+
+def _lookup_sr_alloc(filename):
+    """Cached get_sr_alloc
+
+        Besides the explicit invalidate_sr_alloc() calls, the cache is
+        dropped whenever <config_dir> changes, which catches SR upgrades
+        done by other processes.
+    """
+
+    global _sr_alloc_stamp
+    stamp = _config_dir_stamp()
+    if stamp != _sr_alloc_stamp:
+        _sr_alloc_cache.clear()
+        _sr_alloc_stamp = stamp
+    sr_alloc = _sr_alloc_cache.get(filename)
+    if sr_alloc is None:
+        sr_alloc = get_sr_alloc(filename)
+        _sr_alloc_cache[filename] = sr_alloc
+    return sr_alloc
+
+
+def _lookup_scsi_id(path):
+    """Cached getSCSIid, keyed by device path and number. Return None if
+    'path' does not exist"""
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_rdev)
+    scsi_id = _scsi_id_cache.get(key)
+    if scsi_id is None:
+        scsi_id = getSCSIid(path)
+        _scsi_id_cache[key] = scsi_id
+    return scsi_id
+
+
+def _lookup_vgname(arg):
+    """Cached extract_vgname"""
+
+    try:
+        return _vgname_cache[arg]
+    except KeyError:
+        pass
+    vgname = extract_vgname(arg)
+    if len(_vgname_cache) >= VGNAME_CACHE_SIZE:
+        _vgname_cache.clear()
+    _vgname_cache[arg] = vgname
+    return vgname
+
+
 def extract_vgname(str_in):
     """Search for and return a VG name
 
@@ -192,15 +276,17 @@ def cmd_lvm(cmd, sr_alloc=None, pread_func=util.pread2, *args):
             util.SMlog("CMD_LVM: Not all lvm arguments are of type 'str'")
             return None
 
+    vgname = None
     if sr_alloc is None:
         if lvm_cmd not in PV_COMMANDS:
             for arg in lvm_args:
                 try:
-                    filename = extract_vgname(arg)
+                    filename = _lookup_vgname(arg)
                 except:
                     util.logException('CMD_LVM')
                     return None
                 if filename:
+                    vgname = filename
                     break
             else: # if for loop doesn't break
                 util.SMlog("CMD_LVM: Could not find VG "
@@ -209,12 +295,12 @@ def cmd_lvm(cmd, sr_alloc=None, pread_func=util.pread2, *args):
                 return None
         else:
             for arg in lvm_args:
-                if os.path.exists(arg):
-                    try:
-                        filename = getSCSIid(arg)
-                    except:
-                        util.logException('CMD_LVM')
-                        return None
+                try:
+                    filename = _lookup_scsi_id(arg)
+                except:
+                    util.logException('CMD_LVM')
+                    return None
+                if filename:
                     break
             else: # if for loop doesn't break
                 util.SMlog("CMD_LVM: Could not find PV "
@@ -222,11 +308,18 @@ def cmd_lvm(cmd, sr_alloc=None, pread_func=util.pread2, *args):
                 util.SMlog([lvm_cmd] + lvm_args)
                 return None
 
-        sr_alloc = get_sr_alloc(filename)
+        sr_alloc = _lookup_sr_alloc(filename)
 
     if sr_alloc == 'xlvhd':
         stdout = pread_func(['/bin/xenvm', lvm_cmd] + lvm_args, *args)
     elif sr_alloc == 'thick':
+        if USE_LVM_SHELL and vgname and pread_func is util.pread2 and \
+                not args:
+            try:
+                return lvmshell.run(vgname, os.path.join(LVM_BIN, "lvm"),
+                        cmd)
+            except lvmshell.LVMShellError, e:
+                util.SMlog("CMD_LVM: %s, running %s directly" % (e, lvm_cmd))
         stdout = pread_func([os.path.join(LVM_BIN, lvm_cmd)] + lvm_args, *args)
     else:
         util.SMlog("CMD_LVM: ERROR: 'sr_alloc' neither 'xlvhd' nor 'thick'")
@@ -269,6 +362,7 @@ def setvginfo(uuid,vg,devices,uri, local_allocator=None):
     if local_allocator is not None:
       cmd = cmd + [ "--local-allocator-path", local_allocator ]
     util.pread2(cmd)    
+    invalidate_sr_alloc(vg)
 
 config_dir = "/var/run/nonpersistent/xenvm.d/"
 
@@ -391,6 +485,12 @@ def _getLVsize(path):
         raise xs_errors.XenError('VDIUnavailable', \
               opterr='no such VDI %s' % path)
 
+def getVGSeqno(vgname):
+    """Return the VG metadata sequence number, which LVM increments on every
+    metadata change in the VG"""
+    text = cmd_lvm([CMD_VGS, "--noheadings", "-o", "vg_seq_no", vgname])
+    return int(text.strip())
+
 def _getVGstats(vgname):
     try:
         #cmd = cmd_lvm([CMD_VGS, "--noheadings", "--nosuffix",
@@ -672,6 +772,8 @@ def createVG(root, vgname, sr_alloc='thick'):
 
     # End block
 
+    invalidate_sr_alloc()
+
 def removeVG(root, vgname):
     # Check PVs match VG
     try:
@@ -699,6 +801,8 @@ def removeVG(root, vgname):
         raise xs_errors.XenError('LVMDelete', \
               opterr='errno is %d' % inst.code)
 
+    invalidate_sr_alloc()
+
 def resizePV(dev):
     try:
         #cmd = cmd_lvm([CMD_PVRESIZE, dev])
@@ -863,6 +967,37 @@ def activateNoRefcount(path, refresh):
         # Restore slave mode lvm.conf
         os.environ['LVM_SYSTEM_DIR'] = DEF_LVM_CONF
 
+def activateManyNoRefcount(paths):
+    """Activate the LVs at paths (which must all be in the same VG) with a
+    single lvchange"""
+    if not paths:
+        return
+    cmd = [CMD_LVCHANGE, "-ay"] + paths
+    stateFileAttach = os.getenv('THIN_STATE_FILE_ATTACH', None)
+    if stateFileAttach == "true":
+        cmd.append("--offline")
+    text = cmd_lvm(cmd)
+    inactive = [path for path in paths if not _checkActive(path)]
+    if inactive:
+        raise util.CommandException(-1, str(cmd),
+                "LVs not activated: %s" % " ".join(inactive))
+
+def deactivateManyNoRefcount(paths):
+    """Deactivate the LVs at paths (which must all be in the same VG) with a
+    single lvchange, with the same workarounds as deactivateNoRefcount()"""
+    if not paths:
+        return
+    for i in range(LVM_FAIL_RETRIES):
+        try:
+            cmd_lvm([CMD_LVCHANGE, "-an"] + paths)
+            break
+        except util.CommandException:
+            if i >= LVM_FAIL_RETRIES - 1:
+                raise
+            util.SMlog("*** lvchange -an failed on attempt #%d" % i)
+    for path in paths:
+        _lvmBugCleanup(path)
+
 def deactivateNoRefcount(path):
     # LVM has a bug where if an "lvs" command happens to run at the same time 
     # as "lvchange -an", it might hold the device in use and cause "lvchange 
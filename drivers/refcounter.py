@@ -26,6 +26,8 @@
 
 import os
 import util
+import flock
+import threading
 from lock import Lock
 import errno
 
@@ -33,10 +35,21 @@ class RefCounterException(util.SMException):
     pass
 
 class RefCounter:
-    """Persistent local-FS file-based reference counter. The
-    operations are get() and put(), and they are atomic."""
+    """Persistent local-FS reference counter. The operations are get() and
+    put(), and they are atomic.
+    All the counts of a namespace are kept in a single table file, which is
+    only modified under an fcntl lock (taken on a separate lock file) and is
+    replaced atomically, so readers never need to lock. Counts left behind
+    by older versions (one file per object, in a directory per namespace)
+    are migrated to the table on first use of the namespace."""
 
     BASE_DIR = "/var/run/sm/refcount"
+    TABLE_EXT = ".db"
+    LOCK_EXT = ".lock"
+
+    # serializes the transactions of the threads of this process (the fcntl
+    # lock only serializes processes)
+    _threadLock = threading.Lock()
 
     def get(obj, binary, ns = None):
         """Get (inc ref count) 'obj' in namespace 'ns' (optional). 
@@ -57,6 +70,18 @@ class RefCounter:
             return RefCounter._adjust(ns, obj, -1, 0)
     put = staticmethod(put)
 
+    def getMany(objs, ns):
+        """get() each (obj, binary) pair of the list 'objs' in namespace
+        'ns', in a single transaction. Returns the new ref counts, in order"""
+        return RefCounter._adjustMany(ns, RefCounter._getDeltas(objs, 1))
+    getMany = staticmethod(getMany)
+
+    def putMany(objs, ns):
+        """put() each (obj, binary) pair of the list 'objs' in namespace
+        'ns', in a single transaction. Returns the new ref counts, in order"""
+        return RefCounter._adjustMany(ns, RefCounter._getDeltas(objs, -1))
+    putMany = staticmethod(putMany)
+
     def set(obj, count, binaryCount, ns = None):
         """Set normal & binary counts explicitly to the specified values.
         Returns new ref count"""
@@ -100,62 +125,95 @@ class RefCounter:
             if not util.pathexists(RefCounter.BASE_DIR):
                 return
             try:
-                nsList = os.listdir(RefCounter.BASE_DIR)
+                names = os.listdir(RefCounter.BASE_DIR)
             except OSError:
                 raise RefCounterException("failed to get namespace list")
+            nsList = []
+            for name in names:
+                if name.endswith(RefCounter.TABLE_EXT):
+                    nsList.append(name[:-len(RefCounter.TABLE_EXT)])
+                elif os.path.isdir(os.path.join(RefCounter.BASE_DIR, name)):
+                    nsList.append(name)
         for ns in nsList:
             RefCounter._reset(ns, obj)
     resetAll = staticmethod(resetAll)
 
+    def _getDeltas(objs, sign):
+        deltas = []
+        for obj, binary in objs:
+            if binary:
+                deltas.append((obj, 0, sign))
+            else:
+                deltas.append((obj, sign, 0))
+        return deltas
+    _getDeltas = staticmethod(_getDeltas)
+
     def _adjust(ns, obj, delta, binaryDelta):
         """Add 'delta' to the normal refcount and 'binaryDelta' to the binary
         refcount of 'obj' in namespace 'ns'. 
         Returns new ref count"""
-        if binaryDelta > 1 or binaryDelta < -1:
-            raise RefCounterException("Binary delta = %d outside [-1;1]" % \
-                    binaryDelta)
         (obj, ns) = RefCounter._getSafeNames(obj, ns)
-        (count, binaryCount) = RefCounter._get(ns, obj)
-
-        newCount = count + delta
-        newBinaryCount = binaryCount + binaryDelta
-        if newCount < 0:
-            util.SMlog("WARNING: decrementing normal refcount of 0")
-            newCount = 0
-        if newBinaryCount < 0:
-            util.SMlog("WARNING: decrementing binary refcount of 0")
-            newBinaryCount = 0
-        if newBinaryCount > 1:
-            newBinaryCount = 1
-        util.SMlog("Refcount for %s:%s (%d, %d) + (%d, %d) => (%d, %d)" % \
-                (ns, obj, count, binaryCount, delta, binaryDelta,
-                    newCount, newBinaryCount))
-        RefCounter._set(ns, obj, newCount, newBinaryCount)
-        return newCount + newBinaryCount
+        return RefCounter._adjustMany(ns, [(obj, delta, binaryDelta)])[0]
     _adjust = staticmethod(_adjust)
 
+    def _adjustMany(ns, deltas):
+        """Apply the (obj, delta, binaryDelta) changes of the list 'deltas'
+        to the refcounts in namespace 'ns' (see _adjust), in a single
+        transaction. Returns the new ref counts, in order"""
+        for obj, delta, binaryDelta in deltas:
+            if binaryDelta > 1 or binaryDelta < -1:
+                raise RefCounterException("Binary delta = %d outside " \
+                        "[-1;1]" % binaryDelta)
+
+        def adjust(table):
+            results = []
+            for obj, delta, binaryDelta in deltas:
+                obj = RefCounter._getSafeNames(obj, ns)[0]
+                (count, binaryCount) = table.get(obj, (0, 0))
+                newCount = count + delta
+                newBinaryCount = binaryCount + binaryDelta
+                if newCount < 0:
+                    util.SMlog("WARNING: decrementing normal refcount of 0")
+                    newCount = 0
+                if newBinaryCount < 0:
+                    util.SMlog("WARNING: decrementing binary refcount of 0")
+                    newBinaryCount = 0
+                if newBinaryCount > 1:
+                    newBinaryCount = 1
+                util.SMlog("Refcount for %s:%s (%d, %d) + (%d, %d) => " \
+                        "(%d, %d)" % (ns, obj, count, binaryCount, delta,
+                            binaryDelta, newCount, newBinaryCount))
+                RefCounter._setEntry(table, obj, newCount, newBinaryCount)
+                results.append(newCount + newBinaryCount)
+            return results
+
+        return RefCounter._update(ns, adjust)
+    _adjustMany = staticmethod(_adjustMany)
+
     def _get(ns, obj):
         """Get the ref count values for 'obj' in namespace 'ns'"""
-        objFile = os.path.join(RefCounter.BASE_DIR, ns, obj)
-        (count, binaryCount) = (0, 0)
-        if util.pathexists(objFile):
-            (count, binaryCount) = RefCounter._readCount(objFile)
-        return (count, binaryCount)
+        if os.path.isdir(os.path.join(RefCounter.BASE_DIR, ns)):
+            # not migrated yet
+            table = RefCounter._update(ns, dict)
+        else:
+            table = RefCounter._readTable(RefCounter._getTablePath(ns))
+        return table.get(obj, (0, 0))
     _get = staticmethod(_get)
 
     def _set(ns, obj, count, binaryCount):
         """Set the ref count values for 'obj' in namespace 'ns'"""
         util.SMlog("Refcount for %s:%s set => (%d, %db)" % \
                 (ns, obj, count, binaryCount))
+        RefCounter._update(ns, lambda table: \
+                RefCounter._setEntry(table, obj, count, binaryCount))
+    _set = staticmethod(_set)
+
+    def _setEntry(table, obj, count, binaryCount):
         if count == 0 and binaryCount == 0:
-            RefCounter._removeObject(ns, obj)
+            table.pop(obj, None)
         else:
-            objFile = os.path.join(RefCounter.BASE_DIR, ns, obj)
-
-            while not RefCounter._writeCount(objFile, count, binaryCount):
-                RefCounter._createNamespace(ns)
-
-    _set = staticmethod(_set)
+            table[obj] = (count, binaryCount)
+    _setEntry = staticmethod(_setEntry)
 
     def _getSafeNames(obj, ns):
         """Get a name that can be used as a file name"""
@@ -168,54 +226,142 @@ class RefCounter:
         return (obj, ns)
     _getSafeNames = staticmethod(_getSafeNames)
 
-    def _createNamespace(ns):
-        nsDir = os.path.join(RefCounter.BASE_DIR, ns)
-        try:
-            os.makedirs(nsDir)
-        except OSError, e:
-            if e.errno != errno.EEXIST:
-                raise RefCounterException("failed to makedirs '%s' (%s)" % \
-                        (nsDir, e))
-    _createNamespace = staticmethod(_createNamespace)
+    def _getTablePath(ns):
+        return os.path.join(RefCounter.BASE_DIR, ns + RefCounter.TABLE_EXT)
+    _getTablePath = staticmethod(_getTablePath)
 
-    def _removeObject(ns, obj):
-        nsDir = os.path.join(RefCounter.BASE_DIR, ns)
-        objFile = os.path.join(nsDir, obj)
-        if not util.pathexists(objFile):
-            return
+    def _update(ns, func):
+        """Run 'func' on the table of namespace 'ns' (a dict mapping objects
+        to (count, binaryCount)) under the namespace lock, and write the
+        table back. Returns what 'func' returns"""
+        lockPath = os.path.join(RefCounter.BASE_DIR, ns + RefCounter.LOCK_EXT)
+        RefCounter._threadLock.acquire()
         try:
-            os.unlink(objFile)
-        except OSError:
-            raise RefCounterException("failed to remove '%s'" % objFile)
+            try:
+                lockFile = open(lockPath, 'a')
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise RefCounterException("failed to open '%s': %s" % \
+                            (lockPath, e))
+                RefCounter._createBaseDir()
+                lockFile = open(lockPath, 'a')
+            try:
+                fileLock = flock.WriteLock(lockFile.fileno())
+                fileLock.lock()
+                try:
+                    path = RefCounter._getTablePath(ns)
+                    table = RefCounter._readTable(path)
+                    legacyFiles = RefCounter._readLegacy(ns, table)
+                    result = func(table)
+                    RefCounter._writeTable(path, table)
+                    if legacyFiles:
+                        RefCounter._removeLegacy(ns, legacyFiles)
+                    return result
+                finally:
+                    fileLock.unlock()
+            finally:
+                lockFile.close()
+        finally:
+            RefCounter._threadLock.release()
+    _update = staticmethod(_update)
 
+    def _createBaseDir():
         try:
-            os.rmdir(nsDir)
+            os.makedirs(RefCounter.BASE_DIR)
         except OSError, e:
-            namespaceAlreadyCleanedUp = e.errno == errno.ENOENT
-            newObjectAddedToNamespace = e.errno == errno.ENOTEMPTY
-
-            if namespaceAlreadyCleanedUp or newObjectAddedToNamespace:
-                pass
-            else:
-                raise RefCounterException("failed to remove '%s'" % nsDir)
-    _removeObject = staticmethod(_removeObject)
+            if e.errno != errno.EEXIST:
+                raise RefCounterException("failed to makedirs '%s' (%s)" % \
+                        (RefCounter.BASE_DIR, e))
+    _createBaseDir = staticmethod(_createBaseDir)
 
     def _reset(ns, obj = None):
-        nsDir = os.path.join(RefCounter.BASE_DIR, ns)
-        if not util.pathexists(nsDir):
+        if not util.pathexists(RefCounter._getTablePath(ns)) and \
+                not os.path.isdir(os.path.join(RefCounter.BASE_DIR, ns)):
             return
         if obj:
-            if not util.pathexists(os.path.join(nsDir, obj)):
-                return
-            objList = [obj]
+            RefCounter._update(ns, lambda table: table.pop(obj, None))
         else:
+            RefCounter._update(ns, lambda table: table.clear())
+    _reset = staticmethod(_reset)
+
+    def _readTable(path):
+        table = dict()
+        try:
+            f = open(path, 'r')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return table
+            raise RefCounterException("failed to read file '%s'" % path)
+        try:
             try:
-                objList = os.listdir(nsDir)
-            except OSError:
-                raise RefCounterException("failed to list '%s'" % ns)
+                for line in f:
+                    obj, count, binaryCount = line.rstrip("\n").rsplit(" ", 2)
+                    table[obj] = (int(count), int(binaryCount))
+            except IOError:
+                raise RefCounterException("failed to read file '%s'" % path)
+            except ValueError:
+                raise RefCounterException("corrupt file '%s'" % path)
+        finally:
+            f.close()
+        return table
+    _readTable = staticmethod(_readTable)
+
+    def _writeTable(path, table):
+        if not table:
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise RefCounterException("failed to remove '%s'" % path)
+            return
+        lines = []
+        for obj, (count, binaryCount) in table.iteritems():
+            lines.append("%s %d %d\n" % (obj, count, binaryCount))
+        tmpPath = "%s.%d" % (path, os.getpid())
+        try:
+            f = open(tmpPath, 'w')
+            try:
+                f.write("".join(lines))
+            finally:
+                f.close()
+            os.rename(tmpPath, path)
+        except (IOError, OSError), e:
+            raise RefCounterException("failed to write '%s': %s" % (path, e))
+    _writeTable = staticmethod(_writeTable)
+
+    def _readLegacy(ns, table):
+        """Merge the per-object count files of namespace 'ns' left by older
+        versions into 'table'. Returns the files merged"""
+        nsDir = os.path.join(RefCounter.BASE_DIR, ns)
+        if not os.path.isdir(nsDir):
+            return []
+        try:
+            objList = os.listdir(nsDir)
+        except OSError:
+            raise RefCounterException("failed to list '%s'" % ns)
         for obj in objList:
-            RefCounter._removeObject(ns, obj)
-    _reset = staticmethod(_reset)
+            (count, binaryCount) = RefCounter._readCount(
+                    os.path.join(nsDir, obj))
+            RefCounter._setEntry(table, obj, count, binaryCount)
+        util.SMlog("Refcount: migrating %d objects of %s" % \
+                (len(objList), ns))
+        return objList
+    _readLegacy = staticmethod(_readLegacy)
+
+    def _removeLegacy(ns, objList):
+        nsDir = os.path.join(RefCounter.BASE_DIR, ns)
+        for obj in objList:
+            objFile = os.path.join(nsDir, obj)
+            try:
+                os.unlink(objFile)
+            except OSError:
+                raise RefCounterException("failed to remove '%s'" % objFile)
+        try:
+            os.rmdir(nsDir)
+        except OSError, e:
+            if e.errno not in [errno.ENOENT, errno.ENOTEMPTY]:
+                raise RefCounterException("failed to remove '%s'" % nsDir)
+    _removeLegacy = staticmethod(_removeLegacy)
 
     def _readCount(fn):
         try:
@@ -230,20 +376,6 @@ class RefCounter:
         return (count, binaryCount)
     _readCount = staticmethod(_readCount)
 
-    def _writeCount(fn, count, binaryCount):
-        try:
-            f = open(fn, 'w')
-            f.write("%d %d\n" % (count, binaryCount))
-            f.close()
-            return True
-        except IOError, e:
-            fileNotFound = e.errno == errno.ENOENT
-            if fileNotFound:
-                return False
-            raise RefCounterException("failed to write '(%d %d)' to '%s': %s" \
-                    % (count, binaryCount, fn, e))
-    _writeCount = staticmethod(_writeCount)
-
 
     def _runTests():
         "Unit tests"
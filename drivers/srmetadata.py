@@ -20,7 +20,10 @@
 import util
 import metadata
 import os
+import re
 import sys
+import errno
+import bisect
 sys.path.insert(0,'/opt/xensource/sm/snapwatchd')
 import xs_errors
 import lvutil
@@ -73,6 +76,10 @@ METADATA_OBJECT_TYPE_SR = 'sr'
 METADATA_OBJECT_TYPE_VDI = 'vdi'
 METADATA_BLK_SIZE = 512
 
+# an element of a VDI record (a flat list of elements, see getVdiInfo)
+VDI_FIELD_RE = re.compile(r"<(\w+)>([^<]*)</\1>")
+XML_ENTITIES = {"&quot;": '"', "&apos;": "'"}
+
 # ----------------- # General helper functions - begin # -----------------
 def get_min_blk_size_wrapper(fd):
     return METADATA_BLK_SIZE
@@ -196,6 +203,25 @@ def getMetadataLength(fd):
                    "Error: %s" % str(e))
         raise
     
+def parseVdiRecord(record):
+    """Parse a VDI record (the XML of its sectors) into a dict of tag ->
+    value, as metadata._parseXML does, but with a regular expression rather
+    than a DOM. A record without the flat layout written by getVdiInfo is
+    handed to metadata._parseXML"""
+    record = record.replace('\x00','')
+    fields = VDI_FIELD_RE.findall(record)
+    if record.lstrip().startswith("<%s>" % VDI_TAG) and \
+            record.rstrip().endswith(VDI_CLOSING_TAG) and \
+            record.count("</") == len(fields) + 1:
+        vdi_info = {}
+        for tag, value in fields:
+            vdi_info[tag] = \
+                    xml.sax.saxutils.unescape(value, XML_ENTITIES).strip()
+        return vdi_info
+    parsable_metadata = '%s<%s>%s</%s>' % (XML_HEADER, metadata.XML_TAG,
+                                           record, metadata.XML_TAG)
+    return metadata._parseXML(parsable_metadata)[VDI_TAG]
+
 def requiresUpgrade(path):
     # if the metadata requires upgrade either by pre-Boston logic
     # or Boston logic upgrade it
@@ -249,6 +275,16 @@ class MetadataHandler:
         self.path = path
         if self.path != None:
             self.fd = open_file(self.path, write)
+        # index of the VDI records (see _loadIndex), kept up to date by the
+        # writes of this handler, which must be the only writer in its life
+        self.mdlength = None
+        self.vdiOffsets = None
+        self.freeOffsets = None
+        # the sectors written but not flushed yet, by offset (see startBatch),
+        # and the metadata length in the header on disk (None if unknown)
+        self.batch = False
+        self.dirtySectors = {}
+        self.diskLength = None
     
     def __del__(self):
         if self.fd != -1:
@@ -360,32 +396,153 @@ class MetadataHandler:
         util.SMlog("Checking if there is space in the metadata for %d VDI." % \
                    count)
         try:
-            self.spaceAvailableForVdis(count)
+            if self.batch:
+                self.checkSpaceForVdis(count)
+            else:
+                self.spaceAvailableForVdis(count)
         except Exception, e:
             raise xs_errors.XenError('MetadataError', \
                 opterr='%s' % str(e))
         
+    # Start a batch of updates: the updates of the handler are only written
+    # by flush(), which writes every sector they changed once
+    def startBatch(self):
+        self.batch = True
+
+    # Write the sectors changed since the last flush, coalescing contiguous
+    # ones, then the metadata length in the header if it changed. The sectors
+    # are synced before the header is written, so that a crash never leaves
+    # the header covering VDI records which are not on disk yet
+    def flush(self):
+        try:
+            self._flush()
+        except Exception, e:
+            util.SMlog('Error writing the metadata updates. Error: %s' % \
+                    str(e))
+            raise xs_errors.XenError('MetadataError', \
+                opterr='%s' % str(e))
+
+    def _flush(self):
+        try:
+            try:
+                self._writeDirtySectors()
+            except:
+                # what is on disk is unknown now, start afresh
+                self.mdlength = None
+                self.diskLength = None
+                self.vdiOffsets = None
+                raise
+        finally:
+            self.dirtySectors = {}
+            self.batch = False
+
+    def _writeDirtySectors(self):
+        runs = []
+        for offset in sorted(self.dirtySectors.keys()):
+            if runs and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1][1] += SECTOR_SIZE
+            else:
+                runs.append([offset, SECTOR_SIZE])
+
+        written = False
+        for (start, length) in runs:
+            ondisk = file_read_wrapper(self.fd, start, length, SECTOR_SIZE)
+            # only write the sectors that actually changed
+            offset = start
+            while offset < start + length:
+                data = ''
+                while offset < start + length and \
+                        self.dirtySectors[offset] != \
+                        ondisk[offset - start:offset - start + SECTOR_SIZE]:
+                    data += self.dirtySectors[offset]
+                    offset += SECTOR_SIZE
+                if not data:
+                    offset += SECTOR_SIZE
+                    continue
+                file_write_wrapper(self.fd, offset - len(data), SECTOR_SIZE, \
+                        data, len(data))
+                written = True
+                if offset == len(data):
+                    # the header was overwritten
+                    self.diskLength = None
+        if written:
+            os.fsync(self.fd)
+
+        if self.mdlength != None and self.mdlength != self.diskLength:
+            updateLengthInHeader(self.fd, self.mdlength)
+            os.fsync(self.fd)
+            self.diskLength = self.mdlength
+
+    # Check that the metadata volume has room for count more VDI records,
+    # without writing a dummy one like spaceAvailableForVdis does, which a
+    # batch would not write anyway
+    def checkSpaceForVdis(self, count):
+        self._loadIndex()
+        newRecords = max(0, count - len(self.freeOffsets))
+        required = self.mdlength + \
+                newRecords * SECTOR_SIZE * self.VDI_INFO_SIZE_IN_SECTORS
+        size = os.lseek(self.fd, 0, os.SEEK_END)
+        if required > size:
+            raise IOError(errno.ENOSPC, "No space in the metadata for %d " \
+                    "VDIs (%d bytes needed, %d available)" % \
+                    (count, required, size))
+
+    # Queue data for writing at offset (a multiple of SECTOR_SIZE), to be
+    # written by _commit, or flush() in a batch
+    def _write(self, offset, data):
+        for i in range(0, len(data), SECTOR_SIZE):
+            self.dirtySectors[offset + i] = getSector(data[i:i + SECTOR_SIZE])
+
+    # Read length bytes at offset, as they will be once the queued writes
+    # are written
+    def _read(self, offset, length):
+        data = file_read_wrapper(self.fd, offset, length, \
+                get_min_blk_size_wrapper(self.fd))
+        if not self.dirtySectors:
+            return data
+        data = data.ljust(length, '\x00')
+        for i in range(offset - offset % SECTOR_SIZE, offset + length, \
+                SECTOR_SIZE):
+            if self.dirtySectors.has_key(i):
+                lower = max(i, offset)
+                upper = min(i + SECTOR_SIZE, offset + length)
+                data = data[:lower - offset] + \
+                        self.dirtySectors[i][lower - i:upper - i] + \
+                        data[upper - offset:]
+        return data
+
+    # The metadata length, as it will be once the queued writes are written
+    def _getLength(self):
+        if self.mdlength == None:
+            self.diskLength = getMetadataLength(self.fd)
+            self.mdlength = self.diskLength
+        return self.mdlength
+
+    # Write what the last update queued, unless in a batch
+    def _commit(self):
+        if not self.batch:
+            self._flush()
+
     # common functions
     def deleteVdi(self, vdi_uuid, offset = 0):
         util.SMlog("Entering deleteVdi")
         try:
-            md = self.getMetadataInternal({'vdi_uuid': vdi_uuid})
-            if not md.has_key('offset'):
+            self._loadIndex()
+            if not self.vdiOffsets.has_key(vdi_uuid):
                 util.SMlog("Metadata for VDI %s not present, or already removed, " \
                     "no further deletion action required." % vdi_uuid)
                 return
             
-            md['vdi_info'][md['offset']][VDI_DELETED_TAG] = '1'
-            self.updateVdi(md['vdi_info'][md['offset']])
+            offset = self.vdiOffsets[vdi_uuid]
+            self._writeVdiAt(offset, {VDI_DELETED_TAG: '1'})
+            del self.vdiOffsets[vdi_uuid]
             
-            try:
-                mdlength = getMetadataLength(self.fd)
-                if (mdlength - md['offset']) == \
-                    self.VDI_INFO_SIZE_IN_SECTORS * SECTOR_SIZE:
-                    updateLengthInHeader(self.fd, (mdlength - \
-                                    self.VDI_INFO_SIZE_IN_SECTORS * SECTOR_SIZE))
-            except:
-                raise
+            if (self.mdlength - offset) == \
+                self.VDI_INFO_SIZE_IN_SECTORS * SECTOR_SIZE:
+                self.mdlength = offset
+            else:
+                bisect.insort(self.freeOffsets, offset)
+            self._commit()
         except Exception, e:
             raise Exception("VDI delete operation failed for "\
                                 "parameters: %s, %s. Error: %s" % \
@@ -398,7 +555,7 @@ class MetadataHandler:
         if not len(vdi_info.keys()) or not vdi_info.has_key(offset):
             return self.getVdiInfo(update_map)
             
-        for vdi_offset in vdi_info.keys():
+        for vdi_offset in sorted(vdi_info.keys()):
             if vdi_offset < lower:
                 continue
                     
@@ -420,38 +577,100 @@ class MetadataHandler:
     def addVdiInternal(self, Dict):
         util.SMlog("Entering addVdiInternal")
         try:
-            value = ''
             Dict[VDI_DELETED_TAG] = '0'
-            min_block_size = get_min_blk_size_wrapper(self.fd)
-            mdlength = getMetadataLength(self.fd)
-            md = self.getMetadataInternal({'firstDeleted': 1, 'includeDeletedVdis': 1})
-            if not md.has_key('foundDeleted'):
-                md['offset'] = mdlength
-                (md['lower'], md['upper']) = \
-                    getBlockAlignedRange(min_block_size, mdlength, \
-                                        SECTOR_SIZE * self.VDI_INFO_SIZE_IN_SECTORS)
-            # If this has created a new VDI, update metadata length 
-            if md.has_key('foundDeleted'):
-                value = self.getMetadataToWrite(md['sr_info'], md['vdi_info'], \
-                        md['lower'], md['upper'], Dict, md['offset'])
+            self._loadIndex()
+            # reuse the first deleted VDI record, if any
+            if self.freeOffsets:
+                offset = self.freeOffsets[0]
+                length = self.mdlength
             else:
-                value = self.getMetadataToWrite(md['sr_info'], md['vdi_info'], \
-                        md['lower'], md['upper'], Dict, mdlength)
-            
-            file_write_wrapper(self.fd, md['lower'], min_block_size, \
-                                  value, len(value))
+                offset = self.mdlength
+                length = self.mdlength + \
+                        SECTOR_SIZE * self.VDI_INFO_SIZE_IN_SECTORS
+            self._writeVdiAt(offset, Dict)
             
-            if md.has_key('foundDeleted'):
-                updateLengthInHeader(self.fd, mdlength)
-            else:
-                updateLengthInHeader(self.fd, mdlength + \
-                        SECTOR_SIZE * self.VDI_INFO_SIZE_IN_SECTORS)
+            # If this has created a new VDI, update metadata length 
+            if self.freeOffsets and self.freeOffsets[0] == offset:
+                del self.freeOffsets[0]
+            self.mdlength = length
+            self.vdiOffsets[Dict[UUID_TAG]] = offset
+            self._commit()
             return True
         except Exception, e:
             util.SMlog("Exception adding vdi with info: %s. Error: %s" % \
                        (Dict, str(e)))
             raise
 
+    # Index the VDI records of the metadata, by uuid for the VDIs (in
+    # self.vdiOffsets) and in order of offset for the deleted records, which
+    # can be reused (in self.freeOffsets), from a single read of the volume.
+    # The handler keeps the index up to date as it writes, so that each
+    # update, deletion or addition only needs to read and write the sectors
+    # of the VDI record at hand
+    def _loadIndex(self):
+        if self.vdiOffsets != None:
+            return
+        md = self.getMetadataInternal({'includeDeletedVdis': 1})
+        vdiOffsets = {}
+        freeOffsets = []
+        for offset in sorted(md['vdi_info'].keys()):
+            vdi_info = md['vdi_info'][offset]
+            if vdi_info[VDI_DELETED_TAG] == '1':
+                freeOffsets.append(offset)
+            else:
+                vdiOffsets[vdi_info[UUID_TAG]] = offset
+        self.mdlength = md['length']
+        self.vdiOffsets = vdiOffsets
+        self.freeOffsets = freeOffsets
+
+    # Read and parse what is needed to regenerate the block aligned range
+    # lower - upper: the SR info if the range covers it, and the VDI records
+    # in the range. Return (sr_info, vdi_info by offset)
+    def _readRange(self, lower, upper):
+        length = self._getLength()
+        recordSize = SECTOR_SIZE * self.VDI_INFO_SIZE_IN_SECTORS
+        srInfoSize = SECTOR_SIZE * SR_INFO_SIZE_IN_SECTORS
+        sr_info = {}
+        vdi_info = {}
+        start = lower
+        if lower < srInfoSize:
+            start = 0
+        end = min(upper, length)
+        data = ''
+        if end > start:
+            data = self._read(start, end - start)
+        if lower < srInfoSize:
+            sr_info = self._parseSRInfo(data)
+        # the first record starting in the range
+        offset = srInfoSize
+        if lower > srInfoSize:
+            offset += (lower - srInfoSize + recordSize - 1) / recordSize * \
+                    recordSize
+        while offset + recordSize <= end:
+            record = data[offset - start:offset - start + recordSize]
+            vdi_info[offset] = parseVdiRecord(record)
+            offset += recordSize
+        return (sr_info, vdi_info)
+
+    # Queue the VDI record at offset for writing, updated with update_map (or
+    # made of update_map alone, if there is no record at offset yet), along
+    # with whatever else shares its blocks
+    def _writeVdiAt(self, offset, update_map):
+        min_block_size = get_min_blk_size_wrapper(self.fd)
+        (lower, upper) = getBlockAlignedRange(min_block_size, offset, \
+                SECTOR_SIZE * self.VDI_INFO_SIZE_IN_SECTORS)
+        (sr_info, vdi_info) = self._readRange(lower, upper)
+        value = self.getMetadataToWrite(sr_info, vdi_info, lower, upper, \
+                update_map, offset)
+        self._write(lower, value)
+
+    def _parseSRInfo(self, metadataxml):
+        sr_info = metadataxml[SECTOR_SIZE + len(XML_HEADER): \
+                SECTOR_SIZE * SR_INFO_SIZE_IN_SECTORS]
+        sr_info = sr_info.replace('\x00','')
+        parsable_metadata = '%s<%s>%s</%s>' % (XML_HEADER, metadata.XML_TAG, 
+                                               sr_info, metadata.XML_TAG)
+        return metadata._parseXML(parsable_metadata)
         
     # Get metadata from the file name passed in
     # additional params:
@@ -465,26 +684,21 @@ class MetadataHandler:
     # vdi_info: dictionary containing vdi information indexed by offset
     # offset: when passing in vdi_uuid/firstDeleted below
     # deleted - true if deleted VDI found to be replaced
+    # length: the length of the metadata
     def getMetadataInternal(self, params = {}):
         try:
             lower = 0; upper = 0
             retmap = {}; sr_info_map = {}; ret_vdi_info = {}
-            length = getMetadataLength(self.fd)
+            length = self._getLength()
             min_blk_size = get_min_blk_size_wrapper(self.fd)
            
             # Read in the metadata fil
             metadataxml = ''
-            metadataxml = file_read_wrapper(self.fd, 0, length, min_blk_size)
+            metadataxml = self._read(0, length)
            
             # At this point we have the complete metadata in metadataxml
-            offset = SECTOR_SIZE + len(XML_HEADER)
-            sr_info = metadataxml[offset: SECTOR_SIZE * 4]
-            offset = SECTOR_SIZE * 4
-            sr_info = sr_info.replace('\x00','')
-           
-            parsable_metadata = '%s<%s>%s</%s>' % (XML_HEADER, metadata.XML_TAG, 
-                                                   sr_info, metadata.XML_TAG)
-            retmap['sr_info'] = metadata._parseXML(parsable_metadata)
+            retmap['sr_info'] = self._parseSRInfo(metadataxml)
+            offset = SECTOR_SIZE * SR_INFO_SIZE_IN_SECTORS
             
             # At this point we check if an offset has been passed in
             if params.has_key('offset'):
@@ -498,10 +712,7 @@ class MetadataHandler:
                 vdi_info = metadataxml[offset: 
                                 offset + 
                                 (SECTOR_SIZE * self.VDI_INFO_SIZE_IN_SECTORS)]
-                vdi_info = vdi_info.replace('\x00','')
-                parsable_metadata = '%s<%s>%s</%s>' % (XML_HEADER, metadata.XML_TAG, 
-                                               vdi_info, metadata.XML_TAG)
-                vdi_info_map = metadata._parseXML(parsable_metadata)[VDI_TAG]
+                vdi_info_map = parseVdiRecord(vdi_info)
                 vdi_info_map[OFFSET_TAG] = offset
                 
                 if not params.has_key('includeDeletedVdis') and \
@@ -534,6 +745,7 @@ class MetadataHandler:
             retmap['lower'] = lower
             retmap['upper'] = upper
             retmap['vdi_info'] = ret_vdi_info
+            retmap['length'] = length
             return retmap
         except Exception, e:
             util.SMlog("Exception getting metadata with params" \
@@ -553,11 +765,7 @@ class MetadataHandler:
             offset = SECTOR_SIZE * 2       
             (lower, upper) = getBlockAlignedRange(get_min_blk_size_wrapper( \
                 self.fd), offset, SECTOR_SIZE * 2)
-            md = self.getMetadataInternal({'offset': \
-                                SECTOR_SIZE * (SR_INFO_SIZE_IN_SECTORS - 1)})
-            
-            sr_info = md['sr_info']
-            vdi_info_by_offset = md['vdi_info']
+            (sr_info, vdi_info_by_offset) = self._readRange(lower, upper)
            
             # update SR info with Dict
             for key in Dict.keys():
@@ -580,8 +788,8 @@ class MetadataHandler:
                 # generate the remaining VDI
                 value += self.generateVDIsForRange(vdi_info_by_offset, lower, upper)
             
-            file_write_wrapper(self.fd, lower, \
-                get_min_blk_size_wrapper(self.fd), value, len(value))
+            self._write(lower, value)
+            self._commit()
         else:
             raise Exception("SR Update operation not supported for "
                             "parameters: %s" % diff)
@@ -589,13 +797,9 @@ class MetadataHandler:
     def updateVdi(self, Dict):
         util.SMlog('entering updateVdi')
         try:
-            value = ''
-            min_block_size = get_min_blk_size_wrapper(self.fd)
-            mdlength = getMetadataLength(self.fd)
-            md = self.getMetadataInternal({'vdi_uuid': Dict[UUID_TAG]})
-            value = self.getMetadataToWrite(md['sr_info'], md['vdi_info'], \
-                        md['lower'], md['upper'], Dict, md['offset'])
-            file_write_wrapper(self.fd, md['lower'], min_block_size, value, len(value))
+            self._loadIndex()
+            self._writeVdiAt(self.vdiOffsets[Dict[UUID_TAG]], Dict)
+            self._commit()
             return True
         except Exception, e:
             util.SMlog("Exception updating vdi with info: %s. Error: %s" % \
@@ -615,9 +819,10 @@ class MetadataHandler:
                 md += self.getVdiInfo(vdi_info[key])
            
             # Now write the metadata on disk.
-            min_block_size = get_min_blk_size_wrapper(self.fd)
-            file_write_wrapper(self.fd, 0, min_block_size, md, len(md))
-            updateLengthInHeader(self.fd, len(md))
+            self._write(0, md)
+            self.mdlength = len(md)
+            self.vdiOffsets = None
+            self._commit()
            
         except Exception, e:
             util.SMlog("Exception writing metadata with info: %s, %s. "\
@@ -752,7 +957,8 @@ class LVMMetadataHandler(MetadataHandler):
                 if not Dict.has_key(VDI_DELETED_TAG):
                     Dict.update({VDI_DELETED_TAG:'0'})
                 
-                for tag in Dict.keys():
+                # in a fixed order, so that an unchanged sector stays the same
+                for tag in sorted(Dict.keys()):
                     if tag == NAME_LABEL_TAG or tag == NAME_DESCRIPTION_TAG:
                         continue
                     sector2 += getXMLTag(tag) % Dict[tag]
@@ -893,7 +1099,8 @@ class SLMetadataHandler(MetadataHandler):
                 if not Dict.has_key(VDI_DELETED_TAG):
                     Dict.update({VDI_DELETED_TAG:'0'})
                 
-                for tag in Dict.keys():
+                # in a fixed order, so that an unchanged sector stays the same
+                for tag in sorted(Dict.keys()):
                     if tag == NAME_LABEL_TAG or tag == NAME_DESCRIPTION_TAG:
                         continue
                     sector2 += getXMLTag(tag) % Dict[tag]
@@ -0,0 +1,182 @@
+#!/usr/bin/python
+#
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Per-host statistics ring buffers of fixed-size records, shared by all the
+# SM processes (see lockstats and cmdstats), and the helpers of their CLIs
+#
+
+import os
+import sys
+import errno
+import fcntl
+import getopt
+import math
+import struct
+import threading
+
+# magic, version, number of records ever written
+HEADER_FORMAT = "=4sIQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+class StatsRing:
+    """A ring buffer of the numRecords latest records (packed with the struct
+    format recordFormat, read back as dicts keyed by fields) in the file
+    path. Writers keep the file open; the number of records written, in the
+    header, is updated under a lock of the header, so that concurrent
+    writers each get their own slot"""
+
+    VERSION = 1
+
+    def __init__(self, path, magic, recordFormat, fields, numRecords):
+        self.path = path
+        self.magic = magic
+        self.recordFormat = recordFormat
+        self.recordSize = struct.calcsize(recordFormat)
+        self.fields = fields
+        self.numRecords = numRecords
+        self._fd = None
+        self._fdPid = None
+        self._lock = threading.Lock()
+
+    def record(self, values):
+        """Append a record of values (in the order of fields). Never raises:
+        the statistics are best-effort"""
+        self._lock.acquire()
+        try:
+            try:
+                data = struct.pack(self.recordFormat, *values)
+                if self._fdPid != os.getpid():
+                    self._fd = self._open()
+                    self._fdPid = os.getpid()
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+                try:
+                    seq = self._readHeader(self._fd)
+                    os.lseek(self._fd, 0, 0)
+                    os.write(self._fd, struct.pack(HEADER_FORMAT, self.magic,
+                        self.VERSION, seq + 1))
+                finally:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+                os.lseek(self._fd, HEADER_SIZE +
+                        (seq % self.numRecords) * self.recordSize, 0)
+                os.write(self._fd, data)
+            except (IOError, OSError, ValueError, struct.error):
+                pass
+        finally:
+            self._lock.release()
+
+    def read(self):
+        """Return the records in the ring buffer (as dicts), oldest first"""
+        try:
+            f = open(self.path, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        if len(data) < HEADER_SIZE:
+            return []
+        magic, version, seq = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+        if magic != self.magic or version != self.VERSION:
+            return []
+        records = []
+        for i in range(max(0, seq - self.numRecords), seq):
+            offset = HEADER_SIZE + (i % self.numRecords) * self.recordSize
+            chunk = data[offset:offset + self.recordSize]
+            if len(chunk) < self.recordSize:
+                continue
+            rec = dict()
+            values = struct.unpack(self.recordFormat, chunk)
+            for field, value in zip(self.fields, values):
+                if isinstance(value, str):
+                    value = value.rstrip("\0")
+                rec[field] = value
+            records.append(rec)
+        return records
+
+    def clear(self):
+        """Empty the ring buffer (in place, as writers keep it open)"""
+        if not os.path.exists(self.path):
+            return
+        fd = self._open()
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+            os.ftruncate(fd, 0)
+        finally:
+            os.close(fd)
+
+    def _open(self):
+        dirPath = os.path.dirname(self.path)
+        if not os.path.isdir(dirPath):
+            try:
+                os.makedirs(dirPath)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        return fd
+
+    def _readHeader(self, fd):
+        os.lseek(fd, 0, 0)
+        data = os.read(fd, HEADER_SIZE)
+        if len(data) < HEADER_SIZE:
+            return 0
+        magic, version, seq = struct.unpack(HEADER_FORMAT, data)
+        if magic != self.magic or version != self.VERSION:
+            return 0
+        return seq
+
+
+def percentile(values, p):
+    """The p-th percentile of the sorted list values (nearest rank)"""
+    if not values:
+        return 0
+    i = int(math.ceil((p / 100.0) * len(values))) - 1
+    return values[max(i, 0)]
+
+def main(ring, description, topHelp, what, report):
+    """The CLI of a statistics module: print the description and options
+    (and exit) on bad usage, clear ring with -c, or else call report(records,
+    top) with the records of ring, top being the number of entries to show
+    (-n)"""
+    top = 20
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:c", ["top=", "clear"])
+    except getopt.GetoptError:
+        print """%s
+
+Parameters:
+    -n --top N       %s (default: 20)
+    -c --clear       clear the statistics
+    """ % (description, topHelp)
+        sys.exit(1)
+    for o, a in opts:
+        if o in ("-n", "--top"):
+            top = int(a)
+        if o in ("-c", "--clear"):
+            ring.clear()
+            return
+
+    records = ring.read()
+    if not records:
+        print "No %s statistics" % what
+        return
+    report(records, top)
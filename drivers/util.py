@@ -34,6 +34,9 @@ import exceptions
 import traceback
 import glob
 import copy
+import threading
+import Queue
+import cmdstats
 
 NO_LOGGING_STAMPFILE='/etc/xensource/no_sm_log'
 
@@ -41,6 +44,8 @@ IORETRY_MAX = 20 # retries
 IORETRY_PERIOD = 1.0 # seconds
 
 LOGGING = not (os.path.exists(NO_LOGGING_STAMPFILE))
+# record the run time of every external command (see cmdstats)
+CMD_STATS = os.path.exists(cmdstats.STAMPFILE)
 _SM_SYSLOG_FACILITY = syslog.LOG_LOCAL2
 LOG_EMERG   = syslog.LOG_EMERG
 LOG_ALERT   = syslog.LOG_ALERT
@@ -57,6 +62,17 @@ CMD_DD = "/bin/dd"
 
 FIST_PAUSE_PERIOD = 30 # seconds
 
+PLUGIN_THREADS = 8 # concurrent plugin calls (see call_plugin_on_hosts)
+PLUGIN_TIMEOUT = 5 * 60 # seconds, per host
+
+# default timeouts of doexec (seconds), per binary: the commands that may
+# otherwise hang an SM operation for good (e.g. on unresponsive storage)
+COMMAND_TIMEOUTS = {
+    "tap-ctl": 10 * 60,
+    "lvchange": 5 * 60,
+    "iscsiadm": 10 * 60,
+}
+
 class SMException(Exception):
     """Base class for all SM exceptions for easier catching & wrapping in 
     XenError"""
@@ -130,17 +146,97 @@ def _getDateString():
     return "%s-%s-%s:%s:%s:%s" % \
           (t[0],t[1],t[2],t[3],t[4],t[5])
 
-def doexec(args, inputtext=None):
-    """Execute a subprocess, then return its return code, stdout and stderr"""
-    proc = subprocess.Popen(args,stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE,close_fds=True)
-    (stdout,stderr) = proc.communicate(inputtext)
+def doexec(args, inputtext=None, timeout=None, shell=False):
+    """Execute a subprocess, then return its return code, stdout and stderr.
+    args is a list, or a command line for /bin/sh if shell is set. If the
+    subprocess has not exited after timeout seconds (by default, that of its
+    binary in COMMAND_TIMEOUTS, if any), it is killed (with its process group,
+    so the children of a shell too) and CommandException(ETIMEDOUT) raised.
+    Every external command of SM is run here, and recorded per binary while
+    cmdstats.STAMPFILE exists"""
+    cmd = args
+    binary = ""
+    if shell:
+        cmd = ["/bin/sh", "-c", args]
+        if args.split():
+            binary = os.path.basename(args.split()[0])
+    elif args:
+        binary = os.path.basename(args[0])
+    if timeout is None:
+        timeout = COMMAND_TIMEOUTS.get(binary)
+    started = time.time()
+    proc = _Popen(cmd, newGroup = (timeout is not None),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, close_fds=True)
+    timer = None
+    expired = threading.Event()
+    if timeout is not None:
+        timer = threading.Timer(timeout, _killExpired, [proc, expired])
+        timer.start()
+    try:
+        (stdout,stderr) = proc.communicate(inputtext)
+    finally:
+        if timer:
+            timer.cancel()
     # Workaround for a pylint bug, can be removed after upgrade to
     # python 3.x or maybe a newer version of pylint in the future
     stdout = str(stdout)
     stderr = str(stderr)
     rc = proc.returncode
+    recordCommand(binary, started, rc)
+    # the command may have exited on its own just as the timer fired
+    if expired.isSet() and rc == -signal.SIGKILL:
+        raise CommandException(errno.ETIMEDOUT, str(args),
+                "timed out after %d seconds" % timeout)
     return (rc,stdout,stderr)
 
+def recordCommand(binary, started, rc):
+    """Record a run of binary, started at time started, that exited with rc,
+    in the command statistics (if enabled). For commands not run by
+    doexec"""
+    if CMD_STATS:
+        cmdstats.record(binary, started, time.time() - started, rc)
+
+def _killExpired(proc, expired):
+    if proc.returncode is not None:
+        return
+    expired.set()
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        # it has just exited
+        pass
+
+class _Popen(subprocess.Popen):
+    """subprocess.Popen for doexec: close_fds only closes the file
+    descriptors that the child has open, rather than all of them up to the
+    limit of open files (which may be huge), and the child is started in a
+    process group of its own if newGroup is set"""
+
+    def __init__(self, args, newGroup = False, **kwargs):
+        self._newGroup = newGroup
+        subprocess.Popen.__init__(self, args, **kwargs)
+
+    def _close_fds(self, but):
+        # runs in the child, between fork and exec: the only hook there
+        # besides preexec_fn, which would run arbitrary code in the child of
+        # a threaded process
+        if self._newGroup:
+            os.setpgrp()
+        try:
+            fds = os.listdir("/proc/self/fd")
+        except OSError:
+            subprocess.Popen._close_fds(self, but)
+            return
+        for fd in fds:
+            fd = int(fd)
+            if fd > 2 and fd != but:
+                try:
+                    os.close(fd)
+                except OSError:
+                    # the descriptor of the listing itself
+                    pass
+
 def is_string(value):
     return isinstance(value,basestring)
 
@@ -150,9 +246,10 @@ def is_string(value):
 #
 # cmdlist is a list of either single strings or pairs of strings. For
 # each pair, the first component is passed to exec while the second is
-# written to the logs.
+# written to the logs. The command is killed after timeout seconds, if
+# given (see doexec).
 def pread(cmdlist, close_stdin = False, scramble = None, expect_rc = 0,
-        quiet = False):
+        quiet = False, timeout = None):
     cmdlist_for_exec = []
     cmdlist_for_log = []
     for item in cmdlist:
@@ -171,7 +268,7 @@ def pread(cmdlist, close_stdin = False, scramble = None, expect_rc = 0,
 
     if not quiet:
         SMlog(cmdlist_for_log)
-    (rc,stdout,stderr) = doexec(cmdlist_for_exec)
+    (rc,stdout,stderr) = doexec(cmdlist_for_exec, timeout = timeout)
     if rc != expect_rc:
         SMlog("FAILED in util.pread: (rc %d) stdout: '%s', stderr: '%s'" % \
                 (rc, stdout, stderr))
@@ -189,9 +286,9 @@ def pread2(cmdlist, quiet = False):
     return pread(cmdlist, quiet = quiet)
 
 #Read STDOUT from cmdlist, feeding 'text' to STDIN
-def pread3(cmdlist, text):
+def pread3(cmdlist, text, timeout = None):
     SMlog(cmdlist)
-    (rc,stdout,stderr) = doexec(cmdlist,text)
+    (rc,stdout,stderr) = doexec(cmdlist, text, timeout)
     if rc:
         SMlog("FAILED in util.pread3: (errno %d) stdout: '%s', stderr: '%s'" % \
                 (rc, stdout, stderr))
@@ -668,6 +765,78 @@ def get_all_slaves(session):
     master_ref = get_this_host_ref(session)
     return filter(lambda x: x != master_ref, host_refs)
 
+def xapi_map(session, func, items, threads, timeout = None):
+    """Call func(xapi, item) for each of items concurrently, on a pool of at
+    most threads threads, each with its own connection (xapi) to the local
+    XAPI, logged in as session. Return a dict of item -> the value returned
+    by func, or the exception it raised. With a timeout, a call that did not
+    return within timeout seconds of being made is left running in its
+    (daemon) thread, and its item gets a TimeoutException"""
+    results = {}
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+    done = Queue.Queue()
+    started = {}
+
+    def worker():
+        xapi = XenAPI.xapi_local()
+        xapi._session = session._session
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            started[item] = time.time()
+            try:
+                result = func(xapi, item)
+            except Exception, e:
+                result = e
+            done.put((item, result))
+
+    def startWorker():
+        thread = threading.Thread(target = worker)
+        thread.setDaemon(True)
+        thread.start()
+
+    for i in range(min(threads, len(items))):
+        startWorker()
+    while len(results) < len(items):
+        wait = None
+        if timeout is not None:
+            now = time.time()
+            wait = timeout
+            for item, start in started.items():
+                if results.has_key(item):
+                    continue
+                if now - start < timeout:
+                    wait = min(wait, start + timeout - now)
+                    continue
+                SMlog("XAPI call for %s timed out" % item)
+                results[item] = TimeoutException("%s timed out" % item)
+                # the stuck thread no longer counts towards the pool
+                startWorker()
+            if len(results) == len(items):
+                break
+        try:
+            item, result = done.get(True, wait)
+        except Queue.Empty:
+            continue
+        if not results.has_key(item):
+            results[item] = result
+    return results
+
+def call_plugin_on_hosts(session, host_refs, plugin, fn, args,
+        timeout = PLUGIN_TIMEOUT):
+    """Call the XAPI plugin function fn (with args) on each of host_refs
+    concurrently (see xapi_map). Return a dict of host_ref -> the text
+    returned by the call, or the exception it raised (a TimeoutException if
+    it did not return within timeout seconds)"""
+    return xapi_map(session,
+            lambda xapi, host_ref: xapi.xenapi.host.call_plugin(host_ref,
+                    plugin, fn, args),
+            host_refs, PLUGIN_THREADS, timeout)
+
 def get_nfs_timeout(session, sr_uuid):
     if not isinstance(session, XenAPI.Session):
         SMlog("No XAPI session for getting nfs timeout config")
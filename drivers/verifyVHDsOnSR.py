@@ -34,9 +34,7 @@ from refcounter import RefCounter
 VHDs_passed = 0
 VHDs_failed = 0
 
-def activateVdiChainAndCheck(vhd_info, vg_name):
-    global VHDs_passed
-    global VHDs_failed
+def activateVdiChain(vhd_info, vg_name):
     activated_list = []
     vhd_path = os.path.join(lvhdutil.VG_LOCATION, vg_name, vhd_info.path)
     if not activateVdi(
@@ -50,16 +48,28 @@ def activateVdiChainAndCheck(vhd_info, vg_name):
         return activated_list
 
     activated_list.append([vhd_info.uuid, vhd_path])
-    # Do a vhdutil check with -i option, to ignore error in primary
-    if not vhdutil.check(vhd_path, True):
-        util.SMlog("VHD check for %s failed, continuing with the rest!" % vg_name)
-        VHDs_failed += 1
-    else:
-        VHDs_passed += 1
-    
     if hasattr(vhd_info, 'children'):
         for vhd_info_sub in vhd_info.children:
-            activated_list.extend(activateVdiChainAndCheck(vhd_info_sub, vg_name))
+            activated_list.extend(activateVdiChain(vhd_info_sub, vg_name))
+
+    return activated_list
+
+def activateVdiChainAndCheck(vhd_info, vg_name):
+    global VHDs_passed
+    global VHDs_failed
+    activated_list = activateVdiChain(vhd_info, vg_name)
+
+    # Do a vhdutil check with -i option, to ignore error in primary, on the 
+    # whole chain in one batch
+    results = vhdutil.queryMany([item[1] for item in activated_list],
+            [vhdutil.QUERY_CHECK], lvhdutil.extractUuid)
+    for item in activated_list:
+        if results[item[1]].error:
+            util.SMlog("VHD check for %s failed, continuing with the rest!" %
+                    item[1])
+            VHDs_failed += 1
+        else:
+            VHDs_passed += 1
 
     return activated_list
 
@@ -0,0 +1,316 @@
+#!/usr/bin/python
+#
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Persistent cache of VHD scan results (for minimizing VHD re-reads on SR scan)
+#
+
+import os
+import time
+import errno
+import json
+
+import util
+import vhdutil
+
+CACHE_DIR = "/var/run/sm/vhdcache"
+LOG_EXT = ".log"
+OLD_EXT = ".old"
+MAX_LOG_SIZE = 4 * 1024 * 1024
+
+VHDINFO_FIELDS = ["uuid", "path", "sizeVirt", "sizePhys", "hidden",
+        "parentUuid", "parentPath"]
+
+
+def fileStamp(path):
+    """Stamp of a VHD file: changes whenever the file is written to"""
+    st = os.stat(path)
+    return [st.st_dev, st.st_ino, st.st_mtime, st.st_size]
+
+def lvStamp(sizeLV, vgSeqno):
+    """Stamp of a VHD LV: the VG seqno changes on every LVM metadata update
+    (so on any LV create, remove, rename or resize in the VG)"""
+    return [sizeLV, vgSeqno]
+
+def invalidate(path):
+    """Record that the metadata of the VHD at path was modified, in the change
+    log of its namespace (the name of the directory the VHD is in, i.e. the SR
+    mount point or the VG). This is needed for VHD metadata updates that leave
+    the container unchanged (e.g. setting the hidden flag of a VHD on an LV)"""
+    ns = os.path.basename(os.path.dirname(path))
+    ChangeLog(ns).append(os.path.basename(path))
+
+
+class ChangeLog:
+    """Append-only log of the names of the VHDs modified in a namespace (see
+    invalidate()), for readers that need to find out what changed since they
+    last looked. A reader keeps its position in the log as [inode, id,
+    offset], where id is the unique header line a log starts with (so that a
+    reused inode is not mistaken for the same log). Readers are expected to
+    hold the SR lock: rotate() (which renames the log away once it has grown
+    past MAX_LOG_SIZE) must not run concurrently with read(). Nothing is
+    logged while CACHE_DIR does not exist, so taking a position creates it"""
+
+    def __init__(self, ns):
+        self.ns = ns
+        self.path = os.path.join(CACHE_DIR, ns + LOG_EXT)
+        self.oldPath = self.path + OLD_EXT
+
+    def append(self, name):
+        if not os.path.isdir(CACHE_DIR):
+            return
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                    0644)
+            try:
+                os.write(fd, name + "\n")
+            finally:
+                os.close(fd)
+        except OSError, e:
+            util.SMlog("VHDCache: failed to log change of %s: %s" % (name, e))
+
+    def position(self):
+        """Return the current end of the log, or None if changes cannot be
+        logged"""
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            end = self._getEnd(self.path)
+            if not end:
+                self._create()
+                end = self._getEnd(self.path)
+            return end
+        except (IOError, OSError), e:
+            util.SMlog("VHDCache: failed to open %s: %s" % (self.path, e))
+            return None
+
+    def read(self, position):
+        """Return (names, end): the set of names logged between 'position' (as
+        returned by position() or by an earlier read()) and the current end of
+        the log. names is None if that cannot be determined (position is None,
+        or the log has been rotated more than once since)"""
+        end = self.position()
+        if not position or not end:
+            return None, end
+        try:
+            if position[:2] == end[:2]:
+                return self._readNames(self.path, position[2], end[2]), end
+            oldEnd = self._getEnd(self.oldPath)
+            if not oldEnd or position[:2] != oldEnd[:2]:
+                return None, end
+            names = self._readNames(self.oldPath, position[2], oldEnd[2])
+            names.update(self._readNames(self.path, 0, end[2]))
+            return names, end
+        except (IOError, OSError), e:
+            util.SMlog("VHDCache: failed to read %s: %s" % (self.path, e))
+            return None, end
+
+    def rotate(self):
+        """Start a new log, keeping the current one as the previous one"""
+        try:
+            os.rename(self.path, self.oldPath)
+            self._create()
+        except OSError, e:
+            util.SMlog("VHDCache: failed to rotate %s: %s" % (self.path, e))
+
+    def _create(self):
+        """Create the log with its header, unless an appender beat us to it
+        (in which case the log is left without a header)"""
+        tmpPath = "%s.%d" % (self.path, os.getpid())
+        f = open(tmpPath, 'w')
+        try:
+            f.write("#%s.%d\n" % (repr(time.time()), os.getpid()))
+        finally:
+            f.close()
+        try:
+            try:
+                os.link(tmpPath, self.path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        finally:
+            os.unlink(tmpPath)
+
+    def _getEnd(self, path):
+        try:
+            f = open(path, 'r')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            st = os.fstat(f.fileno())
+            header = f.readline()
+        finally:
+            f.close()
+        if not header.startswith("#"):
+            header = ""
+        return [st.st_ino, header.strip(), st.st_size]
+
+    def _readNames(self, path, start, end):
+        names = set()
+        if end <= start:
+            return names
+        f = open(path, 'r')
+        try:
+            f.seek(start)
+            for line in f.read(end - start).split("\n"):
+                if line and not line.startswith("#"):
+                    names.add(line)
+        finally:
+            f.close()
+        return names
+
+
+class VHDCache:
+    """Per-SR on-disk cache of VHDInfo records (as returned by vhd-util scan),
+    keyed by VHD name. Every record is stored with the stamp of its container
+    at the time it was read, and is only returned if the stamp still matches.
+    Records of VHDs that show up in the change log of the namespace are
+    dropped. The caller is expected to hold the SR lock between load() and
+    save().
+    With 'bypass' set, cached records are never returned (but the cache is
+    still refreshed with whatever is put into it)."""
+
+    def __init__(self, ns, bypass = False):
+        self.ns = ns
+        self.bypass = bypass
+        self.path = os.path.join(CACHE_DIR, ns)
+        self.changeLog = ChangeLog(ns)
+        self.logPosition = None
+        self.entries = dict()
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+        self.totalHits = 0
+        self.totalMisses = 0
+
+    def load(self):
+        """(Re)read the cache file, dropping any records invalidated since it
+        was last saved"""
+        self.entries = dict()
+        self.logPosition = None
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+        try:
+            f = open(self.path, 'r')
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+            self.entries = data["entries"]
+            self.totalHits = data["hits"]
+            self.totalMisses = data["misses"]
+            self.logPosition = data["log"]
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                util.SMlog("VHDCache: failed to load %s: %s" % (self.path, e))
+        except (ValueError, KeyError, TypeError), e:
+            util.SMlog("VHDCache: discarding corrupt %s: %s" % (self.path, e))
+        self._dropChanged()
+
+    def get(self, name, stamp):
+        """Return the cached VHDInfo for VHD 'name' if its container still
+        has the given stamp, None otherwise"""
+        self.seen.add(name)
+        entry = self.entries.get(name)
+        if self.bypass or not entry or entry["stamp"] != stamp:
+            self.misses += 1
+            return None
+        self.hits += 1
+        vhdInfo = vhdutil.VHDInfo(None)
+        for field in VHDINFO_FIELDS:
+            value = entry["info"][field]
+            if isinstance(value, unicode):
+                value = str(value)
+            setattr(vhdInfo, field, value)
+        return vhdInfo
+
+    def put(self, name, stamp, vhdInfo):
+        self.seen.add(name)
+        if vhdInfo.error:
+            self.entries.pop(name, None)
+            return
+        info = dict()
+        for field in VHDINFO_FIELDS:
+            info[field] = getattr(vhdInfo, field)
+        self.entries[name] = {"stamp": stamp, "info": info}
+
+    def save(self):
+        """Write the cache back, keeping only the records of VHDs looked up
+        since load() (so that deleted VHDs are forgotten)"""
+        self._dropChanged()
+        for name in self.entries.keys():
+            if name not in self.seen:
+                del self.entries[name]
+        self.totalHits += self.hits
+        self.totalMisses += self.misses
+        data = {"entries": self.entries, "hits": self.totalHits,
+                "misses": self.totalMisses, "log": self.logPosition}
+        tmpPath = "%s.%d" % (self.path, os.getpid())
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            f = open(tmpPath, 'w')
+            try:
+                json.dump(data, f)
+            finally:
+                f.close()
+            os.rename(tmpPath, self.path)
+        except (IOError, OSError), e:
+            util.SMlog("VHDCache: failed to save %s: %s" % (self.path, e))
+        if self.logPosition and self.logPosition[2] > MAX_LOG_SIZE:
+            self.changeLog.rotate()
+        util.SMlog("VHDCache %s: %d hits, %d misses (total: %d hits, "
+                "%d misses)" % (self.ns, self.hits, self.misses,
+                    self.totalHits, self.totalMisses))
+
+    def _dropChanged(self):
+        """Drop the records of the VHDs logged as changed since our last look
+        at the change log (all of them if that cannot be determined)"""
+        names, self.logPosition = self.changeLog.read(self.logPosition)
+        if names is None:
+            self.entries = dict()
+            return
+        for name in names:
+            self.entries.pop(name, None)
+
+
+def getFileVHDs(dirPath, extractUuidFunction, cache):
+    """Cached equivalent of vhdutil.getAllVHDs for all *.vhd files in dirPath:
+    only the VHD files that changed since the last scan are read"""
+    vhds = dict()
+    cache.load()
+    for name in os.listdir(dirPath):
+        if name.startswith('.') or not name.endswith(vhdutil.FILE_EXTN_VHD):
+            continue
+        path = os.path.join(dirPath, name)
+        try:
+            stamp = fileStamp(path)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+        vhdInfo = cache.get(name, stamp)
+        if not vhdInfo:
+            vhdInfo = vhdutil.getScanInfo(path, extractUuidFunction)
+            if not vhdInfo:
+                continue
+            cache.put(name, stamp, vhdInfo)
+        vhds[vhdInfo.uuid] = vhdInfo
+    cache.save()
+    return vhds
@@ -0,0 +1,397 @@
+#!/usr/bin/python
+#
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# In-process reader for VHD metadata (footer, dynamic header, parent locators
+# and BAT). Mirrors the semantics of the libvhd queries used by vhd-util so
+# that vhdutil can avoid a fork/exec for read-only metadata queries.
+#
+
+import os
+import sys
+import array
+import struct
+
+import util
+
+
+SECTOR_SIZE = 512
+FOOTER_SIZE = 512
+HEADER_SIZE = 1024
+
+FOOTER_COOKIE = "conectix"
+HEADER_COOKIE = "cxsparse"
+BATMAP_COOKIE = "tdbatmap"
+MACX_PREFIX = "file://"
+
+DISK_TYPE_FIXED = 2
+DISK_TYPE_DYNAMIC = 3
+DISK_TYPE_DIFF = 4
+
+BAT_ENTRY_UNUSED = 0xFFFFFFFFL
+
+PLAT_CODE_NONE = 0x0
+PLAT_CODE_MACX = 0x4D616358 # "MacX"
+PLAT_CODE_W2KU = 0x57326B75 # "W2ku"
+PLAT_CODE_W2RU = 0x57327275 # "W2ru"
+NUM_LOCATORS = 8
+
+# cookie, features, format version, data offset, timestamp, creator app,
+# creator version, creator OS, original size, current size, geometry, disk
+# type, checksum, unique id, saved state, hidden
+FOOTER_FORMAT = ">8sIIQI4sIIQQIII16sBB"
+FOOTER_CHECKSUM_OFFSET = 64
+FOOTER_HIDDEN_OFFSET = 85
+
+# cookie, data offset, table offset, header version, max BAT entries, block
+# size, checksum, parent unique id, parent timestamp, reserved, parent name
+HEADER_FORMAT = ">8sQQIIII16sII512s"
+HEADER_CHECKSUM_OFFSET = 36
+
+# platform code, data space, data length, reserved, data offset
+LOCATOR_FORMAT = ">IIIIQ"
+LOCATOR_OFFSET = struct.calcsize(HEADER_FORMAT)
+LOCATOR_SIZE = struct.calcsize(LOCATOR_FORMAT)
+
+# cookie, batmap offset, batmap size (sectors)
+BATMAP_HEADER_FORMAT = ">8sQI"
+
+NULL_UUID = "\0" * 16
+
+# guard against parent locator loops when walking a chain
+MAX_CHAIN_DEPTH = 1024
+
+
+class VHDReadError(util.SMException):
+    """The VHD metadata could not be parsed natively. Callers are expected to
+    fall back to vhd-util, which knows about every quirk of the format"""
+    pass
+
+
+def _checksum(data, offset):
+    """VHD checksum: one's complement of the byte sum, excluding the 4-byte
+    checksum field itself"""
+    total = sum(array.array('B', data[:offset] + data[offset + 4:]))
+    return ~total & 0xFFFFFFFFL
+
+def _roundupSectors(size):
+    """Size in bytes rounded up to whole sectors (but at least one)"""
+    secs = (size + SECTOR_SIZE - 1) / SECTOR_SIZE
+    if secs == 0:
+        secs = 1
+    return secs * SECTOR_SIZE
+
+
+class Locator:
+    def __init__(self, code, dataSpace, dataLen, dataOffset):
+        self.code = code
+        self.dataSpace = dataSpace
+        self.dataLen = dataLen
+        self.dataOffset = dataOffset
+
+    def getSize(self):
+        """The on-disk space of the locator. The spec says data_space is in
+        sectors, but some implementations store it in bytes"""
+        if self.dataSpace < SECTOR_SIZE:
+            return self.dataSpace * SECTOR_SIZE
+        if self.dataSpace % SECTOR_SIZE == 0:
+            return self.dataSpace
+        return 0
+
+    def decode(self, data):
+        if self.code == PLAT_CODE_MACX:
+            name = data.decode("utf-8")
+            if name.startswith(MACX_PREFIX):
+                name = name[len(MACX_PREFIX):]
+        elif self.code in (PLAT_CODE_W2KU, PLAT_CODE_W2RU):
+            name = data.decode("utf-16-le")
+        else:
+            raise VHDReadError("unknown parent locator code 0x%x" % self.code)
+        return name.rstrip(u"\0").encode("utf-8")
+
+
+class VHD:
+    """Metadata of a single VHD. The footer and (for dynamic and differencing
+    disks) the header are read on open(); the BAT and the parent locators are
+    read on demand while the VHD is still open."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.fileSize = 0
+        self.diskType = None
+        self.currSize = 0
+        self.dataOffset = 0
+        self.creatorApp = ""
+        self.hidden = 0
+        self.tableOffset = 0
+        self.maxBATSize = 0
+        self.blockSize = 0
+        self.parentUuid = NULL_UUID
+        self.locators = []
+
+    def open(self):
+        try:
+            self.fd = os.open(self.path, os.O_RDONLY)
+            self.fileSize = os.lseek(self.fd, 0, 2)
+        except OSError, e:
+            self.close()
+            raise VHDReadError("failed to open %s: %s" % (self.path, e))
+        try:
+            self._readFooter()
+            if self.isDynamic():
+                self._readHeader()
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def isDynamic(self):
+        return self.diskType in (DISK_TYPE_DYNAMIC, DISK_TYPE_DIFF)
+
+    def hasParent(self):
+        return self.diskType == DISK_TYPE_DIFF
+
+    def isParentRaw(self):
+        return self.parentUuid == NULL_UUID
+
+    def getSizeVirt(self):
+        """Virtual size, truncated to MB like vhd-util query -v"""
+        return (self.currSize >> 20) << 20
+
+    def getSizePhys(self):
+        """End of the last allocated block (or of the metadata if nothing is
+        allocated) plus the footer, like vhd-util query -s"""
+        if not self.isDynamic():
+            return self.fileSize
+        end = self._getEndOfHeaders()
+        blockSecs = self.blockSize / SECTOR_SIZE
+        bitmapSecs = _roundupSectors(blockSecs / 8) / SECTOR_SIZE
+        allocated = set(self._readBAT())
+        allocated.discard(BAT_ENTRY_UNUSED)
+        if allocated:
+            blockEnd = (max(allocated) + bitmapSecs + blockSecs) * SECTOR_SIZE
+            if blockEnd > end:
+                end = blockEnd
+        return end + FOOTER_SIZE
+
+    def getParentName(self):
+        """Decoded name stored in the first usable parent locator, without
+        trying to resolve it"""
+        for loc in self.locators:
+            try:
+                return loc.decode(self._readLocator(loc))
+            except (VHDReadError, UnicodeError):
+                continue
+        return None
+
+    def getParentPath(self):
+        """Resolve the parent path the same way libvhd does: try each parent
+        locator in turn, absolute paths as-is, relative ones against the
+        directory of the child. Return None if there is no parent"""
+        if not self.hasParent():
+            return None
+        for loc in self.locators:
+            try:
+                name = loc.decode(self._readLocator(loc))
+            except (VHDReadError, UnicodeError):
+                continue
+            if not name:
+                continue
+            if name.startswith("/") and os.access(name, os.R_OK):
+                return name
+            location = os.path.join(os.path.dirname(self.path), name)
+            if os.access(location, os.R_OK):
+                return os.path.realpath(location)
+        raise VHDReadError("parent of %s not found" % self.path)
+
+    def _pread(self, offset, length):
+        chunks = []
+        remaining = length
+        try:
+            os.lseek(self.fd, offset, 0)
+            while remaining > 0:
+                chunk = os.read(self.fd, remaining)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                remaining -= len(chunk)
+        except OSError, e:
+            raise VHDReadError("read of %s at %d failed: %s" % \
+                    (self.path, offset, e))
+        if remaining:
+            raise VHDReadError("short read of %s at %d" % (self.path, offset))
+        return "".join(chunks)
+
+    def _parseFooter(self, data):
+        fields = struct.unpack(FOOTER_FORMAT,
+                data[:struct.calcsize(FOOTER_FORMAT)])
+        if fields[0] != FOOTER_COOKIE:
+            return False
+        checksum = _checksum(data, FOOTER_CHECKSUM_OFFSET)
+        if checksum != fields[12]:
+            # early tapdisks did not update the checksum when marking a VHD
+            # hidden
+            if not fields[15] or not fields[5].startswith("tap"):
+                return False
+            data = data[:FOOTER_HIDDEN_OFFSET] + "\0" + \
+                    data[FOOTER_HIDDEN_OFFSET + 1:]
+            if _checksum(data, FOOTER_CHECKSUM_OFFSET) != fields[12]:
+                return False
+        self.dataOffset = fields[3]
+        self.creatorApp = fields[5]
+        self.currSize = fields[9]
+        self.diskType = fields[11]
+        self.hidden = fields[15]
+        return True
+
+    def _readFooter(self):
+        if self.fileSize < FOOTER_SIZE:
+            raise VHDReadError("%s too small to be a VHD" % self.path)
+        data = self._pread(self.fileSize - FOOTER_SIZE, FOOTER_SIZE)
+        if self._parseFooter(data):
+            return
+        # dynamic disks keep a copy of the footer at the start of the file
+        data = self._pread(0, FOOTER_SIZE)
+        if self._parseFooter(data) and self.isDynamic():
+            return
+        raise VHDReadError("no valid footer in %s" % self.path)
+
+    def _readHeader(self):
+        data = self._pread(self.dataOffset, HEADER_SIZE)
+        fields = struct.unpack(HEADER_FORMAT, data[:LOCATOR_OFFSET])
+        if fields[0] != HEADER_COOKIE:
+            raise VHDReadError("bad header cookie in %s" % self.path)
+        if _checksum(data, HEADER_CHECKSUM_OFFSET) != fields[6]:
+            raise VHDReadError("bad header checksum in %s" % self.path)
+        self.tableOffset = fields[2]
+        self.maxBATSize = fields[4]
+        self.blockSize = fields[5]
+        self.parentUuid = fields[7]
+        if not self.blockSize or self.blockSize % SECTOR_SIZE:
+            raise VHDReadError("bad block size %d in %s" % \
+                    (self.blockSize, self.path))
+        self.locators = []
+        for i in range(NUM_LOCATORS):
+            start = LOCATOR_OFFSET + i * LOCATOR_SIZE
+            code, dataSpace, dataLen, reserved, dataOffset = struct.unpack(
+                    LOCATOR_FORMAT, data[start:start + LOCATOR_SIZE])
+            if code == PLAT_CODE_NONE:
+                continue
+            self.locators.append(Locator(code, dataSpace, dataLen, dataOffset))
+
+    def _readLocator(self, loc):
+        if not loc.dataLen or loc.dataLen > loc.getSize():
+            raise VHDReadError("bad parent locator in %s" % self.path)
+        return self._pread(loc.dataOffset, loc.dataLen)
+
+    def _readBAT(self):
+        """Read the BAT entries that can be allocated, i.e. those covering
+        the current virtual size"""
+        numEntries = (self.currSize + self.blockSize - 1) / self.blockSize
+        if numEntries > self.maxBATSize:
+            numEntries = self.maxBATSize
+        bat = array.array('I')
+        if bat.itemsize != 4:
+            bat = array.array('L')
+        if numEntries == 0:
+            return bat
+        bat.fromstring(self._pread(self.tableOffset, numEntries * 4))
+        if sys.byteorder == "little":
+            bat.byteswap()
+        return bat
+
+    def _getEndOfHeaders(self):
+        end = self.dataOffset + HEADER_SIZE
+        batEnd = self.tableOffset + _roundupSectors(self.maxBATSize * 4)
+        end = max(end, batEnd)
+        # tapdisk keeps a BAT bitmap right after the BAT
+        hdrSize = struct.calcsize(BATMAP_HEADER_FORMAT)
+        if batEnd + hdrSize <= self.fileSize:
+            cookie, mapOffset, mapSecs = struct.unpack(BATMAP_HEADER_FORMAT,
+                    self._pread(batEnd, hdrSize))
+            if cookie == BATMAP_COOKIE:
+                end = max(end, batEnd + _roundupSectors(hdrSize))
+                end = max(end, mapOffset + mapSecs * SECTOR_SIZE)
+        for loc in self.locators:
+            end = max(end, loc.dataOffset + loc.getSize())
+        return end
+
+
+def _query(path, func):
+    vhd = VHD(path)
+    vhd.open()
+    try:
+        return func(vhd)
+    finally:
+        vhd.close()
+
+def getSizeVirt(path):
+    return _query(path, lambda vhd: vhd.getSizeVirt())
+
+def getSizePhys(path):
+    return _query(path, lambda vhd: vhd.getSizePhys())
+
+def getHidden(path):
+    return _query(path, lambda vhd: vhd.hidden)
+
+def hasParent(path):
+    def _hasParent(vhd):
+        if not vhd.isDynamic():
+            raise VHDReadError("%s is not a dynamic VHD" % path)
+        return vhd.hasParent()
+    return _query(path, _hasParent)
+
+def getParentPath(path):
+    return _query(path, lambda vhd: vhd.getParentPath())
+
+def getParentName(path):
+    return _query(path, lambda vhd: vhd.getParentName())
+
+def getInfo(path, includeParent = True):
+    """Return (sizeVirt, sizePhys, parentPath, hidden) for the VHD, parentPath
+    being None if there is no parent or it was not requested"""
+    def _getInfo(vhd):
+        parentPath = None
+        if includeParent:
+            parentPath = vhd.getParentPath()
+        return (vhd.getSizeVirt(), vhd.getSizePhys(), parentPath, vhd.hidden)
+    return _query(path, _getInfo)
+
+def getDepth(path):
+    """Number of VHDs in the chain starting at path, counting a raw parent at
+    the bottom of the chain, like vhd-util query -d"""
+    depth = 0
+    while path:
+        if depth >= MAX_CHAIN_DEPTH:
+            raise VHDReadError("parent loop detected at %s" % path)
+        vhd = VHD(path)
+        vhd.open()
+        try:
+            depth += 1
+            if not vhd.hasParent():
+                break
+            if vhd.isParentRaw():
+                depth += 1
+                break
+            path = vhd.getParentPath()
+        finally:
+            vhd.close()
+    return depth
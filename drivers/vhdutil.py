@@ -24,6 +24,10 @@ import util
 import errno
 import zlib
 import re
+import Queue
+import threading
+import vhdreader
+import vhdcache
 
 
 MAX_VHD_JOURNAL_SIZE = 6 * 1024 * 1024 # 2MB VHD block size, max 2TB VHD size
@@ -33,6 +37,15 @@ OPT_LOG_ERR = "--debug"
 VHD_BLOCK_SIZE = 2 * 1024 * 1024
 VHD_FOOTER_SIZE = 512
  
+# fields for queryMany
+QUERY_SIZE_VIRT = "sizeVirt"
+QUERY_SIZE_PHYS = "sizePhys"
+QUERY_HIDDEN = "hidden"
+QUERY_PARENT = "parent" # the parent must be present
+QUERY_PARENT_NOCHECK = "parentNoCheck" # parent name from the locator only
+QUERY_CHECK = "check" # vhd-util check, ignoring a missing primary footer
+QUERY_THREADS = 8 # max concurrent readers in queryMany
+
 # lock to lock the entire SR for short ops
 LOCK_TYPE_SR = "sr"
 
@@ -98,10 +111,36 @@ def ioretry(cmd):
     return util.ioretry(lambda: util.pread2(cmd),
             errlist = [errno.EIO, errno.EAGAIN])
 
+def _ioretryModify(path, cmd):
+    """Run a vhd-util command that modifies the VHD at path, making sure any
+    cached info of the VHD is dropped"""
+    try:
+        return ioretry(cmd)
+    finally:
+        vhdcache.invalidate(path)
+
+def _nativeFailed(path, e):
+    util.SMlog("Native VHD read of %s failed (%s), using vhd-util" % (path, e))
+
 def getVHDInfo(path, extractUuidFunction, includeParent = True):
     """Get the VHD info. The parent info may optionally be omitted: vhd-util
     tries to verify the parent by opening it, which results in error if the VHD
     resides on an inactive LV"""
+    try:
+        sizeVirt, sizePhys, parentPath, hidden = \
+                vhdreader.getInfo(path, includeParent)
+        vhdInfo = VHDInfo(extractUuidFunction(path))
+        vhdInfo.sizeVirt = sizeVirt
+        vhdInfo.sizePhys = sizePhys
+        if parentPath:
+            vhdInfo.parentPath = parentPath
+            vhdInfo.parentUuid = extractUuidFunction(parentPath)
+        vhdInfo.hidden = hidden
+        vhdInfo.path = path
+        return vhdInfo
+    except vhdreader.VHDReadError, e:
+        _nativeFailed(path, e)
+
     opts = "-vsf"
     if includeParent:
         opts += "p"
@@ -146,6 +185,30 @@ def getAllVHDs(pattern, extractUuidFunction, vgName = None, \
             vhds[vhdInfo.uuid] = vhdInfo
     return vhds
 
+def getScanInfo(path, extractUuidFunction):
+    """Get the VHD info of a single VHD file as returned by getAllVHDs, i.e.
+    without verifying the parent (return None if path is not a VHD)"""
+    try:
+        vhd = vhdreader.VHD(path)
+        vhd.open()
+        try:
+            vhdInfo = VHDInfo(extractUuidFunction(path))
+            vhdInfo.path = path
+            vhdInfo.sizeVirt = vhd.currSize
+            vhdInfo.sizePhys = vhd.getSizePhys()
+            vhdInfo.hidden = vhd.hidden
+            if vhd.hasParent():
+                vhdInfo.parentPath = vhd.getParentName()
+                vhdInfo.parentUuid = extractUuidFunction(vhdInfo.parentPath)
+        finally:
+            vhd.close()
+        return vhdInfo
+    except vhdreader.VHDReadError, e:
+        _nativeFailed(path, e)
+
+    vhds = getAllVHDs(path, extractUuidFunction)
+    return vhds.get(extractUuidFunction(path))
+
 def getParentChain(lvName, extractUuidFunction, vgName):
     """Get the chain of all VHD parents of 'path'. Safe to call for raw VDI's
     as well"""
@@ -157,6 +220,14 @@ def getParentChain(lvName, extractUuidFunction, vgName):
     return chain
 
 def getParent(path, extractUuidFunction):
+    try:
+        parentPath = vhdreader.getParentPath(path)
+        if not parentPath:
+            return None
+        return extractUuidFunction(parentPath)
+    except vhdreader.VHDReadError, e:
+        _nativeFailed(path, e)
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-p", "-n", path]
     ret = ioretry(cmd)
     if ret.find("query failed") != -1 or ret.find("Failed opening") != -1:
@@ -169,6 +240,11 @@ def hasParent(path):
     """Check if the VHD has a parent. A VHD has a parent iff its type is
     'Differencing'. This function does not need the parent to actually
     be present (e.g. the parent LV to be activated)."""
+    try:
+        return vhdreader.hasParent(path)
+    except vhdreader.VHDReadError, e:
+        _nativeFailed(path, e)
+
     cmd = [VHD_UTIL, "read", OPT_LOG_ERR, "-p", "-n", path]
     ret = ioretry(cmd)
     m = re.match(".*Disk type\s+: (\S+) hard disk.*", ret, flags = re.S)
@@ -181,9 +257,14 @@ def setParent(path, parentPath, parentRaw):
     cmd = [VHD_UTIL, "modify", OPT_LOG_ERR, "-p", normpath, "-n", path]
     if parentRaw:
         cmd.append("-m")
-    ioretry(cmd)
+    _ioretryModify(path, cmd)
 
 def getHidden(path):
+    try:
+        return vhdreader.getHidden(path)
+    except vhdreader.VHDReadError, e:
+        _nativeFailed(path, e)
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-f", "-n", path]
     ret = ioretry(cmd)
     hidden = int(ret.split(':')[-1].strip())
@@ -194,9 +275,14 @@ def setHidden(path, hidden = True):
     if not hidden:
         opt = "0"
     cmd = [VHD_UTIL, "set", OPT_LOG_ERR, "-n", path, "-f", "hidden", "-v", opt]
-    ret = ioretry(cmd)
+    ret = _ioretryModify(path, cmd)
 
 def getSizeVirt(path):
+    try:
+        return long(vhdreader.getSizeVirt(path))
+    except vhdreader.VHDReadError, e:
+        _nativeFailed(path, e)
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-v", "-n", path]
     ret = ioretry(cmd)
     size = long(ret) * 1024 * 1024
@@ -207,13 +293,13 @@ def setSizeVirt(path, size, jFile):
     size_mb = size / 1024 /1024
     cmd = [VHD_UTIL, "resize", OPT_LOG_ERR, "-s", str(size_mb), "-n", path,
             "-j", jFile]
-    ioretry(cmd)
+    _ioretryModify(path, cmd)
 
 def setSizeVirtFast(path, size):
     "resize VHD online"
     size_mb = size / 1024 /1024
     cmd = [VHD_UTIL, "resize", OPT_LOG_ERR, "-s", str(size_mb), "-n", path, "-f"]
-    ioretry(cmd)
+    _ioretryModify(path, cmd)
 
 def getMaxResizeSize(path):
     """get the max virtual size for fast resize"""
@@ -222,6 +308,11 @@ def getMaxResizeSize(path):
     return int(ret)
 
 def getSizePhys(path):
+    try:
+        return vhdreader.getSizePhys(path)
+    except vhdreader.VHDReadError, e:
+        _nativeFailed(path, e)
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-s", "-n", path]
     ret = ioretry(cmd)
     return int(ret)
@@ -232,15 +323,20 @@ def setSizePhys(path, size, debug = True):
         cmd = [VHD_UTIL, "modify", OPT_LOG_ERR, "-s", str(size), "-n", path]
     else:
         cmd = [VHD_UTIL, "modify", "-s", str(size), "-n", path]
-    ioretry(cmd)
+    _ioretryModify(path, cmd)
 
 def killData(path):
     "zero out the disk (kill all data inside the VHD file)"
     cmd = [VHD_UTIL, "modify", OPT_LOG_ERR, "-z", "-n", path]
-    ioretry(cmd)
+    _ioretryModify(path, cmd)
 
 def getDepth(path):
     "get the VHD parent chain depth"
+    try:
+        return vhdreader.getDepth(path)
+    except vhdreader.VHDReadError, e:
+        _nativeFailed(path, e)
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-d", "-n", path]
     text = ioretry(cmd)
     depth = -1
@@ -255,7 +351,7 @@ def getBlockBitmap(path):
 
 def coalesce(path):
     cmd = [VHD_UTIL, "coalesce", OPT_LOG_ERR, "-n", path]
-    ioretry(cmd)
+    _ioretryModify(path, cmd)
 
 def create(path, size, static, msize = 0):
     size_mb = size / 1024 /1024
@@ -265,7 +361,7 @@ def create(path, size, static, msize = 0):
     if msize:
         cmd.append("-S")
         cmd.append(str(msize))
-    ioretry(cmd)
+    _ioretryModify(path, cmd)
 
 def snapshot(path, parent, parentRaw, msize = 0, checkEmpty = True):
     cmd = [VHD_UTIL, "snapshot", OPT_LOG_ERR, "-n", path, "-p", parent]
@@ -276,7 +372,7 @@ def snapshot(path, parent, parentRaw, msize = 0, checkEmpty = True):
         cmd.append(str(msize))
     if not checkEmpty:
         cmd.append("-e")
-    text = ioretry(cmd)
+    text = _ioretryModify(path, cmd)
 
 def check(path, ignoreMissingFooter = False, fast = False):
     cmd = [VHD_UTIL, "check", OPT_LOG_ERR, "-n", path]
@@ -292,7 +388,7 @@ def check(path, ignoreMissingFooter = False, fast = False):
 
 def revert(path, jFile):
     cmd = [VHD_UTIL, "revert", OPT_LOG_ERR, "-n", path, "-j", jFile]
-    ioretry(cmd)
+    _ioretryModify(path, cmd)
 
 def _parseVHDInfo(line, extractUuidFunction):
     vhdInfo = None
@@ -323,19 +419,123 @@ def _parseVHDInfo(line, extractUuidFunction):
             vhdInfo.parentUuid = extractUuidFunction(val)
     return vhdInfo
 
-def _getVHDParentNoCheck(path):
+def _parentNameToVdi(val):
+    vdi = val.replace("--", "-")[-40:]
+    if vdi[1:].startswith("LV-"):
+        vdi = vdi[1:]
+    return vdi
+
+def _getVHDParentNameNoCheck(path):
+    """Get the parent name as stored in the first parent locator, without
+    resolving it (so the parent need not be present)"""
+    try:
+        name = vhdreader.getParentName(path)
+        if name is None:
+            return None
+        return name.split(':')[0].strip()
+    except vhdreader.VHDReadError, e:
+        _nativeFailed(path, e)
+
     cmd = ["vhd-util", "read", "-p", "-n", "%s" % path]
     text = util.pread(cmd)
     util.SMlog(text)
     for line in text.split('\n'):
         if line.find("decoded name :") != -1:
-            val = line.split(':')[1].strip()
-            vdi = val.replace("--", "-")[-40:]
-            if vdi[1:].startswith("LV-"):
-                vdi = vdi[1:]
-            return vdi
+            return line.split(':')[1].strip()
     return None
+
+def _getVHDParentNoCheck(path):
+    name = _getVHDParentNameNoCheck(path)
+    if name is None:
+        return None
+    return _parentNameToVdi(name)
+
+def _queryNative(vhdInfo, fields, extractUuidFunction):
+    vhd = vhdreader.VHD(vhdInfo.path)
+    vhd.open()
+    try:
+        if QUERY_SIZE_VIRT in fields:
+            vhdInfo.sizeVirt = vhd.getSizeVirt()
+        if QUERY_SIZE_PHYS in fields:
+            vhdInfo.sizePhys = vhd.getSizePhys()
+        if QUERY_HIDDEN in fields:
+            vhdInfo.hidden = vhd.hidden
+        parentPath = None
+        if QUERY_PARENT in fields:
+            parentPath = vhd.getParentPath()
+        elif QUERY_PARENT_NOCHECK in fields and vhd.hasParent():
+            parentPath = vhd.getParentName()
+            if parentPath:
+                parentPath = parentPath.split(':')[0].strip()
+        if parentPath:
+            vhdInfo.parentPath = parentPath
+            vhdInfo.parentUuid = extractUuidFunction(parentPath)
+    finally:
+        vhd.close()
+
+def _queryVhdUtil(vhdInfo, fields, extractUuidFunction):
+    path = vhdInfo.path
+    if QUERY_SIZE_VIRT in fields:
+        vhdInfo.sizeVirt = getSizeVirt(path)
+    if QUERY_SIZE_PHYS in fields:
+        vhdInfo.sizePhys = getSizePhys(path)
+    if QUERY_HIDDEN in fields:
+        vhdInfo.hidden = getHidden(path)
+    parentPath = None
+    if QUERY_PARENT in fields:
+        parentPath = getParent(path, lambda x: x.strip())
+    elif QUERY_PARENT_NOCHECK in fields:
+        parentPath = _getVHDParentNameNoCheck(path)
+    if parentPath:
+        vhdInfo.parentPath = parentPath
+        vhdInfo.parentUuid = extractUuidFunction(parentPath)
+
+def _queryOne(path, fields, extractUuidFunction):
+    vhdInfo = VHDInfo(None)
+    vhdInfo.path = path
+    try:
+        vhdInfo.uuid = extractUuidFunction(path)
+        try:
+            if set(fields) - set([QUERY_CHECK]):
+                _queryNative(vhdInfo, fields, extractUuidFunction)
+        except vhdreader.VHDReadError, e:
+            _nativeFailed(path, e)
+            _queryVhdUtil(vhdInfo, fields, extractUuidFunction)
+        if QUERY_CHECK in fields and not check(path, True):
+            vhdInfo.error = "check failed"
+    except Exception, e:
+        util.SMlog("***** VHD query error on %s: %s" % (path, e))
+        vhdInfo.error = str(e)
+    return vhdInfo
+
+def queryMany(paths, fields, extractUuidFunction):
+    """Query the QUERY_* fields of many VHDs in one pass, on a bounded pool
+    of reader threads. Return a dict of path -> VHDInfo. Errors do not abort
+    the batch: a VHD that could not be queried has its 'error' set instead"""
+    results = {}
+    pending = Queue.Queue()
+    for path in paths:
+        pending.put(path)
+
+    def worker():
+        while True:
+            try:
+                path = pending.get_nowait()
+            except Queue.Empty:
+                return
+            results[path] = _queryOne(path, fields, extractUuidFunction)
+
+    threads = []
+    for i in range(min(QUERY_THREADS, len(paths))):
+        thread = threading.Thread(target = worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
 def repair(path):
     """Repairs the VHD."""
-    ioretry([VHD_UTIL, 'repair', '-n', path])
+    _ioretryModify(path, [VHD_UTIL, 'repair', '-n', path])
 
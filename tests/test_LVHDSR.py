@@ -76,3 +76,83 @@ class TestLVHDSR(unittest.TestCase, Stubs):
 
         sr._undoAllInflateJournals()
         self.assertEquals(0, mock_lvhdutil_lvRefreshOnAllSlaves.call_count)
+
+
+class TestIntroduceFromMetadata(unittest.TestCase, Stubs):
+
+    def setUp(self):
+        self.init_stubs()
+        self.xapi = mock.MagicMock()
+        self.stubout('XenAPI.xapi_local', return_value=self.xapi)
+        self.stubout('util.SMlog', new_callable=SMLog)
+        self.stubout('LVHDSR.LVMMetadataHandler')
+        self.metadata = {}
+        LVHDSR.LVMMetadataHandler.return_value.getMetadata.return_value = \
+            ({}, self.metadata)
+        self.stubout('util.list_VDI_records_in_sr')
+        self.records = {}
+        LVHDSR.util.list_VDI_records_in_sr.return_value = self.records
+        self.stubout('vhdutil.queryMany')
+        self.vhdInfos = {}
+        LVHDSR.vhdutil.queryMany.return_value = self.vhdInfos
+
+    def tearDown(self):
+        self.remove_stubs()
+
+    def create_LVHDSR(self):
+        srcmd = mock.Mock()
+        srcmd.dconf = {'device': '/dev/bar'}
+        srcmd.params = {'command': 'foo', 'session_ref': 'some session ref'}
+        sr = LVHDSR.LVHDSR(srcmd, "some SR UUID")
+        sr.lvmCache = mock.MagicMock()
+        sr.provision = 'thick'
+        return sr
+
+    def add_metadata(self, uuid, snapshot_of=''):
+        self.metadata[len(self.metadata)] = {
+            LVHDSR.UUID_TAG: uuid, LVHDSR.NAME_LABEL_TAG: 'label',
+            LVHDSR.NAME_DESCRIPTION_TAG: '', LVHDSR.TYPE_TAG: 'user',
+            LVHDSR.VDI_TYPE_TAG: 'vhd', LVHDSR.READ_ONLY_TAG: '0',
+            LVHDSR.MANAGED_TAG: '1',
+            LVHDSR.IS_A_SNAPSHOT_TAG: str(int(bool(snapshot_of))),
+            LVHDSR.SNAPSHOT_OF_TAG: snapshot_of,
+            LVHDSR.SNAPSHOT_TIME_TAG: '20200101T00:00:00Z',
+            LVHDSR.METADATA_OF_POOL_TAG: ''}
+        info = LVHDSR.vhdutil.VHDInfo(uuid)
+        info.sizeVirt = 1024 * 1024
+        info.error = 0
+        self.vhdInfos['/dev/VG_XenStorage-some SR UUID/VHD-' + uuid] = info
+
+    def test_introduces_missing_vdis_in_single_calls(self):
+        self.records['OpaqueRef:base'] = {'uuid': 'base',
+                                          'snapshot_of': 'OpaqueRef:NULL'}
+        self.add_metadata('base')
+        self.add_metadata('snap', snapshot_of='base')
+        self.xapi.xenapi.VDI.db_introduce.return_value = 'OpaqueRef:snap'
+        sr = self.create_LVHDSR()
+        activated = []
+
+        sr._introduceFromMetadata(activated)
+
+        self.assertEquals(['VHD-snap'], activated)
+        args = self.xapi.xenapi.VDI.db_introduce.call_args[0]
+        self.assertEquals('snap', args[0])
+        self.assertEquals((True, str(1024 * 1024)), (args[11], args[12]))
+        self.assertEquals((True, 'OpaqueRef:base'), (args[15], args[17]))
+        self.assertEquals(['db_introduce'],
+                          [c[0] for c in self.xapi.xenapi.VDI.method_calls])
+
+    def test_snapshot_of_set_when_missing(self):
+        self.records['OpaqueRef:base'] = {'uuid': 'base',
+                                          'snapshot_of': 'OpaqueRef:NULL'}
+        self.records['OpaqueRef:snap'] = {'uuid': 'snap',
+                                          'snapshot_of': 'OpaqueRef:NULL'}
+        self.add_metadata('base')
+        self.add_metadata('snap', snapshot_of='base')
+        sr = self.create_LVHDSR()
+
+        sr._introduceFromMetadata([])
+
+        self.assertEquals(0, self.xapi.xenapi.VDI.db_introduce.call_count)
+        self.xapi.xenapi.VDI.set_snapshot_of.assert_called_once_with(
+            'OpaqueRef:snap', 'OpaqueRef:base')
@@ -0,0 +1,88 @@
+import unittest
+import mock
+
+import SR
+import VDI
+
+
+class FakeVDI(VDI.VDI):
+    def load(self, vdi_uuid):
+        self.size = 2048
+        self.utilisation = 1024
+        self.sm_config_override = {'vhd-parent': 'parent-uuid'}
+
+
+def xenapi_record(uuid, **fields):
+    record = {'uuid': uuid, 'location': uuid, 'read_only': False,
+              'virtual_size': '2048', 'physical_utilisation': '1024',
+              'sm_config': {'vhd-parent': 'parent-uuid'}}
+    record.update(fields)
+    return record
+
+
+class TestScanRecord(unittest.TestCase):
+    def setUp(self):
+        self.xapi = mock.MagicMock()
+        for name, value in [('util.XenAPI.xapi_local',
+                             mock.MagicMock(return_value=self.xapi)),
+                            ('util.SMlog', mock.MagicMock())]:
+            patcher = mock.patch(name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # the update threads share self.xapi: create its methods up front, as
+        # mock does not create children thread-safely
+        for method in ['set_physical_utilisation', 'add_to_sm_config',
+                       'remove_from_sm_config']:
+            getattr(self.xapi.xenapi.VDI, method)
+        self.sr = mock.MagicMock()
+        self.sr.vdis = {}
+        self.records = {}
+
+    def add_vdi(self, uuid, **fields):
+        self.sr.vdis[uuid] = FakeVDI(self.sr, uuid)
+        self.records['OpaqueRef:' + uuid] = xenapi_record(uuid, **fields)
+
+    def scan_record(self):
+        with mock.patch('util.list_VDI_records_in_sr',
+                        return_value=self.records):
+            return SR.ScanRecord(self.sr)
+
+    def test_only_changed_fields_are_written(self):
+        self.add_vdi('vdi1', physical_utilisation='512')
+        self.add_vdi('vdi2', sm_config={'vhd-parent': 'old-parent',
+                                        'host_h1': 'RW'})
+        self.add_vdi('vdi3')
+        scanrecord = self.scan_record()
+        self.assertEquals(['vdi1', 'vdi2'], sorted(scanrecord.existing))
+
+        scanrecord.synchronise_existing()
+
+        self.assertItemsEqual(
+            [mock.call.set_physical_utilisation('OpaqueRef:vdi1',
+                                                       '1024'),
+                    mock.call.remove_from_sm_config('OpaqueRef:vdi2',
+                                                    'vhd-parent'),
+                    mock.call.add_to_sm_config('OpaqueRef:vdi2',
+                                               'vhd-parent', 'parent-uuid')],
+            self.xapi.xenapi.VDI.method_calls)
+        self.assertEquals([], self.sr.session.xenapi.VDI.method_calls)
+
+    def test_new_sm_config_key_is_removed_first(self):
+        # the key may have been added since the record was read
+        self.add_vdi('vdi1', sm_config={})
+        scanrecord = self.scan_record()
+
+        scanrecord.synchronise_existing()
+
+        self.assertEquals(
+            [mock.call.remove_from_sm_config('OpaqueRef:vdi1', 'vhd-parent'),
+             mock.call.add_to_sm_config('OpaqueRef:vdi1', 'vhd-parent',
+                                        'parent-uuid')],
+            self.xapi.xenapi.VDI.method_calls)
+
+    def test_update_failure_is_raised(self):
+        self.add_vdi('vdi1', read_only=True)
+        self.xapi.xenapi.VDI.set_read_only.side_effect = Exception('failure')
+        scanrecord = self.scan_record()
+
+        self.assertRaises(Exception, scanrecord.synchronise_existing)
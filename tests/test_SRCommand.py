@@ -125,3 +125,47 @@ class TestStandaloneFunctions(unittest.TestCase):
             SRCommand.run(mock_driver, DRIVER_INFO)
         except Exception, e:
             self.assertTrue(isinstance(e, SomeException))
+
+
+class TestRunLocked(unittest.TestCase):
+    def run_locked(self, cmd, ops_exclusive, ops_shared):
+        """Run cmd, returning the SR and the calls on the SR lock made
+        before the command itself ran"""
+        srcmd = SRCommand.SRCommand(None)
+        srcmd.cmd = cmd
+        srcmd.vdi_uuid = 'vdi-uuid'
+        sr = mock.MagicMock()
+        sr.ops_exclusive = ops_exclusive
+        sr.ops_shared = ops_shared
+        before_run = []
+        with mock.patch('SRCommand.SRCommand._run') as mock_run:
+            mock_run.side_effect = lambda sr, target: before_run.extend(
+                [c[0] for c in sr.lock.method_calls])
+            srcmd._run_locked(sr)
+        return sr, before_run
+
+    def test_exclusive_command(self):
+        sr, before_run = self.run_locked('sr_scan', ['sr_scan'],
+                                         ['sr_update'])
+
+        self.assertEquals(['acquire'], before_run)
+        sr.lock.release.assert_called_once_with()
+
+    def test_shared_command(self):
+        sr, before_run = self.run_locked('sr_update', ['sr_scan'],
+                                         ['sr_update'])
+
+        self.assertEquals(['acquireShared'], before_run)
+        sr.lock.release.assert_called_once_with()
+
+    def test_shared_vdi_init_only(self):
+        sr, before_run = self.run_locked('vdi_activate', ['vdi_create'],
+                                         ['vdi_init'])
+
+        self.assertEquals(['acquireShared', 'release'], before_run)
+        sr.lock.release.assert_called_once_with()
+
+    def test_unlocked_command(self):
+        sr, before_run = self.run_locked('vdi_generate_config', [], [])
+
+        self.assertEquals([], sr.lock.method_calls)
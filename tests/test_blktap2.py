@@ -25,3 +25,89 @@ class TestVDI(unittest.TestCase):
         result = self.vdi.get_tap_type()
 
         self.assertEquals('aio', result)
+
+
+class TestTapPause(unittest.TestCase):
+    def setUp(self):
+        self.session = mock.MagicMock()
+        self.session.xenapi.VDI.get_sm_config.return_value = {
+            'host_h1': 'RW', 'host_h2': 'RO', 'vhd-parent': 'p'}
+        self.failing = set()
+        self.calls = []
+        xapi = mock.MagicMock()
+        xapi.xenapi.host.call_plugin.side_effect = self.call_plugin
+        patcher = mock.patch('util.XenAPI.xapi_local', return_value=xapi)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        log_patcher = mock.patch('util.SMlog')
+        log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+
+    def call_plugin(self, host_ref, plugin, action, args):
+        self.calls.append((host_ref, action))
+        return str((host_ref, action) not in self.failing)
+
+    def test_pause_calls_all_hosts(self):
+        result = blktap2.VDI.tap_pause(self.session, 'sr', 'vdi')
+
+        self.assertTrue(result)
+        self.assertEquals([('h1', 'pause'), ('h2', 'pause')],
+                          sorted(self.calls))
+        self.assertEquals(
+            0, self.session.xenapi.VDI.remove_from_sm_config.call_count)
+
+    def test_failed_pause_is_rolled_back(self):
+        self.failing.add(('h2', 'pause'))
+
+        result = blktap2.VDI.tap_pause(self.session, 'sr', 'vdi')
+
+        self.assertFalse(result)
+        self.assertEquals([('h1', 'pause'), ('h1', 'unpause'),
+                           ('h2', 'pause')], sorted(self.calls))
+        self.session.xenapi.VDI.remove_from_sm_config.assert_called_once_with(
+            self.session.xenapi.VDI.get_by_uuid.return_value, 'paused')
+
+    def test_failed_unpause_leaves_vdi_paused(self):
+        self.failing.add(('h1', 'unpause'))
+
+        result = blktap2.VDI.tap_unpause(self.session, 'sr', 'vdi')
+
+        self.assertFalse(result)
+        self.assertEquals(2, len(self.calls))
+        self.assertEquals(
+            0, self.session.xenapi.VDI.remove_from_sm_config.call_count)
+
+    def test_refresh(self):
+        self.assertTrue(blktap2.VDI.tap_refresh(self.session, 'sr', 'vdi'))
+        self.failing.add(('h2', 'refresh'))
+        self.assertFalse(blktap2.VDI.tap_refresh(self.session, 'sr', 'vdi'))
+
+
+class TestTapCtl(unittest.TestCase):
+    def setUp(self):
+        log_patcher = mock.patch('blktap2.util.SMlog')
+        log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+
+    @mock.patch('blktap2.util.doexec')
+    def test_list(self, mock_doexec):
+        mock_doexec.return_value = (
+            0, 'pid=10 minor=2 state=0 args=vhd:/dev/VG/LV\n', '')
+
+        result = blktap2.TapCtl.list(minor=2)
+
+        mock_doexec.assert_called_once_with(
+            ['/usr/sbin/tap-ctl', 'list', '-m', '2'])
+        self.assertEquals([{'pid': 10, 'minor': 2, 'state': 0,
+                            'args': 'vhd:/dev/VG/LV'}], result)
+
+    @mock.patch('blktap2.util.doexec')
+    def test_failure(self, mock_doexec):
+        mock_doexec.return_value = (22, '', 'bad\nargs\n')
+
+        try:
+            blktap2.TapCtl.spawn()
+            self.fail("CommandFailure not raised")
+        except blktap2.TapCtl.CommandFailure, e:
+            self.assertEquals(22, e.get_error_code())
+            self.assertEquals('bad; args', e.errmsg)
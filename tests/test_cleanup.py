@@ -1,9 +1,19 @@
 import unittest
 import mock
+import base64
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
 
 import cleanup
+import vhdcache
 
 import util
+from test_vhdreader import write_vhd, BLOCK_SIZE
 
 
 class FakeXapi(object):
@@ -139,3 +149,912 @@ class TestSR(unittest.TestCase):
             pass
 
         self.assertEquals(0, sr._locked)
+
+
+def naive_count_bits(bitmap1, bitmap2):
+    count = 0
+    for i in range(max(len(bitmap1), len(bitmap2))):
+        val = 0
+        if i < len(bitmap1):
+            val |= ord(bitmap1[i])
+        if i < len(bitmap2):
+            val |= ord(bitmap2[i])
+        count += bin(val).count("1")
+    return count
+
+
+class TestShouldPreempt(unittest.TestCase):
+    @mock.patch('cleanup.SR.getInstance')
+    def test_several_coalesce_entries(self, mock_get_instance):
+        sr = mock_get_instance.return_value
+        sr.journaler.getAll.return_value = {'vdi1': 'parent1',
+                                            'vdi2': 'parent2'}
+        sr.findGarbage.return_value = [FakeTreeVDI('vdi3')]
+
+        self.assertFalse(cleanup.should_preempt(None, 'sr-uuid'))
+
+        sr.findGarbage.return_value = [FakeTreeVDI('vdi3'),
+                                       FakeTreeVDI('vdi2')]
+        self.assertTrue(cleanup.should_preempt(None, 'sr-uuid'))
+        sr.journaler.getAll.assert_called_with(cleanup.VDI.JRN_COALESCE)
+
+
+class TestCountBits(unittest.TestCase):
+    BITMAPS = [
+        ('', ''),
+        ('\xff', ''),
+        ('\x01\x80', '\x02'),
+        ('\x0f', '\xf0\x00\x81'),
+        (''.join([chr(i) for i in range(256)]) * 16,
+         ''.join([chr(255 - i) for i in range(128)])),
+    ]
+
+    def check_count_bits(self):
+        for bitmap1, bitmap2 in self.BITMAPS:
+            self.assertEquals(naive_count_bits(bitmap1, bitmap2),
+                              cleanup.Util.countBits(bitmap1, bitmap2))
+
+    def test_count_bits_without_numpy(self):
+        with mock.patch('cleanup.numpy', None):
+            self.check_count_bits()
+
+    @unittest.skipIf(cleanup.numpy is None, "NumPy not available")
+    def test_count_bits_with_numpy(self):
+        self.check_count_bits()
+
+    def test_num_bits(self):
+        self.assertEquals(0, cleanup.Util.numBits(0))
+        self.assertEquals(8, cleanup.Util.numBits(255))
+        self.assertEquals(2, cleanup.Util.numBits(0x10001))
+
+
+class TestBlockBitmapCache(unittest.TestCase):
+    def create_vdi(self, sr, uuid, size, leaf=False):
+        vdi = cleanup.VDI(sr, uuid, False)
+        vdi._sizeVHD = size
+        if not leaf:
+            vdi.children = [cleanup.VDI(sr, uuid + '-child', False)]
+        vdi.getConfig = mock.Mock(
+            return_value=base64.b64encode(zlib.compress('\x03')))
+        vdi.delConfig = mock.Mock()
+        return vdi
+
+    def test_bitmap_cached_until_size_changes(self):
+        sr = create_cleanup_sr()
+        vdi = self.create_vdi(sr, 'vdi', 4096)
+
+        vdi.getVHDBlocks()
+        vdi.getVHDBlocks()
+        self.assertEquals(1, vdi.getConfig.call_count)
+
+        vdi._sizeVHD = 8192
+        vdi.getVHDBlocks()
+        self.assertEquals(2, vdi.getConfig.call_count)
+
+    def test_leaf_bitmap_not_cached(self):
+        sr = create_cleanup_sr()
+        vdi = self.create_vdi(sr, 'vdi', 4096, leaf=True)
+
+        vdi.getVHDBlocks()
+        vdi.getVHDBlocks()
+
+        self.assertEquals(2, vdi.getConfig.call_count)
+
+    def test_coalesced_size_counted_once(self):
+        sr = create_cleanup_sr()
+        parent = self.create_vdi(sr, 'parent', 4096)
+        child = self.create_vdi(sr, 'child', 4096)
+        child.parent = parent
+        child.sizeVirt = 1024 * 1024 * 1024
+
+        with mock.patch('cleanup.Util.countBits', return_value=2) as count:
+            child._getCoalescedSizeData()
+            size = child._getCoalescedSizeData()
+
+        self.assertEquals(1, count.call_count)
+        self.assertEquals(1, child.delConfig.call_count)
+        self.assertEquals(2 * cleanup.vhdutil.VHD_BLOCK_SIZE, size)
+
+    def test_read_only_sr_uses_stored_bitmap(self):
+        sr = create_cleanup_sr()
+        sr.readOnly = True
+        vdi = self.create_vdi(sr, 'vdi', 4096)
+        vdi.updateBlockInfo = mock.Mock()
+
+        self.assertEquals('\x03', vdi.getVHDBlocks(refresh=True))
+
+        self.assertEquals(0, vdi.delConfig.call_count)
+        self.assertEquals(0, vdi.updateBlockInfo.call_count)
+        vdi.getConfig.return_value = None
+        self.assertRaises(util.SMException, vdi.getVHDBlocks)
+
+    @mock.patch('cleanup.vhdutil.getSizePhys')
+    def test_read_only_sr_does_not_activate(self, mock_size):
+        sr = create_cleanup_sr()
+        sr.readOnly = True
+        parent = cleanup.LVHDVDI(sr, 'parent', False)
+        child = cleanup.LVHDVDI(sr, 'child', False)
+        child.parent = parent
+        parent.children = [child]
+        child.children = [cleanup.LVHDVDI(sr, 'leaf', False)]
+        child.sizeVirt = 1024 * 1024 * 1024
+        for vdi in parent, child:
+            vdi._activate = mock.Mock()
+            vdi.getConfig = mock.Mock(
+                return_value=base64.b64encode(zlib.compress('\x03')))
+
+        self.assertEquals('\x03', child.getVHDBlocks(refresh=True))
+        self.assertEquals(2 * cleanup.vhdutil.VHD_BLOCK_SIZE,
+                          child._getCoalescedSizeData())
+
+        self.assertFalse(parent._activate.called)
+        self.assertFalse(child._activate.called)
+        self.assertFalse(mock_size.called)
+
+    @mock.patch('cleanup.SR.getInstance')
+    def test_coalesce_plan_is_read_only(self, mock_get_instance):
+        sr = mock_get_instance.return_value
+        sr.scanLocked.side_effect = util.SMException('scan failed')
+
+        self.assertRaises(util.SMException, cleanup.get_coalesce_plan,
+                          None, 'sr-uuid')
+
+        self.assertTrue(sr.readOnly)
+        sr.cleanup.assert_called_once_with()
+
+    def test_forget(self):
+        cache = cleanup.BlockBitmapCache()
+        cache.putBitmap(('a', 1), 'x')
+        cache.putCount((('a', 1), ('b', 1)), 3)
+
+        cache.forget('b')
+
+        self.assertEquals('x', cache.getBitmap(('a', 1)))
+        self.assertEquals(None, cache.getCount((('a', 1), ('b', 1))))
+
+
+class FakeTreeVDI(object):
+    def __init__(self, uuid, root=None, height=2, space=0):
+        self.uuid = uuid
+        self.root = root or self
+        self.height = height
+        self.space = space
+        self.parent = self.root
+
+    def isCoalesceable(self):
+        return self.root is not self
+
+    def getTreeRoot(self):
+        return self.root
+
+    def getTreeHeight(self):
+        return self.height
+
+    def _getAllSubtree(self):
+        return [self]
+
+    def _calcExtraSpaceForCoalescing(self):
+        return self.space
+
+
+class TestParallelCoalesce(unittest.TestCase):
+    def create_sr(self, other_config=None, free_space=100):
+        sr = create_cleanup_sr()
+        sr.xapi.srRecord['other_config'] = other_config or {}
+        sr.journaler = mock.Mock()
+        sr.journaler.getAll.return_value = {}
+        sr.getFreeSpace = mock.Mock(return_value=free_space)
+        return sr
+
+    def add_vdis(self, sr, *vdis):
+        for vdi in vdis:
+            sr.vdis[vdi.uuid] = vdi
+
+    def test_coalesce_workers(self):
+        self.assertEquals(1, self.create_sr().getCoalesceWorkers())
+        self.assertEquals(4, self.create_sr(
+            {'coalesce-workers': '4'}).getCoalesceWorkers())
+        self.assertEquals(cleanup.SR.MAX_COALESCE_WORKERS, self.create_sr(
+            {'coalesce-workers': '1000'}).getCoalesceWorkers())
+        self.assertEquals(1, self.create_sr(
+            {'coalesce-workers': 'many'}).getCoalesceWorkers())
+
+    def test_one_candidate_per_tree(self):
+        sr = self.create_sr()
+        root1 = FakeTreeVDI('root1', height=3)
+        root2 = FakeTreeVDI('root2', height=2)
+        self.add_vdis(sr, root1, root2,
+                      FakeTreeVDI('a', root1), FakeTreeVDI('b', root1),
+                      FakeTreeVDI('c', root2))
+
+        candidates = sr.findCoalesceableMany(8)
+
+        self.assertEquals(2, len(candidates))
+        self.assertEquals(set([root1, root2]),
+                          set([c.getTreeRoot() for c in candidates]))
+        # the tallest tree comes first
+        self.assertEquals(root1, candidates[0].getTreeRoot())
+
+    def test_candidates_share_free_space(self):
+        sr = self.create_sr(free_space=100)
+        roots = [FakeTreeVDI('root%d' % i) for i in range(3)]
+        self.add_vdis(sr, *roots)
+        self.add_vdis(sr, *[FakeTreeVDI('vdi%d' % i, roots[i], space=40)
+                            for i in range(3)])
+
+        self.assertEquals(2, len(sr.findCoalesceableMany(8)))
+
+    def test_max_count(self):
+        sr = self.create_sr()
+        roots = [FakeTreeVDI('root%d' % i) for i in range(3)]
+        self.add_vdis(sr, *roots)
+        self.add_vdis(sr, *[FakeTreeVDI('vdi%d' % i, roots[i])
+                            for i in range(3)])
+
+        self.assertEquals(2, len(sr.findCoalesceableMany(2)))
+
+    def test_pending_relink_disables_parallel_coalesce(self):
+        sr = self.create_sr()
+        root = FakeTreeVDI('root')
+        self.add_vdis(sr, root, FakeTreeVDI('vdi', root))
+        sr.journaler.getAll.return_value = {'vdi': '1'}
+
+        self.assertEquals([], sr.findCoalesceableMany(8))
+
+    @mock.patch('cleanup.Util.runAbortable')
+    def test_coalesce_parallel_runs_one_worker_per_vdi(self, mock_run):
+        sr = self.create_sr()
+        vdis = [FakeTreeVDI('vdi%d' % i, FakeTreeVDI('root%d' % i))
+                for i in range(3)]
+
+        sr.coalesceParallel(vdis, False)
+
+        self.assertEquals(3, mock_run.call_count)
+        namespaces = set([c[0][2] for c in mock_run.call_args_list])
+        self.assertEquals(3, len(namespaces))
+        self.assertEquals([], sr._failedCoalesceTargets)
+
+    @mock.patch('cleanup.Util.runAbortable')
+    def test_coalesce_parallel_failures(self, mock_run):
+        sr = self.create_sr()
+        good = FakeTreeVDI('good', FakeTreeVDI('root1'))
+        bad = FakeTreeVDI('bad', FakeTreeVDI('root2'))
+
+        def run(func, ret, ns, abortTest, pollInterval, timeOut):
+            if ns.endswith('gc1'):
+                raise util.SMException("Child process exited with error")
+        mock_run.side_effect = run
+
+        sr.coalesceParallel([good, bad], False)
+
+        self.assertEquals([bad], sr._failedCoalesceTargets)
+
+    @mock.patch('cleanup.Util.runAbortable')
+    def test_coalesce_parallel_abort(self, mock_run):
+        sr = self.create_sr()
+        mock_run.side_effect = cleanup.AbortException("Aborting due to signal")
+        vdis = [FakeTreeVDI('vdi%d' % i, FakeTreeVDI('root%d' % i))
+                for i in range(2)]
+
+        self.assertRaises(cleanup.AbortException,
+                          sr.coalesceParallel, vdis, False)
+
+
+def process_gone(pid):
+    try:
+        stat = open('/proc/%d/stat' % pid).read()
+    except IOError:
+        return True
+    # reparented to an init that does not reap
+    return stat.split(')')[-1].split()[0] == 'Z'
+
+
+class TestParallelCoalesceAbort(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name, value in [('cleanup.IPCFlag.BASE_DIR', self.tmpdir),
+                            ('cleanup.Util.log', mock.MagicMock()),
+                            ('cleanup.VDI.POLL_INTERVAL', 0.1),
+                            ('cleanup._coalesceWorker', self.worker)]:
+            patcher = mock.patch(name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pidFile = os.path.join(self.tmpdir, 'pid')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def worker(self, sr, vdiUuid, rootUuid, slot):
+        # a worker coalescing through runAbortable, which does not get to
+        # notice the abort itself
+        def coalesce():
+            proc = subprocess.Popen(['sleep', '60'])
+            f = open(self.pidFile + '.tmp', 'w')
+            f.write(str(proc.pid))
+            f.close()
+            os.rename(self.pidFile + '.tmp', self.pidFile)
+            proc.wait()
+            return True
+        cleanup.Util.runAbortable(coalesce, True, 'sr-vhd%d' % slot,
+                                  lambda: False, 0.1, 0)
+        return True
+
+    def test_abort_kills_the_coalesce_of_the_worker(self):
+        sr = create_cleanup_sr()
+        sr.uuid = 'sr'
+        sr.journaler = mock.Mock()
+        vdi = FakeTreeVDI('vdi', FakeTreeVDI('root'))
+
+        def abort():
+            while not os.path.exists(self.pidFile):
+                time.sleep(0.05)
+            cleanup.IPCFlag('sr').set(cleanup.FLAG_TYPE_ABORT)
+        thread = threading.Thread(target=abort)
+        thread.start()
+
+        self.assertRaises(cleanup.AbortException,
+                          sr.coalesceParallel, [vdi], False)
+        thread.join()
+
+        pid = int(open(self.pidFile).read())
+        deadline = time.time() + 5
+        while not process_gone(pid) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(process_gone(pid))
+
+
+class TestIncrementalUpdate(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        cache_dir_patcher = mock.patch('vhdcache.CACHE_DIR',
+                                       os.path.join(self.tmpdir, 'cache'))
+        cache_dir_patcher.start()
+        self.addCleanup(cache_dir_patcher.stop)
+        log_patcher = mock.patch('cleanup.Util.log')
+        log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+
+        self.sr = cleanup.FileSR('sr', FakeXapi(), False, False)
+        self.sr.path = os.path.join(self.tmpdir, 'sr')
+        os.mkdir(self.sr.path)
+        self.sr.journaler = mock.Mock()
+        self.sr.journaler.getAll.return_value = {}
+
+        write_vhd(self.path('base'), BLOCK_SIZE, hidden=1)
+        write_vhd(self.path('leaf1'), BLOCK_SIZE, parent='./base.vhd')
+        write_vhd(self.path('leaf2'), BLOCK_SIZE, parent='./base.vhd')
+        write_vhd(self.path('other'), BLOCK_SIZE)
+        self.sr.scan()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, uuid):
+        return os.path.join(self.tmpdir, 'sr', uuid + '.vhd')
+
+    def update(self):
+        with mock.patch.object(self.sr, 'scan', wraps=self.sr.scan) as scan:
+            with mock.patch('vhdutil.getScanInfo',
+                            wraps=cleanup.vhdutil.getScanInfo) as read:
+                self.sr.update()
+        reread = [os.path.basename(c[0][0])[:-4] for c in read.call_args_list]
+        return scan.call_count, sorted(reread)
+
+    def test_first_update_is_a_full_scan(self):
+        self.sr._lastFullScan = 0
+
+        self.assertEquals(1, self.update()[0])
+
+    def test_no_changes(self):
+        self.assertEquals((0, []), self.update())
+
+    def test_logged_change_is_reloaded(self):
+        write_vhd(self.path('leaf1'), 2 * BLOCK_SIZE, parent='./base.vhd')
+        vhdcache.invalidate(self.path('leaf1'))
+
+        self.assertEquals((0, ['leaf1']), self.update())
+        self.assertEquals(2 * BLOCK_SIZE, self.sr.getVDI('leaf1').sizeVirt)
+        self.assertEquals(self.sr.getVDI('base'),
+                          self.sr.getVDI('leaf1').parent)
+        self.assertEquals(2, len(self.sr.getVDI('base').children))
+
+    def test_logged_new_vdi_is_loaded(self):
+        write_vhd(self.path('leaf3'), BLOCK_SIZE, parent='./base.vhd')
+        vhdcache.invalidate(self.path('leaf3'))
+
+        self.assertEquals((0, ['leaf3']), self.update())
+        self.assertEquals(3, len(self.sr.getVDI('base').children))
+
+    def test_touched_tree_is_reloaded(self):
+        self.sr.touch(self.sr.getVDI('leaf2'))
+
+        self.assertEquals((0, ['base', 'leaf1', 'leaf2']), self.update())
+        self.assertEquals((0, []), self.update())
+
+    def test_deleted_leaf_is_dropped(self):
+        os.unlink(self.path('leaf2'))
+
+        self.assertEquals((0, []), self.update())
+        self.assertEquals(None, self.sr.getVDI('leaf2'))
+        self.assertEquals(1, len(self.sr.getVDI('base').children))
+
+    def test_unexpected_new_vdi_forces_full_scan(self):
+        write_vhd(self.path('leaf3'), BLOCK_SIZE, parent='./base.vhd')
+
+        self.assertEquals(1, self.update()[0])
+        self.assertEquals(3, len(self.sr.getVDI('base').children))
+
+    def test_vanished_parent_forces_full_scan(self):
+        os.unlink(self.path('base'))
+        write_vhd(self.path('leaf1'), BLOCK_SIZE)
+        write_vhd(self.path('leaf2'), BLOCK_SIZE)
+
+        self.assertEquals(1, self.update()[0])
+
+    def test_periodic_full_scan(self):
+        self.sr._lastFullScan = time.time() - cleanup.SR.FULL_SCAN_INTERVAL
+
+        self.assertEquals(1, self.update()[0])
+
+    @mock.patch('cleanup.FileVDI.isCoalesceable', return_value=True)
+    @mock.patch('cleanup.lock.Lock')
+    @mock.patch('cleanup.XAPI')
+    def test_coalesce_worker_only_reloads_its_tree(self, mock_xapi, mock_lock,
+                                                   mock_coalesceable):
+        # as done by coalesceParallel before starting the workers
+        self.sr.touch(self.sr.getVDI('leaf1'))
+        self.sr.touch(self.sr.getVDI('other'))
+        gcXapi = self.sr.xapi
+        workerXapi = mock_xapi.return_value
+        coalesced = []
+
+        def coalesce(vdi, dryRun):
+            coalesced.append(vdi.uuid)
+            self.assertEquals(workerXapi, self.sr.xapi)
+        self.sr.coalesce = coalesce
+
+        with mock.patch.object(self.sr, 'scan') as scan:
+            with mock.patch('vhdutil.getScanInfo',
+                            wraps=cleanup.vhdutil.getScanInfo) as read:
+                self.assertTrue(cleanup._coalesceWorker(self.sr, 'leaf1',
+                                                        'base', 0))
+
+        self.assertFalse(scan.called)
+        reread = [os.path.basename(c[0][0])[:-4] for c in read.call_args_list]
+        self.assertEquals(['base', 'leaf1', 'leaf2'], sorted(reread))
+        self.assertEquals(['leaf1'], coalesced)
+        self.assertFalse(gcXapi.sessionPrivate)
+        mock_xapi.assert_called_once_with(None, 'sr')
+        self.assertEquals('sr-vhd0', self.sr.ipcNs)
+
+
+class FakeCostVDI(FakeTreeVDI):
+    def __init__(self, uuid, copied=0, reclaimed=0, chain=2, attached=False):
+        FakeTreeVDI.__init__(self, uuid, FakeTreeVDI('root-' + uuid))
+        self.copied = copied * cleanup.Util.PREFIX['G']
+        self.reclaimed = reclaimed * cleanup.Util.PREFIX['G']
+        self.chain = chain
+        self.attached = attached
+
+    def _getCopySizeForCoalescing(self):
+        return self.copied
+
+    def _calcSpaceReclaimedByCoalescing(self):
+        return self.reclaimed
+
+    def getChainLength(self):
+        return self.chain
+
+    def hasAttachedLeaf(self):
+        return self.attached
+
+
+class TestCoalesceScheduler(unittest.TestCase):
+    def create_sr(self, other_config):
+        sr = create_cleanup_sr()
+        sr.xapi.srRecord['other_config'] = other_config
+        return sr
+
+    def rank(self, other_config, *vdis):
+        sr = self.create_sr(other_config)
+        scheduler = cleanup.CoalesceScheduler.getInstance(sr)
+        return [vdi.uuid for score, vdi, reason in scheduler.rank(vdis)]
+
+    def test_default_is_tallest_tree_first(self):
+        low = FakeTreeVDI('low', FakeTreeVDI('root1', height=2))
+        high = FakeTreeVDI('high', FakeTreeVDI('root2', height=5))
+
+        self.assertEquals(['high', 'low'], self.rank({}, low, high))
+
+    def test_unknown_scheduler_falls_back_to_default(self):
+        sr = self.create_sr({'coalesce-scheduler': 'magic'})
+
+        scheduler = cleanup.CoalesceScheduler.getInstance(sr)
+
+        self.assertEquals(cleanup.CoalesceScheduler, scheduler.__class__)
+
+    def test_cost_prefers_more_reclaimed_per_byte_copied(self):
+        cheap = FakeCostVDI('cheap', copied=1, reclaimed=4)
+        costly = FakeCostVDI('costly', copied=8, reclaimed=4)
+
+        self.assertEquals(['cheap', 'costly'],
+                          self.rank({'coalesce-scheduler': 'cost'},
+                                    costly, cheap))
+
+    def test_cost_deep_chain_is_urgent(self):
+        shallow = FakeCostVDI('shallow', copied=1, reclaimed=1, chain=3)
+        deep = FakeCostVDI('deep', copied=1, reclaimed=1,
+                           chain=cleanup.vhdutil.MAX_CHAIN_SIZE - 1)
+
+        self.assertEquals(['deep', 'shallow'],
+                          self.rank({'coalesce-scheduler': 'cost'},
+                                    shallow, deep))
+
+    def test_cost_attached_penalty(self):
+        attached = FakeCostVDI('attached', reclaimed=2, attached=True)
+        detached = FakeCostVDI('detached', reclaimed=2)
+
+        self.assertEquals(['detached', 'attached'],
+                          self.rank({'coalesce-scheduler': 'cost'},
+                                    attached, detached))
+
+    def test_cost_weights(self):
+        sr = self.create_sr({'coalesce-scheduler': 'cost',
+                             'coalesce-scheduler-weights':
+                             'depth=0, copy=2,bogus=3,reclaim=x'})
+
+        weights = cleanup.CoalesceScheduler.getInstance(sr).weights
+
+        self.assertEquals(0, weights['depth'])
+        self.assertEquals(2, weights['copy'])
+        self.assertEquals(1, weights['reclaim'])
+        self.assertFalse('bogus' in weights)
+
+    @mock.patch('cleanup.Util.log')
+    def test_cost_estimate_failure_ranks_last(self, mock_log):
+        good = FakeCostVDI('good', reclaimed=1)
+        bad = FakeCostVDI('bad', reclaimed=1)
+        bad.hasAttachedLeaf = mock.Mock(
+            side_effect=util.SMException('no XAPI'))
+
+        self.assertEquals(['good', 'bad'],
+                          self.rank({'coalesce-scheduler': 'cost'},
+                                    bad, good))
+
+
+class TestIOThrottle(unittest.TestCase):
+    def throttle(self, nbytes, nops, elapsed, **kwargs):
+        throttle = cleanup.IOThrottle(**kwargs)
+        throttle.startTime = time.time() - elapsed
+
+        def sample(pgid):
+            throttle.bytes, throttle.ops = nbytes, nops
+        throttle.sample = sample
+        return throttle
+
+    @mock.patch('cleanup.time.sleep')
+    @mock.patch('cleanup.os.killpg')
+    def test_within_budget(self, mock_killpg, mock_sleep):
+        throttle = self.throttle(10 * 1024 * 1024, 10, 10,
+                                 maxBytesPerSec=2 * 1024 * 1024)
+
+        throttle.pace(123, 1)
+
+        self.assertEquals(0, mock_killpg.call_count)
+
+    @mock.patch('cleanup.time.sleep')
+    @mock.patch('cleanup.os.killpg')
+    def test_over_bandwidth_stops_group(self, mock_killpg, mock_sleep):
+        throttle = self.throttle(100 * 1024 * 1024, 10, 10,
+                                 maxBytesPerSec=2 * 1024 * 1024)
+
+        throttle.pace(123, 1)
+
+        self.assertEquals([mock.call(123, cleanup.signal.SIGSTOP),
+                           mock.call(123, cleanup.signal.SIGCONT)],
+                          mock_killpg.call_args_list)
+        self.assertEquals(1, mock_sleep.call_args[0][0])
+        self.assertEquals(1, throttle.stoppedTime)
+
+    @mock.patch('cleanup.time.sleep')
+    @mock.patch('cleanup.os.killpg')
+    def test_over_iops(self, mock_killpg, mock_sleep):
+        throttle = self.throttle(0, 1050, 10, maxOpsPerSec=100)
+
+        throttle.pace(123, 1)
+
+        self.assertEquals(2, mock_killpg.call_count)
+        self.assertTrue(0.4 < mock_sleep.call_args[0][0] <= 0.5)
+
+    def test_sample_accounts_process_group(self):
+        throttle = cleanup.IOThrottle(1)
+
+        throttle.sample(os.getpgrp())
+        first = throttle.bytes
+        fd = os.open('/dev/zero', os.O_RDONLY)
+        os.read(fd, 4096)
+        os.close(fd)
+        throttle.sample(os.getpgrp())
+
+        self.assertTrue(first > 0)
+        self.assertTrue(throttle.bytes - first >= 4096)
+
+
+class TestGCLimits(unittest.TestCase):
+    def create_sr(self, other_config):
+        sr = create_cleanup_sr()
+        sr.xapi.srRecord['other_config'] = other_config
+        return sr
+
+    def delay(self, windows, hour, minute):
+        sr = self.create_sr({'gc-windows': windows})
+        now = time.struct_time((2020, 1, 1, hour, minute, 0, 2, 1, -1))
+        return sr.getGCWindowDelay(now)
+
+    def test_no_windows(self):
+        self.assertEquals(0, self.create_sr({}).getGCWindowDelay())
+
+    def test_inside_window(self):
+        self.assertEquals(0, self.delay('09:00-17:00', 12, 0))
+
+    def test_before_window(self):
+        self.assertEquals(3600, self.delay('09:00-17:00', 8, 0))
+
+    def test_window_across_midnight(self):
+        self.assertEquals(0, self.delay('22:00-06:00', 23, 0))
+        self.assertEquals(0, self.delay('22:00-06:00', 5, 59))
+        self.assertEquals(16 * 3600, self.delay('22:00-06:00', 6, 0))
+
+    def test_nearest_window(self):
+        self.assertEquals(30 * 60,
+                          self.delay('22:00-06:00,12:00-13:00', 11, 30))
+
+    @mock.patch('cleanup.Util.log')
+    def test_invalid_windows_are_ignored(self, mock_log):
+        self.assertEquals(0, self.delay('25:00-26:00,nonsense', 11, 30))
+
+    @mock.patch('cleanup.Util.log')
+    def test_throttle_config(self, mock_log):
+        self.assertEquals(None, self.create_sr({}).getCoalesceThrottle())
+
+        throttle = self.create_sr({'coalesce-rate-limit': '20',
+                                   'coalesce-iops-limit': 'x'}
+                                  ).getCoalesceThrottle()
+
+        self.assertEquals(20 * 1024 * 1024, throttle.maxBytesPerSec)
+        self.assertEquals(0, throttle.maxOpsPerSec)
+
+
+class FakeProgressVDI(object):
+    def __init__(self, uuid, parent=None, copySize=0):
+        self.uuid = uuid
+        self.parent = parent
+        self.sr = mock.MagicMock()
+        self.sr.uuid = 'sr-uuid'
+        self.copySize = copySize
+
+    def _getCopySizeForCoalescing(self):
+        return self.copySize
+
+
+class TestCoalesceProgress(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        state_dir_patcher = mock.patch('cleanup.GC_STATE_DIR', self.tmpdir)
+        state_dir_patcher.start()
+        self.addCleanup(state_dir_patcher.stop)
+        get_state_patcher = mock.patch('cleanup.get_state')
+        get_state_patcher.start().return_value = True
+        self.addCleanup(get_state_patcher.stop)
+
+        base = FakeProgressVDI('base')
+        middle = FakeProgressVDI('middle', base)
+        self.vdi = FakeProgressVDI('leaf', middle,
+                                   10 * cleanup.vhdutil.VHD_BLOCK_SIZE)
+        self.stats = cleanup.IOStats()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_update_publishes_progress(self):
+        progress = cleanup.CoalesceProgress(self.vdi, self.stats)
+        progress.startTime -= 10
+        self.stats.writeBytes = 4 * cleanup.vhdutil.VHD_BLOCK_SIZE
+
+        progress.update()
+
+        state = cleanup.get_progress('sr-uuid')
+        entry = state['coalesce']['leaf']
+        self.assertTrue(state['running'])
+        self.assertEquals('middle', entry['parent'])
+        self.assertEquals(['middle', 'base'], entry['chain'])
+        self.assertEquals(4 * cleanup.vhdutil.VHD_BLOCK_SIZE,
+                          entry['bytes_done'])
+        self.assertEquals(6, entry['blocks_remaining'])
+        self.assertTrue(14 <= entry['eta'] <= 15)
+
+    def test_updates_are_rate_limited(self):
+        progress = cleanup.CoalesceProgress(self.vdi, self.stats)
+        progress.update()
+        self.stats.writeBytes = cleanup.vhdutil.VHD_BLOCK_SIZE
+
+        progress.update()
+
+        entry = cleanup.get_progress('sr-uuid')['coalesce']['leaf']
+        self.assertEquals(0, entry['bytes_done'])
+        self.assertEquals(None, entry['eta'])
+
+    def test_finish_updates_totals(self):
+        progress = cleanup.CoalesceProgress(self.vdi, self.stats)
+        progress.update()
+        self.stats.writeBytes = 12 * cleanup.vhdutil.VHD_BLOCK_SIZE
+
+        progress.finish(True)
+        cleanup.CoalesceProgress(self.vdi, cleanup.IOStats()).finish(False)
+
+        state = cleanup.get_progress('sr-uuid')
+        self.assertEquals({}, state['coalesce'])
+        self.assertEquals((1, 1), (state['totals']['coalesced'],
+                                   state['totals']['failed']))
+        self.assertEquals(12 * cleanup.vhdutil.VHD_BLOCK_SIZE,
+                          state['totals']['bytes'])
+        self.assertEquals(False, state['last']['success'])
+
+    @mock.patch('cleanup.Util.isAlive')
+    def test_entries_of_dead_processes_are_dropped(self, mock_alive):
+        cleanup.CoalesceProgress(self.vdi, self.stats).update()
+        mock_alive.return_value = False
+
+        self.assertEquals({}, cleanup.get_progress('sr-uuid')['coalesce'])
+
+    @mock.patch('cleanup.Util.log')
+    def test_corrupt_state_is_discarded(self, mock_log):
+        f = open(os.path.join(self.tmpdir, 'sr-uuid'), 'w')
+        f.write('garbage')
+        f.close()
+
+        cleanup.CoalesceProgress(self.vdi, self.stats).finish(True)
+
+        self.assertEquals(1, cleanup.get_progress('sr-uuid')['totals'][
+            'coalesced'])
+
+    @mock.patch('cleanup.Util.log')
+    @mock.patch('cleanup.Util.runAbortable')
+    def test_coalesce_vhd_publishes_progress(self, mock_run, mock_log):
+        self.vdi.sr.ipcNs = 'sr-uuid'
+        published = []
+
+        def run(func, ret, ns, abortTest, pollInterval, timeOut, monitor):
+            monitor(os.getpgrp())
+            published.append(cleanup.get_progress('sr-uuid')['coalesce'])
+        mock_run.side_effect = run
+
+        cleanup.VDI._coalesceVHD.im_func(self.vdi, 0)
+
+        self.assertEquals(['leaf'], published[0].keys())
+        self.assertEquals(1, cleanup.get_progress('sr-uuid')['totals'][
+            'coalesced'])
+
+
+class FakeEvent(object):
+    """Scripted IPCEvent: every wait() returns the next (seconds, codes)
+    pair, or times out once the script is exhausted"""
+    def __init__(self, clock, script):
+        self.clock = clock
+        self.script = list(script)
+        self.timeouts = []
+
+    def wait(self, timeout):
+        self.timeouts.append(timeout)
+        if self.script:
+            seconds, codes = self.script.pop(0)
+            self.clock[0] += seconds
+            return codes
+        self.clock[0] += timeout
+        return ''
+
+
+class TestQuietPeriod(unittest.TestCase):
+    def setUp(self):
+        self.clock = [1000.0]
+        time_patcher = mock.patch('cleanup.time.time')
+        time_patcher.start().side_effect = lambda: self.clock[0]
+        self.addCleanup(time_patcher.stop)
+
+    def test_idle_sr_waits_minimum(self):
+        event = FakeEvent(self.clock, [])
+
+        self.assertTrue(cleanup.QuietPeriod(event).wait())
+
+        self.assertEquals(1020.0, self.clock[0])
+
+    def test_sr_operations_extend_quiet_period(self):
+        event = FakeEvent(self.clock, [(5, 'o'), (5, 'oo')])
+
+        self.assertTrue(cleanup.QuietPeriod(event).wait())
+
+        # 4 operations in the window: quiet for 10 + 4 * 10 seconds after the
+        # last one
+        self.assertEquals(1010.0 + 50, self.clock[0])
+
+    def test_quiet_period_is_capped(self):
+        event = FakeEvent(self.clock, [(1, 'o' * 100)])
+
+        self.assertTrue(cleanup.QuietPeriod(event).wait())
+
+        self.assertEquals(1001.0 + cleanup.QuietPeriod.MAX_LENGTH,
+                          self.clock[0])
+
+    def test_abort_ends_quiet_period(self):
+        event = FakeEvent(self.clock, [(1, 'a')])
+
+        self.assertFalse(cleanup.QuietPeriod(event).wait())
+
+        self.assertEquals(1001.0, self.clock[0])
+
+
+class TestGCLoop(unittest.TestCase):
+    def setUp(self):
+        self.quiet = mock.MagicMock()
+        self.quiet.return_value.wait.return_value = True
+        for name, value in [('cleanup.lockActive', mock.MagicMock()),
+                            ('cleanup.lockRunning', mock.MagicMock()),
+                            ('cleanup.IPCEvent', mock.MagicMock()),
+                            ('cleanup.QuietPeriod', self.quiet),
+                            ('cleanup.Util.log', mock.MagicMock())]:
+            patcher = mock.patch(name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.sr = mock.MagicMock()
+        self.sr.hasWork.return_value = True
+
+    def test_abort_during_quiet_period(self):
+        self.quiet.return_value.wait.return_value = False
+
+        cleanup._gcLoop(self.sr, False)
+
+        self.assertEquals([], self.sr.method_calls)
+        cleanup.lockActive.release.assert_called_once_with()
+
+    def test_sr_record_refreshed_before_time_windows(self):
+        self.sr.gcEnabled.side_effect = [True, False]
+        self.sr.getGCWindowDelay.return_value = 60
+        cleanup.IPCEvent.return_value.wait.return_value = ''
+
+        cleanup._gcLoop(self.sr, False)
+
+        self.assertEquals(
+            ['gcEnabled', 'getGCWindowDelay', 'gcEnabled'],
+            [c[0] for c in self.sr.method_calls
+             if c[0] in ['gcEnabled', 'getGCWindowDelay']])
+
+
+class TestRunAbortable(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        base_dir_patcher = mock.patch('cleanup.IPCFlag.BASE_DIR', self.tmpdir)
+        base_dir_patcher.start()
+        self.addCleanup(base_dir_patcher.stop)
+        log_patcher = mock.patch('cleanup.Util.log')
+        log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_abortable(self, func, abortTest=lambda: False):
+        return cleanup.Util.runAbortable(func, True, 'ns', abortTest, 60, 0)
+
+    def test_completion_does_not_wait_for_poll(self):
+        start = time.time()
+
+        self.run_abortable(lambda: True)
+
+        self.assertTrue(time.time() - start < 30)
+
+    def test_failure(self):
+        self.assertRaises(util.SMException, self.run_abortable, lambda: False)
+
+    def test_exit_without_result(self):
+        self.assertRaises(util.SMException, self.run_abortable,
+                          lambda: os._exit(1))
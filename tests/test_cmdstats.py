@@ -0,0 +1,53 @@
+import unittest
+import mock
+import os
+import shutil
+import tempfile
+
+import cmdstats
+import statsring
+
+
+class TestCmdStats(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        ring = cmdstats._ring
+        ring = statsring.StatsRing(os.path.join(self.tmpdir, 'stats'),
+                                   ring.magic, ring.recordFormat, ring.fields,
+                                   ring.numRecords)
+        patcher = mock.patch('cmdstats._ring', ring)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_record_and_read(self):
+        cmdstats.record('vhd-util', 100.0, 0.5, 22)
+
+        records = cmdstats.read()
+
+        self.assertEquals(1, len(records))
+        rec = records[0]
+        self.assertEquals(('vhd-util', 100.0, 0.5, 22, os.getpid()),
+                          (rec['binary'], rec['time'], rec['duration'],
+                           rec['rc'], rec['pid']))
+
+    def test_summarize(self):
+        for i in range(1, 101):
+            cmdstats.record('lvchange', 0, (i - 0.5) / 100,
+                            i % 10 == 0 and 5 or 0)
+        cmdstats.record('tap-ctl', 0, 0.001, 0)
+
+        summary = cmdstats.summarize(cmdstats.read())
+
+        self.assertEquals(['lvchange', 'tap-ctl'],
+                          [s['binary'] for s in summary])
+        lvchange = summary[0]
+        self.assertEquals(100, lvchange['count'])
+        self.assertEquals(10, lvchange['failed'])
+        self.assertEquals({0: 90, 5: 10}, lvchange['rcs'])
+        self.assertAlmostEquals(0.495, lvchange['p50'], 5)
+        self.assertAlmostEquals(0.995, lvchange['max'], 5)
+        self.assertEquals([1, 9, 90, 0, 0, 0], lvchange['histogram'])
+        self.assertEquals([1, 0, 0, 0, 0, 0], summary[1]['histogram'])
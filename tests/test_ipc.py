@@ -0,0 +1,50 @@
+import unittest
+import mock
+import shutil
+import tempfile
+import time
+
+import ipc
+
+
+class TestIPCEvent(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        base_dir_patcher = mock.patch('ipc.IPCEvent.BASE_DIR', self.tmpdir)
+        base_dir_patcher.start()
+        self.addCleanup(base_dir_patcher.stop)
+        self.event = ipc.IPCEvent('ns', 'event')
+        self.addCleanup(self.event.close)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_notify_without_listener(self):
+        self.assertFalse(self.event.notify('x'))
+
+    def test_notifications_wake_up_listener(self):
+        self.event.listen()
+
+        self.assertTrue(ipc.IPCEvent('ns', 'event').notify('a'))
+        self.assertTrue(ipc.IPCEvent('ns', 'event').notify('b'))
+
+        self.assertEquals('ab', self.event.wait(10))
+
+    def test_wait_times_out(self):
+        self.event.listen()
+        start = time.time()
+
+        self.assertEquals('', self.event.wait(0.1))
+        self.assertTrue(time.time() - start >= 0.1)
+
+    def test_notifications_after_close_are_dropped(self):
+        self.event.listen()
+        self.event.close()
+
+        self.assertFalse(self.event.notify('x'))
+
+    @mock.patch('ipc.time.sleep')
+    def test_wait_without_listen_sleeps(self, mock_sleep):
+        self.assertEquals('', self.event.wait(5))
+
+        mock_sleep.assert_called_once_with(5)
@@ -3,6 +3,8 @@ import mock
 import os
 import gc
 import errno
+import shutil
+import tempfile
 
 import testlib
 
@@ -57,6 +59,157 @@ class TestLock(unittest.TestCase):
                 os.path.join(lck.BASE_DIR, 'namespace', 'somename')))
 
 
+class TestLockSet(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name, value in [('lock.Lock.BASE_DIR', self.tmpdir),
+                            ('lock.LockSet._locks', {}),
+                            ('lock.LockSet._lru', []),
+                            ('lock.util.SMlog', mock.MagicMock())]:
+            patcher = mock.patch(name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def cached(self, name, ns='ns'):
+        return lock.LockSet._locks[(ns, name)]
+
+    def test_acquired_in_order_and_released_in_reverse(self):
+        locks = lock.LockSet(['c', 'a', 'b', 'a'], 'ns')
+        self.assertEquals(['a', 'b', 'c'], locks.names)
+
+        self.assertTrue(locks.acquire())
+        self.assertEquals(['a', 'b', 'c'], [l.name for l in locks.held])
+        released = []
+        for name in locks.names:
+            self.cached(name).lock.unlock = \
+                lambda name=name: released.append(name)
+
+        locks.release()
+
+        self.assertEquals(['c', 'b', 'a'], released)
+        self.assertEquals([], locks.held)
+
+    def test_lock_files_are_reused(self):
+        locks = lock.LockSet(['a', 'b'], 'ns')
+        locks.acquire()
+        locks.release()
+        first = self.cached('a')
+
+        with mock.patch('lock.Lock._open') as mock_open:
+            locks = lock.LockSet(['a'], 'ns')
+            locks.acquire()
+            locks.release()
+
+        self.assertEquals(0, mock_open.call_count)
+        self.assertTrue(first is self.cached('a'))
+
+    def test_removed_lock_file_is_reopened(self):
+        locks = lock.LockSet(['a'], 'ns')
+        locks.acquire()
+        locks.release()
+        first = self.cached('a')
+
+        lock.Lock.cleanup('a', 'ns')
+        locks.acquire()
+
+        self.assertFalse(first is self.cached('a'))
+        self.assertTrue(os.path.exists(self.cached('a').lockpath))
+        locks.release()
+
+    @mock.patch('lock.LockSet.MAX_CACHED', 2)
+    def test_least_recently_used_lock_files_are_closed(self):
+        held = lock.LockSet(['a'], 'ns')
+        held.acquire()
+        for name in ['b', 'c', 'b', 'd']:
+            locks = lock.LockSet([name], 'ns')
+            locks.acquire()
+            locks.release()
+        closed = self.cached('a').lockfile
+
+        self.assertEquals(['a', 'd'], sorted(
+            [name for ns, name in lock.LockSet._locks.keys()]))
+        self.assertTrue(self.cached('a').held())
+        self.assertFalse(closed.closed)
+        held.release()
+
+        locks = lock.LockSet(['e'], 'ns')
+        locks.acquire()
+        locks.release()
+
+        self.assertEquals(['d', 'e'], sorted(
+            [name for ns, name in lock.LockSet._locks.keys()]))
+        self.assertTrue(closed.closed)
+
+    def test_timeout_backs_off_with_nothing_held(self):
+        locks = lock.LockSet(['a', 'b'], 'ns')
+        locks.acquire()
+        locks.release()
+        self.cached('b').lock = mock.MagicMock()
+        self.cached('b').lock.held.return_value = False
+        self.cached('b').lock.trylock.return_value = False
+
+        self.assertFalse(locks.acquire(timeout=0.05))
+
+        self.assertEquals([], locks.held)
+        self.assertFalse(self.cached('a').held())
+        self.assertTrue(self.cached('b').lock.trylock.call_count > 1)
+
+
+class TestSharedLock(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name, value in [('lock.Lock.BASE_DIR', self.tmpdir),
+                            ('lock.util.SMlog', mock.MagicMock())]:
+            patcher = mock.patch(name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def try_in_child(self, shared):
+        """Whether another process can take the lock right now"""
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                if lock.Lock('sr', 'ns')._trylock(shared):
+                    status = 0
+            finally:
+                os._exit(status)
+        return os.waitpid(pid, 0)[1] == 0
+
+    def test_shared_holders_exclude_exclusive_only(self):
+        lck = lock.Lock('sr', 'ns')
+
+        lck.acquireShared()
+
+        self.assertTrue(lck.held())
+        self.assertTrue(self.try_in_child(True))
+        self.assertFalse(self.try_in_child(False))
+        lck.release()
+
+    def test_exclusive_holder_excludes_shared(self):
+        lck = lock.Lock('sr', 'ns')
+
+        lck.acquire()
+
+        self.assertFalse(self.try_in_child(True))
+        lck.release()
+
+    def test_release_of_shared_lock(self):
+        lck = lock.Lock('sr', 'ns')
+        lck.acquireShared()
+
+        lck.release()
+
+        self.assertFalse(lck.held())
+        self.assertTrue(self.try_in_child(False))
+
+
 def create_lock_class_that_fails_to_create_file(number_of_failures):
 
     class LockThatFailsToCreateFile(lock.Lock):
@@ -0,0 +1,90 @@
+import unittest
+import mock
+import os
+import shutil
+import tempfile
+
+import lock
+import lockstats
+import statsring
+
+
+class TestLockStats(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        ring = lockstats._ring
+        ring = statsring.StatsRing(os.path.join(self.tmpdir, 'stats'),
+                                   ring.magic, ring.recordFormat, ring.fields,
+                                   ring.numRecords)
+        patcher = mock.patch('lockstats._ring', ring)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_record_and_read(self):
+        lockstats.record('sr-uuid', 'sr', 100.0, 0.5, 2.0, 1234, 'tap-ctl')
+
+        records = lockstats.read()
+
+        self.assertEquals(1, len(records))
+        rec = records[0]
+        self.assertEquals(('sr-uuid', 'sr', 100.0, 0.5, 2.0, 1234, 'tap-ctl',
+                           os.getpid()),
+                          (rec['ns'], rec['name'], rec['time'], rec['wait'],
+                           rec['hold'], rec['holder'], rec['holderCommand'],
+                           rec['pid']))
+
+    def test_summarize(self):
+        for wait in range(1, 101):
+            lockstats.record('sr-uuid', 'sr', 0, wait, 1, 42, 'SMlog')
+        lockstats.record('other', 'x', 0, 0, 0)
+
+        summary = lockstats.summarize(lockstats.read())
+
+        self.assertEquals(['sr-uuid', 'other'], [s['ns'] for s in summary])
+        self.assertEquals(100, summary[0]['count'])
+        self.assertEquals(100, summary[0]['contended'])
+        self.assertEquals(50, summary[0]['wait50'])
+        self.assertEquals(99, summary[0]['wait99'])
+        self.assertEquals(100, summary[0]['maxWait'])
+        self.assertEquals({'SMlog': 100}, summary[0]['holders'])
+        self.assertEquals(0, summary[1]['contended'])
+
+
+class TestLockInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name, value in [('lock.Lock.BASE_DIR', self.tmpdir),
+                            ('lock.util.SMlog', mock.MagicMock())]:
+            patcher = mock.patch(name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        record_patcher = mock.patch('lockstats.record')
+        self.record = record_patcher.start()
+        self.addCleanup(record_patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('lock.LOCK_STATS', True)
+    def test_release_records_acquisition(self):
+        lck = lock.Lock('sr', 'sr-uuid')
+        lck.acquire()
+
+        lck.release()
+
+        self.assertEquals(1, self.record.call_count)
+        args = self.record.call_args[0]
+        self.assertEquals(('sr-uuid', 'sr'), args[:2])
+        self.assertEquals(0, args[3])
+
+    @mock.patch('lock.LOCK_STATS', False)
+    def test_nothing_recorded_when_disabled(self):
+        lck = lock.Lock('sr', 'sr-uuid')
+        lck.acquire()
+
+        lck.release()
+
+        self.assertEquals(0, self.record.call_count)
@@ -0,0 +1,316 @@
+import unittest
+import mock
+import os
+import shutil
+import tempfile
+
+import lvmcache
+import util
+
+
+VG_NAME = 'VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7'
+
+
+class FakeRefCounter(object):
+    def __init__(self):
+        self.counts = {}
+
+    def get(self, ref, binary, ns):
+        self.counts[ref] = self.counts.get(ref, 0) + 1
+        return self.counts[ref]
+
+    def put(self, ref, binary, ns):
+        self.counts[ref] = self.counts.get(ref, 0) - 1
+        return self.counts[ref]
+
+    def getMany(self, refs, ns):
+        return [self.get(ref, binary, ns) for ref, binary in refs]
+
+    def putMany(self, refs, ns):
+        return [self.put(ref, binary, ns) for ref, binary in refs]
+
+
+class TestActivateMany(unittest.TestCase):
+    def setUp(self):
+        self.refcounter = FakeRefCounter()
+        for name, value in [('lvmcache.RefCounter', self.refcounter),
+                            ('lvmcache.LockSet', mock.MagicMock())]:
+            patcher = mock.patch(name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        lvutil_patcher = mock.patch('lvmcache.lvutil')
+        self.lvutil = lvutil_patcher.start()
+        self.addCleanup(lvutil_patcher.stop)
+
+        self.cache = lvmcache.LVMCache(VG_NAME)
+        self.cache.initialized = True
+        for name in ['lv1', 'lv2', 'lv3']:
+            self.cache.lvs[name] = lvmcache.LVInfo(name)
+        self.lvs = [('uuid1', 'lv1', False), ('uuid2', 'lv2', False),
+                    ('uuid3', 'lv3', True)]
+
+    def path(self, name):
+        return '/dev/%s/%s' % (VG_NAME, name)
+
+    def test_activate_many_uses_one_command(self):
+        self.refcounter.counts['uuid2'] = 1
+
+        self.cache.activateMany('ns', self.lvs)
+
+        self.lvutil.activateManyNoRefcount.assert_called_once_with(
+            [self.path('lv1'), self.path('lv3')])
+        self.assertTrue(self.cache.lvs['lv1'].active)
+        self.assertFalse(self.cache.lvs['lv2'].active)
+        self.assertEquals({'uuid1': 1, 'uuid2': 2, 'uuid3': 1},
+                          self.refcounter.counts)
+
+    def test_activate_many_failure_reverts_refcounts(self):
+        self.lvutil.activateManyNoRefcount.side_effect = \
+            util.CommandException(5)
+
+        self.assertRaises(util.CommandException, self.cache.activateMany,
+                          'ns', self.lvs)
+
+        self.assertEquals({'uuid1': 0, 'uuid2': 0, 'uuid3': 0},
+                          self.refcounter.counts)
+        self.assertFalse(self.cache.lvs['lv1'].active)
+
+    @mock.patch('lvmcache.util.SMlog')
+    def test_stale_cache_keeps_refcounts(self, mock_log):
+        del self.cache.lvs['lv3']
+        self.cache.refresh = mock.MagicMock()
+
+        self.cache.activateMany('ns', self.lvs)
+
+        self.assertEquals({'uuid1': 1, 'uuid2': 1, 'uuid3': 1},
+                          self.refcounter.counts)
+        self.assertEquals(1, self.cache.refresh.call_count)
+
+    def test_locks_are_taken_as_a_set(self):
+        self.cache.activateMany('ns', self.lvs)
+
+        lvmcache.LockSet.assert_called_once_with(['uuid1', 'uuid2', 'uuid3'],
+                                                 'ns')
+        lvmcache.LockSet.return_value.acquire.assert_called_once_with()
+        lvmcache.LockSet.return_value.release.assert_called_once_with()
+
+    def test_deactivate_many_uses_one_command(self):
+        self.refcounter.counts = {'uuid1': 1, 'uuid2': 2, 'uuid3': 1}
+
+        failed = self.cache.deactivateMany('ns', self.lvs)
+
+        self.assertEquals([], failed)
+        self.lvutil.deactivateManyNoRefcount.assert_called_once_with(
+            [self.path('lv1'), self.path('lv3')])
+
+    @mock.patch('lvmcache.util.SMlog')
+    @mock.patch('lvmcache.util.logException')
+    def test_deactivate_many_falls_back_to_one_by_one(self, mock_log_exc,
+                                                      mock_log):
+        self.refcounter.counts = {'uuid1': 1, 'uuid2': 1, 'uuid3': 1}
+        for lvInfo in self.cache.lvs.values():
+            lvInfo.active = True
+        self.lvutil.deactivateManyNoRefcount.side_effect = \
+            util.CommandException(5)
+
+        def deactivate(path):
+            if path.endswith('lv2'):
+                raise util.CommandException(5)
+        self.lvutil.deactivateNoRefcount.side_effect = deactivate
+        self.cache.refresh = mock.MagicMock()
+
+        failed = self.cache.deactivateMany('ns', self.lvs)
+
+        self.assertEquals(['uuid2'], failed)
+        self.assertEquals(1, self.refcounter.counts['uuid2'])
+        self.assertEquals(3, self.lvutil.deactivateNoRefcount.call_count)
+
+
+LVS_OUTPUT = """\
+  lv1:-wi-ao----:8388608:10:hidden
+  lv2:-ri-------:4194304:10:
+"""
+
+DMSETUP_OUTPUT = """\
+VG_XenStorage--b3b18d06--b2ba--5b67--f098--3cdd5087a2a7-lv1:1
+"""
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        patcher = mock.patch('lvmcache.SNAPSHOT_DIR', self.tmpdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        lvutil_patcher = mock.patch('lvmcache.lvutil')
+        self.lvutil = lvutil_patcher.start()
+        self.addCleanup(lvutil_patcher.stop)
+        self.lvutil.getVGSeqno.return_value = 10
+        self.lvutil.cmd_lvm.return_value = LVS_OUTPUT
+        pread_patcher = mock.patch('lvmcache.util.pread2')
+        self.pread = pread_patcher.start()
+        self.addCleanup(pread_patcher.stop)
+        self.pread.return_value = DMSETUP_OUTPUT
+        log_patcher = mock.patch('lvmcache.util.SMlog')
+        log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self):
+        cache = lvmcache.LVMCache(VG_NAME)
+        cache.refresh()
+        return cache
+
+    def test_valid_snapshot_skips_lvs(self):
+        self.load()
+        self.pread.return_value = ''
+
+        cache = self.load()
+
+        self.assertEquals(1, self.lvutil.cmd_lvm.call_count)
+        # only checked against the snapshot, not before the first lvs
+        self.assertEquals(1, self.lvutil.getVGSeqno.call_count)
+        self.assertEquals(8388608, cache.getSize('lv1'))
+        self.assertEquals(['lv1'], cache.getTagged('hidden'))
+        self.assertTrue(cache.checkLV('lv2'))
+        self.assertTrue(cache.lvs['lv2'].readonly)
+        # the activation state comes from device-mapper
+        self.assertFalse(cache.lvs['lv1'].active)
+
+    def test_activation_state_from_device_mapper(self):
+        self.load()
+
+        cache = self.load()
+
+        self.assertTrue(cache.lvs['lv1'].active)
+        self.assertEquals(1, cache.lvs['lv1'].open)
+        self.assertFalse(cache.lvs['lv2'].active)
+
+    def test_seqno_change_runs_lvs(self):
+        self.load()
+        self.lvutil.getVGSeqno.return_value = 11
+
+        self.load()
+
+        self.assertEquals(2, self.lvutil.cmd_lvm.call_count)
+
+    def test_write_through(self):
+        cache = self.load()
+        self.lvutil.getVGSeqno.return_value = 11
+
+        cache.create('lv3', 2097152)
+        self.assertEquals(0, self.lvutil.getVGSeqno.call_count)
+        cache = self.load()
+
+        self.assertEquals(1, self.lvutil.cmd_lvm.call_count)
+        self.assertEquals(2097152, cache.getSize('lv3'))
+
+    def test_unchanged_tag_is_not_written_through(self):
+        self.lvutil.LV_TAG_HIDDEN = 'hidden'
+        cache = self.load()
+
+        cache.setHidden('lv1')
+        cache.create('lv3', 2097152)
+        self.lvutil.getVGSeqno.return_value = 11
+        cache = self.load()
+
+        self.assertEquals(2, self.lvutil.cmd_lvm.call_count)
+
+    def test_concurrent_change_is_not_written_through(self):
+        cache = self.load()
+        self.lvutil.getVGSeqno.return_value = 12
+
+        cache.remove('lv2')
+        self.load()
+
+        self.assertEquals(2, self.lvutil.cmd_lvm.call_count)
+
+    def test_corrupt_snapshot_runs_lvs(self):
+        self.load()
+        f = open(os.path.join(self.tmpdir, VG_NAME), 'w')
+        f.write('garbage')
+        f.close()
+
+        cache = self.load()
+
+        self.assertEquals(2, self.lvutil.cmd_lvm.call_count)
+        self.assertEquals(4194304, cache.getSize('lv2'))
+
+    @mock.patch.dict('os.environ', {'THIN_STATE_FILE_ATTACH': 'true'})
+    def test_no_snapshot_offline(self):
+        self.load()
+        self.load()
+
+        self.assertEquals(2, self.lvutil.cmd_lvm.call_count)
+        self.assertEquals([], os.listdir(self.tmpdir))
+
+
+class TestRefresh(unittest.TestCase):
+    def setUp(self):
+        lvutil_patcher = mock.patch('lvmcache.lvutil')
+        self.lvutil = lvutil_patcher.start()
+        self.addCleanup(lvutil_patcher.stop)
+        self.lvutil.getVGSeqno.return_value = None
+        log_patcher = mock.patch('lvmcache.util.SMlog')
+        log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+        self.cache = lvmcache.LVMCache(VG_NAME)
+
+    def refresh(self, output):
+        self.lvutil.cmd_lvm.return_value = output
+        self.cache.refresh()
+
+    def test_selected_columns(self):
+        self.refresh(LVS_OUTPUT)
+
+        cmd = self.lvutil.cmd_lvm.call_args[0][0]
+        self.assertEquals('lv_name,lv_attr,lv_size,vg_seq_no,lv_tags',
+                          cmd[cmd.index('-o') + 1])
+        lv1 = self.cache.lvs['lv1']
+        self.assertEquals((8388608, True, 1, False, ['hidden']),
+                          (lv1.size, lv1.active, lv1.open, lv1.readonly,
+                           lv1.tags))
+        lv2 = self.cache.lvs['lv2']
+        self.assertEquals((False, 0, True, []),
+                          (lv2.active, lv2.open, lv2.readonly, lv2.tags))
+
+    def test_xenvm_default_columns(self):
+        self.lvutil.get_sr_alloc.return_value = 'xlvhd'
+        self.cache._saveSnapshot = mock.Mock()
+
+        self.refresh("  lv1 %s -wi-ao---- 8388608B hidden\n"
+                     "  lv2 %s -ri------- 4194304B\n" % (VG_NAME, VG_NAME))
+
+        self.lvutil.get_sr_alloc.assert_called_once_with(VG_NAME)
+        self.assertFalse(self.lvutil.getVGSeqno.called)
+        self.assertFalse(self.cache._saveSnapshot.called)
+        self.assertEquals(None, self.cache.seqno)
+        cmd = self.lvutil.cmd_lvm.call_args[0][0]
+        self.assertEquals('+lv_tags', cmd[cmd.index('-o') + 1])
+        self.assertFalse('--separator' in cmd)
+        lv1 = self.cache.lvs['lv1']
+        self.assertEquals((8388608, True, 1, False, ['hidden']),
+                          (lv1.size, lv1.active, lv1.open, lv1.readonly,
+                           lv1.tags))
+        lv2 = self.cache.lvs['lv2']
+        self.assertEquals((4194304, False, True, []),
+                          (lv2.size, lv2.active, lv2.readonly, lv2.tags))
+
+    def test_tags_with_separator(self):
+        self.refresh("  lv1:-wi-------:4194304:7:a:b,hidden\n")
+
+        self.assertEquals(['a:b', 'hidden'], self.cache.lvs['lv1'].tags)
+        self.assertEquals(['lv1'], self.cache.getTagged('a:b'))
+
+    def test_tag_index(self):
+        self.refresh("  lv1:-wi-------:4194304:7:journal\n"
+                     "  lv2:-wi-------:4194304:7:journal,hidden\n")
+
+        self.cache.rename('lv2', 'lv3')
+        self.cache.remove('lv1')
+
+        self.assertEquals(['lv3'], self.cache.getTagged('journal'))
+        self.assertEquals(['lv3'], self.cache.getTagged('hidden'))
+        self.assertEquals([], self.cache.getTagged('other'))
@@ -0,0 +1,209 @@
+import unittest
+import mock
+import os
+import shutil
+import stat
+import sys
+import tempfile
+
+import lvmshell
+import lvutil
+import util
+
+
+FAKE_LVM = '''#!%s
+# minimal lvm shell: "fail" fails, "hang" hangs, "die" exits, anything else
+# is echoed back. No status is reported if FAKE_LVM_NO_REPORT is set
+import json, os, sys, time
+status = 1
+while True:
+    sys.stdout.write("lvm> ")
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        break
+    args = line.split()
+    if args[0] == "lastlog" and os.environ.get("FAKE_LVM_NO_REPORT"):
+        continue
+    if args[0] == "lastlog":
+        report = {"log": [{"log_type": "status", "log_context": "shell",
+                           "log_ret_code": str(status)}]}
+        os.write(int(os.environ["LVM_REPORT_FD"]), json.dumps(report))
+        continue
+    if args[0] == "fail":
+        sys.stderr.write("  Failed\\n")
+        status = 5
+    elif args[0] == "hang":
+        time.sleep(60)
+    elif args[0] == "die":
+        sys.exit(1)
+    else:
+        sys.stdout.write("ran: %%s" %% line)
+        status = 1
+'''
+
+
+class TestLVMShell(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.lvm = os.path.join(self.tmpdir, 'lvm')
+        f = open(self.lvm, 'w')
+        f.write(FAKE_LVM % sys.executable)
+        f.close()
+        os.chmod(self.lvm, stat.S_IRWXU)
+        log_patcher = mock.patch('lvmshell.util.SMlog')
+        log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+        self.shell = lvmshell.LVMShell(self.lvm, dict(os.environ))
+        self.addCleanup(self.shell.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_commands_share_one_process(self):
+        self.shell.start()
+        pid = self.shell.pid
+
+        self.assertEquals('ran: lvs VG\n', self.shell.execute(['lvs', 'VG']))
+        self.assertEquals('ran: vgs\n', self.shell.execute(['vgs']))
+        self.assertEquals(pid, self.shell.pid)
+
+    def test_failure_raises_command_exception(self):
+        self.shell.start()
+
+        try:
+            self.shell.execute(['fail'])
+            self.fail('no exception')
+        except util.CommandException, e:
+            self.assertEquals(5, e.code)
+            self.assertEquals('Failed', e.reason)
+        self.assertTrue(self.shell.isRunning())
+
+    def test_unquotable_argument_is_not_run(self):
+        self.shell.start()
+
+        self.assertRaises(lvmshell.LVMShellError, self.shell.execute,
+                          ['lvs', 'a b'])
+
+    def test_timeout_stops_shell(self):
+        self.shell.start()
+
+        self.assertRaises(util.CommandException, self.shell.execute,
+                          ['hang'], 0.2)
+        self.assertFalse(self.shell.isRunning())
+
+    def test_exit_stops_shell(self):
+        self.shell.start()
+
+        self.assertRaises(util.CommandException, self.shell.execute, ['die'])
+        self.assertFalse(self.shell.isRunning())
+
+    def test_missing_lvm_fails_to_start(self):
+        shell = lvmshell.LVMShell(os.path.join(self.tmpdir, 'none'), {})
+
+        self.assertRaises(lvmshell.LVMShellError, shell.start)
+
+    @mock.patch('lvmshell._unavailable', False)
+    @mock.patch('lvmshell._shells', {})
+    def test_run_restarts_shell(self):
+        self.assertRaises(util.CommandException, lvmshell.run, 'VG', self.lvm,
+                          ['die'])
+
+        self.assertEquals('ran: lvs\n', lvmshell.run('VG', self.lvm, ['lvs']))
+        lvmshell._shells.values()[0].stop()
+
+    @mock.patch('lvmshell._unavailable', False)
+    @mock.patch('lvmshell._shells', {})
+    @mock.patch('util.CMD_STATS', True)
+    @mock.patch('util.cmdstats.record')
+    def test_run_records_command_stats(self, mock_record):
+        lvmshell.run('VG', self.lvm, ['lvs'])
+        self.assertRaises(util.CommandException, lvmshell.run, 'VG', self.lvm,
+                          ['fail'])
+        lvmshell._shells.values()[0].stop()
+
+        self.assertEquals([('lvs', 0), ('fail', 5)],
+                          [(c[0][0], c[0][3]) for c in
+                           mock_record.call_args_list])
+
+    @mock.patch('lvmshell._unavailable', False)
+    @mock.patch('lvmshell._shells', {})
+    def test_run_without_lvm_shell(self):
+        lvm = os.path.join(self.tmpdir, 'none')
+
+        self.assertRaises(lvmshell.LVMShellError, lvmshell.run, 'VG', lvm,
+                          ['lvs'])
+        self.assertTrue(lvmshell._unavailable)
+
+    @mock.patch('lvmshell._unavailable', False)
+    @mock.patch('lvmshell._shells', {})
+    @mock.patch.dict(os.environ, {'FAKE_LVM_NO_REPORT': '1'})
+    def test_run_without_status_report(self):
+        self.assertRaises(lvmshell.LVMShellUnsupported, lvmshell.run, 'VG',
+                          self.lvm, ['lvs'])
+        self.assertTrue(lvmshell._unavailable)
+
+    @mock.patch('lvmshell._unavailable', False)
+    @mock.patch('lvmshell._shells', {})
+    @mock.patch('lvmshell._startFailures', {})
+    @mock.patch('lvmshell.time.time')
+    def test_start_retried_after_transient_failure(self, mock_time):
+        mock_time.return_value = 1000.0
+        with mock.patch('lvmshell.os.pipe', side_effect=OSError(24, 'EMFILE')):
+            self.assertRaises(lvmshell.LVMShellError, lvmshell.run, 'VG',
+                              self.lvm, ['lvs'])
+        self.assertFalse(lvmshell._unavailable)
+
+        with mock.patch('lvmshell.LVMShell.start') as mock_start:
+            self.assertRaises(lvmshell.LVMShellError, lvmshell.run, 'VG',
+                              self.lvm, ['lvs'])
+        self.assertEquals(0, mock_start.call_count)
+
+        mock_time.return_value += lvmshell.START_BACKOFF_MIN
+        self.assertEquals('ran: lvs\n', lvmshell.run('VG', self.lvm, ['lvs']))
+        lvmshell._shells.values()[0].stop()
+        self.assertEquals({}, lvmshell._startFailures)
+
+
+class TestCmdLVMShell(unittest.TestCase):
+    VG_NAME = 'VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7'
+
+    def setUp(self):
+        for name, value in [('lvutil.get_sr_alloc', 'thick')]:
+            patcher = mock.patch(name)
+            patcher.start().return_value = value
+            self.addCleanup(patcher.stop)
+        log_patcher = mock.patch('lvutil.util.SMlog')
+        log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+
+    @mock.patch('lvutil.lvmshell.run')
+    def test_lv_commands_run_in_shell(self, mock_run):
+        mock_run.return_value = 'output'
+
+        self.assertEquals('output',
+                          lvutil.cmd_lvm([lvutil.CMD_LVS, self.VG_NAME]))
+        mock_run.assert_called_once_with(
+            self.VG_NAME, os.path.join(lvutil.LVM_BIN, 'lvm'),
+            [lvutil.CMD_LVS, self.VG_NAME])
+
+    @mock.patch('lvutil.util.doexec')
+    @mock.patch('lvutil.lvmshell.run')
+    def test_fallback_to_fork(self, mock_run, mock_doexec):
+        mock_run.side_effect = lvmshell.LVMShellError('unavailable')
+        mock_doexec.return_value = (0, 'output', '')
+
+        self.assertEquals('output',
+                          lvutil.cmd_lvm([lvutil.CMD_LVS, self.VG_NAME]))
+        mock_doexec.assert_called_once_with(
+            [os.path.join(lvutil.LVM_BIN, lvutil.CMD_LVS), self.VG_NAME],
+            timeout=None)
+
+    @mock.patch('lvutil.util.doexec')
+    @mock.patch('lvutil.lvmshell.run')
+    def test_other_pread_functions_fork(self, mock_run, mock_doexec):
+        mock_doexec.return_value = (0, '', '')
+
+        lvutil.cmd_lvm([lvutil.CMD_LVS, self.VG_NAME], pread_func=util.pread)
+
+        self.assertEquals(0, mock_run.call_count)
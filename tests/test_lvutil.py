@@ -4,6 +4,8 @@ import lvmlib
 import mock
 
 import os
+import shutil
+import tempfile
 import lvutil
 
 
@@ -107,3 +109,106 @@ class TestRemove(unittest.TestCase):
             [os.path.join(lvutil.LVM_BIN, lvutil.CMD_LVREMOVE)]
             + "-f VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7/volume --config devices{blah}".split(),
            quiet= False)
+
+
+class TestActivateMany(unittest.TestCase):
+    @mock.patch('lvutil._checkActive')
+    @mock.patch('lvutil.cmd_lvm')
+    def test_single_lvchange(self, mock_cmd_lvm, mock_check_active):
+        mock_check_active.return_value = True
+
+        lvutil.activateManyNoRefcount(['/dev/VG/lv1', '/dev/VG/lv2'])
+
+        mock_cmd_lvm.assert_called_once_with(
+            [lvutil.CMD_LVCHANGE, '-ay', '/dev/VG/lv1', '/dev/VG/lv2'])
+
+    @mock.patch('lvutil._checkActive')
+    @mock.patch('lvutil.cmd_lvm')
+    def test_inactive_lv_raises(self, mock_cmd_lvm, mock_check_active):
+        mock_check_active.side_effect = lambda path: path.endswith('lv1')
+
+        self.assertRaises(lvutil.util.CommandException,
+                          lvutil.activateManyNoRefcount,
+                          ['/dev/VG/lv1', '/dev/VG/lv2'])
+
+    @mock.patch('lvutil._lvmBugCleanup')
+    @mock.patch('lvutil.cmd_lvm')
+    def test_deactivate_single_lvchange(self, mock_cmd_lvm, mock_cleanup):
+        lvutil.deactivateManyNoRefcount(['/dev/VG/lv1', '/dev/VG/lv2'])
+
+        mock_cmd_lvm.assert_called_once_with(
+            [lvutil.CMD_LVCHANGE, '-an', '/dev/VG/lv1', '/dev/VG/lv2'])
+        self.assertEquals(2, mock_cleanup.call_count)
+
+
+class TestSrAllocCache(unittest.TestCase):
+    VG_NAME = 'VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_dir = os.path.join(self.tmpdir, 'xenvm.d') + '/'
+        os.mkdir(self.config_dir)
+        self.device = os.path.join(self.tmpdir, 'sda')
+        open(self.device, 'w').close()
+        for name, value in [('lvutil.config_dir', self.config_dir),
+                            ('lvutil.USE_LVM_SHELL', False)]:
+            patcher = mock.patch(name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        lvutil.invalidate_sr_alloc()
+        self.pread = mock.MagicMock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        lvutil.invalidate_sr_alloc()
+
+    def cmd_lvm(self, cmd):
+        lvutil.cmd_lvm(cmd, None, self.pread)
+
+    def executable(self):
+        return self.pread.call_args[0][0][0]
+
+    @mock.patch('lvutil.getSCSIid')
+    def test_scsi_id_looked_up_once(self, mock_scsi_id):
+        mock_scsi_id.return_value = 'scsi-1'
+
+        self.cmd_lvm([lvutil.CMD_PVS, self.device])
+        self.cmd_lvm([lvutil.CMD_PVS, self.device])
+
+        mock_scsi_id.assert_called_once_with(self.device)
+        self.assertEquals(2, self.pread.call_count)
+
+    @mock.patch('lvutil.getSCSIid')
+    def test_invalidate_all_forgets_scsi_ids(self, mock_scsi_id):
+        mock_scsi_id.return_value = 'scsi-1'
+        self.cmd_lvm([lvutil.CMD_PVS, self.device])
+
+        lvutil.invalidate_sr_alloc()
+        self.cmd_lvm([lvutil.CMD_PVS, self.device])
+
+        self.assertEquals(2, mock_scsi_id.call_count)
+
+    def test_upgrade_by_other_process_is_seen(self):
+        self.cmd_lvm([lvutil.CMD_VGS, self.VG_NAME])
+        self.assertEquals(os.path.join(lvutil.LVM_BIN, 'vgs'),
+                          self.executable())
+
+        # the config_dir stamp changes with the new file
+        open(self.config_dir + self.VG_NAME, 'w').close()
+        os.utime(self.config_dir, (0, 0))
+        self.cmd_lvm([lvutil.CMD_VGS, self.VG_NAME])
+
+        self.assertEquals('/bin/xenvm', self.executable())
+
+    @mock.patch('lvutil.get_sr_alloc')
+    def test_invalidate_vg(self, mock_get_sr_alloc):
+        mock_get_sr_alloc.return_value = 'thick'
+        self.cmd_lvm([lvutil.CMD_VGS, self.VG_NAME])
+        self.cmd_lvm([lvutil.CMD_VGS, self.VG_NAME])
+        self.assertEquals(1, mock_get_sr_alloc.call_count)
+
+        lvutil.invalidate_sr_alloc(self.VG_NAME)
+        mock_get_sr_alloc.return_value = 'xlvhd'
+        self.cmd_lvm([lvutil.CMD_VGS, self.VG_NAME])
+
+        self.assertEquals('/bin/xenvm', self.executable())
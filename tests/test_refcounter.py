@@ -1,105 +1,143 @@
 import unittest
-import testlib
 import os
 import mock
-import errno
+import shutil
+import tempfile
 
 import refcounter
 
 
 class TestRefCounter(unittest.TestCase):
-    @testlib.with_context
-    def test_get_whencalled_creates_namespace(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
-
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.base_dir = os.path.join(self.tmpdir, 'refcount')
+        patcher = mock.patch('refcounter.RefCounter.BASE_DIR', self.base_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        log_patcher = mock.patch('refcounter.util.SMlog')
+        log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def table_contents(self, ns):
+        f = open(os.path.join(self.base_dir, ns + '.db'), 'r')
+        contents = f.read()
+        f.close()
+        return contents
+
+    def write_legacy(self, ns, obj, contents):
+        ns_dir = os.path.join(self.base_dir, ns)
+        if not os.path.isdir(ns_dir):
+            os.makedirs(ns_dir)
+        f = open(os.path.join(ns_dir, obj), 'w')
+        f.write(contents)
+        f.close()
+
+    def test_get_whencalled_creates_base_dir(self):
         refcounter.RefCounter.get('not-important', False, 'somenamespace')
 
-        self.assertEquals(
-            ['somenamespace'],
-            os.listdir(os.path.join(refcounter.RefCounter.BASE_DIR)))
-
-    @testlib.with_context
-    def test_get_whencalled_returns_counters(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
+        self.assertTrue(os.path.isdir(self.base_dir))
 
+    def test_get_whencalled_returns_counters(self):
         result = refcounter.RefCounter.get(
             'not-important', False, 'somenamespace')
 
         self.assertEquals(1, result)
 
-    @testlib.with_context
-    def test_get_whencalled_creates_refcounter_file(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
-
+    def test_get_whencalled_writes_namespace_table(self):
         refcounter.RefCounter.get('someobject', False, 'somenamespace')
+        refcounter.RefCounter.get('otherobject', True, 'somenamespace')
 
         self.assertEquals(
-            ['someobject'],
-            os.listdir(os.path.join(
-                refcounter.RefCounter.BASE_DIR, 'somenamespace')))
+            ['otherobject 0 1', 'someobject 1 0'],
+            sorted(self.table_contents('somenamespace').splitlines()))
 
-    @testlib.with_context
-    def test_get_whencalled_refcounter_file_contents(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
+    def test_put_is_noop_if_already_zero(self):
+        result = refcounter.RefCounter.put(
+            'someobject', False, 'somenamespace')
 
+        self.assertEquals(0, result)
+
+    def test_last_put_removes_table(self):
         refcounter.RefCounter.get('someobject', False, 'somenamespace')
 
-        path_to_refcounter = os.path.join(
-            refcounter.RefCounter.BASE_DIR, 'somenamespace', 'someobject')
+        refcounter.RefCounter.put('someobject', False, 'somenamespace')
 
-        refcounter_file = open(path_to_refcounter, 'r')
-        contents = refcounter_file.read()
-        refcounter_file.close()
+        self.assertEquals(['somenamespace.lock'], os.listdir(self.base_dir))
 
-        self.assertEquals('1 0\n', contents)
+    def test_object_names_with_spaces(self):
+        refcounter.RefCounter.set('some object', 3, 1, 'somenamespace')
 
-    @testlib.with_context
-    def test_put_is_noop_if_already_zero(self, context):
-        os.makedirs(refcounter.RefCounter.BASE_DIR)
+        self.assertEquals(
+            (3, 1), refcounter.RefCounter.check('some object',
+                                                'somenamespace'))
 
-        result = refcounter.RefCounter.put(
-            'someobject', False, 'somenamespace')
+    def test_get_many(self):
+        refcounter.RefCounter.get('a', False, 'ns')
 
-        self.assertEquals(0, result)
+        result = refcounter.RefCounter.getMany(
+            [('a', False), ('b', True), ('c', False)], 'ns')
+
+        self.assertEquals([2, 1, 1], result)
+        self.assertEquals((0, 1), refcounter.RefCounter.check('b', 'ns'))
+
+    def test_put_many(self):
+        refcounter.RefCounter.getMany([('a', False), ('a', False),
+                                       ('b', True)], 'ns')
+
+        result = refcounter.RefCounter.putMany([('a', False), ('b', True)],
+                                               'ns')
+
+        self.assertEquals([1, 0], result)
 
-    @testlib.with_context
-    def test_writeCount_returns_true_if_file_found(self, context):
-        os.makedirs('/existing')
+    def test_failed_transaction_changes_nothing(self):
+        refcounter.RefCounter.get('a', False, 'ns')
 
-        result = refcounter.RefCounter._writeCount('/existing/file', 1, 1)
+        self.assertRaises(
+            refcounter.RefCounterException,
+            refcounter.RefCounter._adjustMany, 'ns',
+            [('a', 1, 0), ('b', 0, 2)])
 
-        self.assertTrue(result)
+        self.assertEquals((1, 0), refcounter.RefCounter.check('a', 'ns'))
 
-    @testlib.with_context
-    def test_writeCount_returns_false_if_file_not_found(self, context):
-        result = refcounter.RefCounter._writeCount('/nonexisting/file', 1, 1)
+    def test_legacy_counts_are_migrated(self):
+        self.write_legacy('somenamespace', 'someobject', '2 1\n')
+
+        result = refcounter.RefCounter.get('someobject', False,
+                                           'somenamespace')
+
+        self.assertEquals(4, result)
+        self.assertEquals('someobject 3 1\n',
+                          self.table_contents('somenamespace'))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.base_dir, 'somenamespace')))
+
+    def test_legacy_counts_are_migrated_on_check(self):
+        self.write_legacy('somenamespace', 'someobject', '1 0\n')
+
+        self.assertEquals(
+            (1, 0), refcounter.RefCounter.check('someobject',
+                                                'somenamespace'))
 
-        self.assertFalse(result)
+    def test_reset_all_namespaces(self):
+        refcounter.RefCounter.get('a', False, 'ns1')
+        refcounter.RefCounter.get('b', False, 'ns2')
+        self.write_legacy('ns3', 'c', '1 0\n')
 
-    @mock.patch('os.rmdir')
-    @mock.patch('os.unlink')
-    @mock.patch('util.pathexists')
-    def test_removeObject_ignores_if_directory_already_removed(self,
-                                                               pathexists,
-                                                               unlink,
-                                                               rmdir):
-        rmdir.side_effect = OSError(errno.ENOENT, 'ignored')
+        refcounter.RefCounter.resetAll()
 
-        refcounter.RefCounter._removeObject('namespace', 'obj')
+        for ns, obj in [('ns1', 'a'), ('ns2', 'b'), ('ns3', 'c')]:
+            self.assertEquals((0, 0), refcounter.RefCounter.check(obj, ns))
 
-        rmdir.assert_called_once_with(
-            os.path.join(refcounter.RefCounter.BASE_DIR, 'namespace'))
+    def test_reset_one_object(self):
+        refcounter.RefCounter.getMany([('a', False), ('b', False)], 'ns')
 
-    @mock.patch('os.rmdir')
-    @mock.patch('os.unlink')
-    @mock.patch('util.pathexists')
-    def test_removeObject_ignores_if_directory_not_empty(self,
-                                                         pathexists,
-                                                         unlink,
-                                                         rmdir):
-        rmdir.side_effect = OSError(errno.ENOTEMPTY, 'ignored')
+        refcounter.RefCounter.reset('a', 'ns')
 
-        refcounter.RefCounter._removeObject('namespace', 'obj')
+        self.assertEquals((0, 0), refcounter.RefCounter.check('a', 'ns'))
+        self.assertEquals((1, 0), refcounter.RefCounter.check('b', 'ns'))
 
-        rmdir.assert_called_once_with(
-            os.path.join(refcounter.RefCounter.BASE_DIR, 'namespace'))
+    def test_module_tests(self):
+        self.assertEquals(0, refcounter.RefCounter._runTests())
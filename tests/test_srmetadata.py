@@ -0,0 +1,193 @@
+import unittest
+import mock
+import os
+import shutil
+import tempfile
+
+import lvutil
+import srmetadata
+
+
+SR_INFO = {'uuid': 'sr-uuid', 'allocation': 'thick',
+           'initial_allocation': '', 'allocation_quantum': '',
+           'name_label': 'SR', 'name_description': 'an SR'}
+
+
+def vdi(uuid, name_label='VDI'):
+    return {'uuid': uuid, 'name_label': name_label,
+            'name_description': 'a VDI', 'is_a_snapshot': '0',
+            'snapshot_of': '', 'snapshot_time': '', 'type': 'user',
+            'vdi_type': 'vhd', 'read_only': '0', 'managed': '1',
+            'metadata_of_pool': ''}
+
+
+class TestMetadataHandler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'metadata')
+        open(self.path, 'w').close()
+        for name in ['srmetadata.lvutil.ensurePathExists',
+                     'srmetadata.util.SMlog']:
+            patcher = mock.patch(name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def handler(self):
+        return srmetadata.LVMMetadataHandler(self.path)
+
+    def write(self, uuids):
+        vdis = {}
+        for uuid in uuids:
+            vdis[uuid] = vdi(uuid)
+        self.handler().writeMetadata(dict(SR_INFO), vdis)
+
+    def vdis(self, params={'indexByUuid': 1}):
+        return self.handler().getMetadata(params)[1]
+
+    def test_parse_vdi_record(self):
+        record = self.handler().getVdiInfo(vdi('a', 'x < y & "z"'))
+
+        vdi_info = srmetadata.parseVdiRecord(record)
+
+        self.assertEquals(vdi('a', 'x < y & "z"'),
+                          dict([(k, v) for k, v in vdi_info.items()
+                                if k != 'deleted']))
+        self.assertEquals('0', vdi_info['deleted'])
+
+    def test_parse_unexpected_layout_falls_back(self):
+        record = '<vdi><uuid>a</uuid><x><y>1</y></x></vdi>'
+
+        vdi_info = srmetadata.parseVdiRecord(record)
+
+        self.assertEquals('a', vdi_info['uuid'])
+        self.assertEquals({'y': '1'}, vdi_info['x'])
+
+    def test_update_vdi(self):
+        self.write(['a', 'b', 'c'])
+
+        self.handler().updateVdi({'uuid': 'b',
+                                       'name_label': 'new'})
+
+        vdis = self.vdis()
+        self.assertEquals(['VDI', 'new', 'VDI'],
+                          [vdis[uuid]['name_label'] for uuid in 'abc'])
+
+    def test_deleted_record_is_reused(self):
+        self.write(['a', 'b', 'c'])
+        handler = self.handler()
+        offsets = dict([(v['uuid'], k) for k, v in
+                        handler.getMetadata()[1].items()])
+
+        handler.deleteVdiFromMetadata('b')
+        handler.addVdi(vdi('d'))
+
+        vdis = self.vdis({})
+        self.assertEquals('d', vdis[offsets['b']]['uuid'])
+        self.assertEquals(['a', 'c', 'd'],
+                          sorted([v['uuid'] for v in vdis.values()]))
+
+    def test_delete_last_vdi_shrinks_metadata(self):
+        self.write(['a', 'b'])
+        handler = self.handler()
+        length = srmetadata.getMetadataLength(handler.fd)
+
+        handler.deleteVdiFromMetadata('b')
+        handler.addVdi(vdi('c'))
+        handler.deleteVdiFromMetadata('c')
+
+        self.assertEquals(length - 2 * srmetadata.SECTOR_SIZE,
+                          srmetadata.getMetadataLength(handler.fd))
+        self.assertEquals(['a'], self.vdis().keys())
+
+    @mock.patch('srmetadata.util.gen_uuid')
+    def test_space_check_leaves_metadata_unchanged(self, mock_gen_uuid):
+        mock_gen_uuid.return_value = 'dummy'
+        self.write(['a'])
+        handler = self.handler()
+        length = srmetadata.getMetadataLength(handler.fd)
+
+        handler.spaceAvailableForVdis(1)
+
+        self.assertEquals(length, srmetadata.getMetadataLength(handler.fd))
+        self.assertEquals(['a'], self.vdis().keys())
+
+    def test_update_sr(self):
+        self.write(['a'])
+
+        self.handler().updateMetadata({'objtype': 'sr',
+                                       'name_label': 'renamed'})
+
+        sr_info, vdis = self.handler().getMetadata({'indexByUuid': 1})
+        self.assertEquals('renamed', sr_info['name_label'])
+        self.assertEquals(['a'], vdis.keys())
+
+    def test_batch_is_written_on_flush(self):
+        self.write(['a', 'b'])
+        handler = self.handler()
+        handler.startBatch()
+
+        handler.addVdi(vdi('c'))
+        handler.updateVdi({'uuid': 'a', 'name_label': 'new'})
+        handler.deleteVdiFromMetadata('b')
+        self.assertEquals(['a', 'b'], sorted(self.vdis().keys()))
+        self.assertEquals(['a', 'c'], sorted(
+            handler.getMetadata({'indexByUuid': 1})[1].keys()))
+        handler.flush()
+
+        vdis = self.vdis()
+        self.assertEquals(['a', 'c'], sorted(vdis.keys()))
+        self.assertEquals('new', vdis['a']['name_label'])
+
+    @mock.patch('srmetadata.os.fsync')
+    @mock.patch('srmetadata.file_write_wrapper',
+                wraps=srmetadata.file_write_wrapper)
+    def test_flush_writes_changed_sectors_once(self, mock_write, mock_fsync):
+        self.write(['a', 'b', 'c'])
+        mock_write.reset_mock()
+        mock_fsync.reset_mock()
+        handler = self.handler()
+        handler.startBatch()
+
+        for name_label in ['x', 'y', 'z']:
+            handler.updateVdi({'uuid': 'b', 'name_label': name_label})
+        handler.updateVdi({'uuid': 'c', 'name_label': 'z'})
+        handler.flush()
+
+        # the name_label sectors of b and c, and no header
+        self.assertEquals([srmetadata.SECTOR_SIZE] * 2,
+                          [c[0][4] for c in mock_write.call_args_list])
+        self.assertEquals(1, mock_fsync.call_count)
+
+    def test_new_records_written_before_the_length(self):
+        self.write(['a'])
+        handler = self.handler()
+        handler.startBatch()
+        handler.addVdi(vdi('b'))
+        order = []
+        header = srmetadata.updateLengthInHeader
+
+        def update_length(fd, length):
+            order.append(srmetadata.parseVdiRecord(open(self.path).read()[
+                length - 2 * srmetadata.SECTOR_SIZE:length])['uuid'])
+            header(fd, length)
+
+        with mock.patch('srmetadata.updateLengthInHeader', update_length):
+            handler.flush()
+
+        self.assertEquals(['b'], order)
+        self.assertEquals(['a', 'b'], sorted(self.vdis().keys()))
+
+    def test_space_check_in_batch(self):
+        self.write(['a'])
+        handler = self.handler()
+        length = srmetadata.getMetadataLength(handler.fd)
+        os.ftruncate(handler.fd, length + 2 * srmetadata.SECTOR_SIZE)
+        handler.startBatch()
+
+        handler.checkSpaceForVdis(1)
+        handler.addVdi(vdi('b'))
+
+        self.assertRaises(IOError, handler.checkSpaceForVdis, 1)
@@ -0,0 +1,69 @@
+import unittest
+import mock
+import os
+import shutil
+import tempfile
+
+import statsring
+
+
+class TestStatsRing(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def ring(self, numRecords=4):
+        return statsring.StatsRing(os.path.join(self.tmpdir, 'run', 'stats'),
+                                   'TEST', '=di8s', ['time', 'pid', 'name'],
+                                   numRecords)
+
+    def test_record_and_read(self):
+        ring = self.ring()
+        ring.record((100.0, 42, 'a'))
+
+        self.assertEquals([{'time': 100.0, 'pid': 42, 'name': 'a'}],
+                          self.ring().read())
+
+    def test_ring_keeps_the_latest(self):
+        ring = self.ring()
+        for i in range(10):
+            ring.record((i, 0, 'r%d' % i))
+
+        self.assertEquals(['r6', 'r7', 'r8', 'r9'],
+                          [rec['name'] for rec in ring.read()])
+
+    def test_clear(self):
+        ring = self.ring()
+        ring.record((0, 0, 'a'))
+
+        ring.clear()
+        ring.record((0, 0, 'b'))
+
+        self.assertEquals(['b'], [rec['name'] for rec in ring.read()])
+
+    def test_other_format_is_ignored(self):
+        ring = self.ring()
+        ring.record((0, 0, 'a'))
+        other = statsring.StatsRing(ring.path, 'OTHR', ring.recordFormat,
+                                    ring.fields, ring.numRecords)
+
+        self.assertEquals([], other.read())
+
+    def test_record_never_raises(self):
+        ring = self.ring()
+
+        ring.record((0, 'not a pid', 'a'))
+        with mock.patch('statsring.os.open', side_effect=OSError):
+            ring.record((0, 0, 'b'))
+
+        self.assertEquals([], ring.read())
+
+    def test_percentile(self):
+        values = range(1, 101)
+
+        self.assertEquals(0, statsring.percentile([], 50))
+        self.assertEquals(50, statsring.percentile(values, 50))
+        self.assertEquals(99, statsring.percentile(values, 99))
+        self.assertEquals(1, statsring.percentile(values, 0))
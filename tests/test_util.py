@@ -0,0 +1,149 @@
+import unittest
+import mock
+import errno
+import os
+import threading
+import time
+
+import util
+
+
+class TestCallPluginOnHosts(unittest.TestCase):
+    def setUp(self):
+        self.xapi = mock.MagicMock()
+        patcher = mock.patch('util.XenAPI.xapi_local', return_value=self.xapi)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        log_patcher = mock.patch('util.SMlog')
+        log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+        self.session = mock.MagicMock()
+        self.session._session = 'OpaqueRef:session'
+
+    def test_results_and_errors_per_host(self):
+        error = Exception('host down')
+
+        def call_plugin(host_ref, plugin, fn, args):
+            if host_ref == 'h3':
+                raise error
+            return host_ref + fn
+
+        self.xapi.xenapi.host.call_plugin.side_effect = call_plugin
+
+        results = util.call_plugin_on_hosts(self.session, ['h1', 'h2', 'h3'],
+                                            'plugin', 'fn', {})
+
+        self.assertEquals({'h1': 'h1fn', 'h2': 'h2fn', 'h3': error}, results)
+        self.assertEquals('OpaqueRef:session', self.xapi._session)
+
+    @mock.patch('util.PLUGIN_THREADS', 1)
+    def test_timed_out_host_does_not_hold_up_the_others(self):
+        stuck = threading.Event()
+        self.addCleanup(stuck.set)
+
+        def call_plugin(host_ref, plugin, fn, args):
+            if host_ref == 'h1':
+                stuck.wait(10)
+            return 'True'
+
+        self.xapi.xenapi.host.call_plugin.side_effect = call_plugin
+
+        results = util.call_plugin_on_hosts(self.session, ['h1', 'h2'],
+                                            'plugin', 'fn', {}, timeout=0.2)
+
+        self.assertTrue(isinstance(results['h1'], util.TimeoutException))
+        self.assertEquals('True', results['h2'])
+
+    def test_no_hosts(self):
+        self.assertEquals({}, util.call_plugin_on_hosts(
+            self.session, [], 'plugin', 'fn', {}))
+
+
+class TestDoexec(unittest.TestCase):
+    def setUp(self):
+        for name, value in [('util.CMD_STATS', True),
+                            ('util.cmdstats.record', mock.MagicMock())]:
+            patcher = mock.patch(name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_run_is_recorded_per_binary(self):
+        (rc, stdout, stderr) = util.doexec(['/bin/sh', '-c', 'exit 3'])
+
+        self.assertEquals(3, rc)
+        args = util.cmdstats.record.call_args[0]
+        self.assertEquals('sh', args[0])
+        self.assertEquals(3, args[3])
+
+    def test_shell_command(self):
+        (rc, stdout, stderr) = util.doexec('echo "a  b"', shell=True)
+
+        self.assertEquals((0, 'a  b\n'), (rc, stdout))
+        self.assertEquals('echo', util.cmdstats.record.call_args[0][0])
+
+    def test_timeout_kills_the_command(self):
+        start = time.time()
+
+        try:
+            util.doexec(['/bin/sleep', '10'], timeout=0.2)
+            self.fail('no timeout')
+        except util.CommandException, e:
+            self.assertEquals(errno.ETIMEDOUT, e.code)
+
+        self.assertTrue(time.time() - start < 5)
+        self.assertEquals(1, util.cmdstats.record.call_count)
+
+    def test_timeout_kills_the_children_of_a_shell(self):
+        start = time.time()
+
+        self.assertRaises(util.CommandException, util.doexec,
+                          'sleep 10; true', timeout=0.2, shell=True)
+
+        self.assertTrue(time.time() - start < 5)
+
+    def test_no_timeout_when_done_in_time(self):
+        (rc, stdout, stderr) = util.doexec(['/bin/echo', 'x'], timeout=10)
+
+        self.assertEquals((0, 'x\n'), (rc, stdout))
+
+    def test_default_timeout_of_the_binary(self):
+        with mock.patch.dict('util.COMMAND_TIMEOUTS', {'sleep': 0.2}):
+            self.assertRaises(util.CommandException, util.doexec,
+                              ['/bin/sleep', '10'])
+
+    def test_exited_command_is_not_timed_out(self):
+        proc = mock.Mock(returncode=0)
+        expired = threading.Event()
+
+        with mock.patch('os.killpg') as killpg:
+            util._killExpired(proc, expired)
+
+        self.assertFalse(expired.isSet())
+        self.assertFalse(killpg.called)
+
+    def process_group(self, timeout):
+        (rc, stdout, stderr) = util.doexec(['/bin/cat', '/proc/self/stat'],
+                                           timeout=timeout)
+        fields = stdout.split(')')[-1].split()
+        return int(stdout.split()[0]), int(fields[2])
+
+    def test_process_group_of_its_own_with_a_timeout(self):
+        pid, pgid = self.process_group(10)
+        self.assertEquals(pid, pgid)
+
+        pid, pgid = self.process_group(None)
+        self.assertEquals(os.getpgrp(), pgid)
+
+    def test_inherited_fds_are_closed(self):
+        r, w = os.pipe()
+        os.dup2(w, 100)
+        try:
+            (rc, stdout, stderr) = util.doexec(['/bin/ls', '/proc/self/fd'])
+        finally:
+            os.close(100)
+            os.close(r)
+            os.close(w)
+
+        fds = [int(fd) for fd in stdout.split()]
+        self.assertTrue(max(fds) < 10)
+        self.assertFalse(100 in fds)
@@ -0,0 +1,250 @@
+import unittest
+import mock
+import os
+import shutil
+import tempfile
+
+import lvhdutil
+import vhdcache
+import vhdutil
+from test_vhdreader import write_vhd, BLOCK_SIZE
+
+
+def extract(path):
+    return os.path.basename(path)[:-4]
+
+
+class TestVHDCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srdir = os.path.join(self.tmpdir, 'sr')
+        os.mkdir(self.srdir)
+        cache_dir_patcher = mock.patch('vhdcache.CACHE_DIR',
+                                       os.path.join(self.tmpdir, 'cache'))
+        cache_dir_patcher.start()
+        self.addCleanup(cache_dir_patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.srdir, name)
+
+    def scan(self, bypass=False):
+        cache = vhdcache.VHDCache('sr', bypass)
+        vhds = vhdcache.getFileVHDs(self.srdir, extract, cache)
+        return vhds, cache
+
+    def test_unchanged_vhds_are_not_reread(self):
+        write_vhd(self.path('a.vhd'), BLOCK_SIZE, hidden=1)
+        write_vhd(self.path('b.vhd'), BLOCK_SIZE, parent='./a.vhd')
+        self.scan()
+
+        with mock.patch('vhdutil.getScanInfo') as mock_read:
+            vhds, cache = self.scan()
+
+        self.assertEquals(0, mock_read.call_count)
+        self.assertEquals((2, 0), (cache.hits, cache.misses))
+        self.assertEquals(1, vhds['a'].hidden)
+        self.assertEquals('a', vhds['b'].parentUuid)
+        self.assertEquals(BLOCK_SIZE, vhds['b'].sizeVirt)
+
+    def test_changed_vhd_is_reread(self):
+        write_vhd(self.path('a.vhd'), BLOCK_SIZE)
+        write_vhd(self.path('b.vhd'), BLOCK_SIZE)
+        self.scan()
+
+        write_vhd(self.path('b.vhd'), 2 * BLOCK_SIZE)
+        os.utime(self.path('b.vhd'), (0, 0))
+        vhds, cache = self.scan()
+
+        self.assertEquals((1, 1), (cache.hits, cache.misses))
+        self.assertEquals(2 * BLOCK_SIZE, vhds['b'].sizeVirt)
+
+    def test_bypass(self):
+        write_vhd(self.path('a.vhd'), BLOCK_SIZE)
+        self.scan()
+
+        vhds, cache = self.scan(bypass=True)
+
+        self.assertEquals((0, 1), (cache.hits, cache.misses))
+        self.assertEquals(BLOCK_SIZE, vhds['a'].sizeVirt)
+
+    def test_deleted_vhds_are_forgotten(self):
+        write_vhd(self.path('a.vhd'), BLOCK_SIZE)
+        write_vhd(self.path('b.vhd'), BLOCK_SIZE)
+        self.scan()
+
+        os.unlink(self.path('b.vhd'))
+        vhds, cache = self.scan()
+
+        self.assertEquals(['a'], vhds.keys())
+        self.assertEquals(['a.vhd'], cache.entries.keys())
+
+    def test_invalidate(self):
+        write_vhd(self.path('a.vhd'), BLOCK_SIZE)
+        self.scan()
+
+        vhdcache.invalidate(self.path('a.vhd'))
+        vhds, cache = self.scan()
+
+        self.assertEquals((0, 1), (cache.hits, cache.misses))
+
+    @mock.patch('vhdutil.ioretry')
+    def test_vhd_modification_invalidates(self, mock_ioretry):
+        write_vhd(self.path('a.vhd'), BLOCK_SIZE)
+        self.scan()
+
+        vhdutil.setHidden(self.path('a.vhd'))
+        vhds, cache = self.scan()
+
+        self.assertEquals((0, 1), (cache.hits, cache.misses))
+
+    def test_counters_are_persistent(self):
+        write_vhd(self.path('a.vhd'), BLOCK_SIZE)
+        self.scan()
+        self.scan()
+
+        vhds, cache = self.scan()
+
+        self.assertEquals((2, 1), (cache.totalHits, cache.totalMisses))
+
+    def test_corrupt_cache_is_discarded(self):
+        write_vhd(self.path('a.vhd'), BLOCK_SIZE)
+        self.scan()
+        f = open(os.path.join(vhdcache.CACHE_DIR, 'sr'), 'w')
+        f.write('garbage')
+        f.close()
+
+        vhds, cache = self.scan()
+
+        self.assertEquals((0, 1), (cache.hits, cache.misses))
+        self.assertEquals(BLOCK_SIZE, vhds['a'].sizeVirt)
+
+
+class TestChangeLog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        cache_dir_patcher = mock.patch('vhdcache.CACHE_DIR', self.tmpdir)
+        cache_dir_patcher.start()
+        self.addCleanup(cache_dir_patcher.stop)
+        self.log = vhdcache.ChangeLog('sr')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_since_position(self):
+        self.log.append('a.vhd')
+        position = self.log.position()
+        self.log.append('b.vhd')
+        self.log.append('c.vhd')
+
+        names, position = self.log.read(position)
+
+        self.assertEquals(set(['b.vhd', 'c.vhd']), names)
+        self.assertEquals(set(), self.log.read(position)[0])
+
+    def test_read_before_first_change(self):
+        position = self.log.position()
+        self.log.append('a.vhd')
+
+        self.assertEquals(set(['a.vhd']), self.log.read(position)[0])
+
+    def test_reused_inode_is_not_the_same_log(self):
+        position = self.log.position()
+        os.unlink(self.log.path)
+        self.log.append('a.vhd')
+        position[0] = os.stat(self.log.path).st_ino
+
+        self.assertEquals(None, self.log.read(position)[0])
+
+    def test_read_across_rotation(self):
+        position = self.log.position()
+        self.log.append('a.vhd')
+        self.log.rotate()
+        self.log.append('b.vhd')
+
+        names, position = self.log.read(position)
+
+        self.assertEquals(set(['a.vhd', 'b.vhd']), names)
+
+    def test_unknown_after_two_rotations(self):
+        self.log.append('a.vhd')
+        position = self.log.position()
+        self.log.rotate()
+        self.log.append('b.vhd')
+        self.log.rotate()
+
+        self.assertEquals(None, self.log.read(position)[0])
+        self.assertEquals(None, self.log.read(None)[0])
+
+
+class TestLVHDVDIInfoCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        cache_dir_patcher = mock.patch('vhdcache.CACHE_DIR', self.tmpdir)
+        cache_dir_patcher.start()
+        self.addCleanup(cache_dir_patcher.stop)
+
+        self.lvmCache = mock.MagicMock()
+        self.lvmCache.vgName = 'VG_XenStorage-sr'
+        self.lvmCache.getVGSeqno.return_value = 7
+        lv = mock.MagicMock()
+        lv.name = 'VHD-vdi1'
+        lv.size = 8 * BLOCK_SIZE
+        lv.hidden = False
+        self.lvmCache.getLVInfo.return_value = {'VHD-vdi1': lv}
+
+        vhdInfo = vhdutil.VHDInfo('vdi1')
+        vhdInfo.path = 'VHD-vdi1'
+        vhdInfo.sizeVirt = BLOCK_SIZE
+        vhdInfo.hidden = 1
+        self.vhds = {'vdi1': vhdInfo}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def getVDIInfo(self, bypass=False):
+        cache = vhdcache.VHDCache(self.lvmCache.vgName, bypass)
+        return lvhdutil.getVDIInfo(self.lvmCache, cache)
+
+    @mock.patch('vhdutil.getAllVHDs')
+    def test_scan_skipped_while_seqno_unchanged(self, mock_scan):
+        mock_scan.return_value = self.vhds
+        self.getVDIInfo()
+
+        vdis = self.getVDIInfo()
+
+        self.assertEquals(1, mock_scan.call_count)
+        self.assertEquals(BLOCK_SIZE, vdis['vdi1'].sizeVirt)
+        self.assertEquals(1, vdis['vdi1'].hidden)
+
+    @mock.patch('vhdutil.getAllVHDs')
+    def test_seqno_change_rescans(self, mock_scan):
+        mock_scan.return_value = self.vhds
+        self.getVDIInfo()
+
+        self.lvmCache.getVGSeqno.return_value = 8
+        self.getVDIInfo()
+
+        self.assertEquals(2, mock_scan.call_count)
+
+    @mock.patch('vhdutil.getAllVHDs')
+    def test_bypass_rescans(self, mock_scan):
+        mock_scan.return_value = self.vhds
+        self.getVDIInfo()
+
+        self.getVDIInfo(bypass=True)
+
+        self.assertEquals(2, mock_scan.call_count)
+
+    @mock.patch('vhdutil.util.SMlog')
+    @mock.patch('vhdutil.getAllVHDs')
+    def test_no_seqno_no_cache(self, mock_scan, mock_log):
+        mock_scan.return_value = self.vhds
+        self.lvmCache.getVGSeqno.side_effect = Exception('no vgs')
+        self.getVDIInfo()
+
+        self.getVDIInfo()
+
+        self.assertEquals(2, mock_scan.call_count)
@@ -0,0 +1,272 @@
+import unittest
+import mock
+import os
+import shutil
+import struct
+import tempfile
+
+import vhdreader
+import vhdutil
+
+
+ONE_MEGABYTE = 1024 * 1024
+BLOCK_SIZE = 2 * ONE_MEGABYTE
+
+DATA_OFFSET = 512
+TABLE_OFFSET = 1536
+LOCATOR_DATA_OFFSET = 4608
+
+
+def _with_checksum(data, offset):
+    data = data[:offset] + '\0\0\0\0' + data[offset + 4:]
+    checksum = vhdreader._checksum(data, offset)
+    return data[:offset] + struct.pack('>I', checksum) + data[offset + 4:]
+
+
+def make_footer(size, disk_type, hidden=0):
+    footer = struct.pack(vhdreader.FOOTER_FORMAT,
+                         vhdreader.FOOTER_COOKIE, 2, 0x10000, DATA_OFFSET,
+                         0, 'tap\0', 0x10003, 0, size, size, 0, disk_type,
+                         0, 'u' * 16, 0, hidden)
+    footer += '\0' * (vhdreader.FOOTER_SIZE - len(footer))
+    return _with_checksum(footer, vhdreader.FOOTER_CHECKSUM_OFFSET)
+
+
+def make_header(max_bat, parent_uuid, locators):
+    header = struct.pack(vhdreader.HEADER_FORMAT,
+                         vhdreader.HEADER_COOKIE, 0xFFFFFFFFFFFFFFFF,
+                         TABLE_OFFSET, 0x10000, max_bat, BLOCK_SIZE, 0,
+                         parent_uuid, 0, 0, '\0' * 512)
+    for code, length in locators:
+        header += struct.pack(vhdreader.LOCATOR_FORMAT, code, 1, length, 0,
+                              LOCATOR_DATA_OFFSET)
+    header += '\0' * (vhdreader.HEADER_SIZE - len(header))
+    return _with_checksum(header, vhdreader.HEADER_CHECKSUM_OFFSET)
+
+
+def write_vhd(path, size, blocks=(), parent=None, hidden=0):
+    """Write a minimal dynamic (or differencing, if parent is given) VHD with
+    the given BAT entries allocated"""
+    max_bat = size / BLOCK_SIZE
+    locators = []
+    parent_uuid = '\0' * 16
+    disk_type = vhdreader.DISK_TYPE_DYNAMIC
+    name = ''
+    if parent:
+        disk_type = vhdreader.DISK_TYPE_DIFF
+        parent_uuid = 'p' * 16
+        name = parent.encode('utf-16-le')
+        locators.append((vhdreader.PLAT_CODE_W2RU, len(name)))
+
+    bat = [vhdreader.BAT_ENTRY_UNUSED] * max_bat
+    for i, sector in blocks:
+        bat[i] = sector
+    bat_data = struct.pack('>%dI' % max_bat, *bat)
+
+    footer = make_footer(size, disk_type, hidden)
+    data = footer + make_header(max_bat, parent_uuid, locators)
+    data += bat_data
+    data += '\0' * (LOCATOR_DATA_OFFSET - len(data))
+    data += name
+    data += '\0' * (5120 - len(data))
+    end = 5120
+    for i, sector in blocks:
+        end = max(end, (sector + 1) * 512 + BLOCK_SIZE)
+    data += '\0' * (end - len(data))
+    data += footer
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+
+
+class TestVHDReader(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_size_virt_and_hidden(self):
+        write_vhd(self.path('a.vhd'), 100 * ONE_MEGABYTE, hidden=1)
+
+        self.assertEquals(100 * ONE_MEGABYTE,
+                          vhdreader.getSizeVirt(self.path('a.vhd')))
+        self.assertEquals(1, vhdreader.getHidden(self.path('a.vhd')))
+
+    def test_size_phys_empty(self):
+        write_vhd(self.path('a.vhd'), 100 * ONE_MEGABYTE)
+
+        # end of the (single-sector) BAT plus the footer
+        self.assertEquals(TABLE_OFFSET + 512 + 512,
+                          vhdreader.getSizePhys(self.path('a.vhd')))
+
+    def test_size_phys_uses_last_allocated_block(self):
+        write_vhd(self.path('a.vhd'), 100 * ONE_MEGABYTE,
+                  blocks=[(3, 10), (0, 4106)])
+
+        expected = (4106 + 1 + BLOCK_SIZE / 512) * 512 + 512
+        self.assertEquals(expected, vhdreader.getSizePhys(self.path('a.vhd')))
+
+    def test_no_parent(self):
+        write_vhd(self.path('a.vhd'), 10 * ONE_MEGABYTE)
+
+        self.assertFalse(vhdreader.hasParent(self.path('a.vhd')))
+        self.assertEquals(None, vhdreader.getParentPath(self.path('a.vhd')))
+        self.assertEquals(1, vhdreader.getDepth(self.path('a.vhd')))
+
+    def test_relative_parent_resolved_against_child_dir(self):
+        write_vhd(self.path('parent.vhd'), 10 * ONE_MEGABYTE)
+        write_vhd(self.path('child.vhd'), 10 * ONE_MEGABYTE,
+                  parent='./parent.vhd')
+
+        self.assertTrue(vhdreader.hasParent(self.path('child.vhd')))
+        self.assertEquals(os.path.realpath(self.path('parent.vhd')),
+                          vhdreader.getParentPath(self.path('child.vhd')))
+        self.assertEquals('./parent.vhd',
+                          vhdreader.getParentName(self.path('child.vhd')))
+        self.assertEquals(2, vhdreader.getDepth(self.path('child.vhd')))
+
+    def test_missing_parent_raises(self):
+        write_vhd(self.path('child.vhd'), 10 * ONE_MEGABYTE,
+                  parent='./gone.vhd')
+
+        self.assertRaises(vhdreader.VHDReadError,
+                          vhdreader.getParentPath, self.path('child.vhd'))
+
+    def test_backup_footer_used_if_primary_missing(self):
+        write_vhd(self.path('a.vhd'), 10 * ONE_MEGABYTE)
+        f = open(self.path('a.vhd'), 'ab')
+        f.write('\0' * 4096)
+        f.close()
+
+        self.assertEquals(10 * ONE_MEGABYTE,
+                          vhdreader.getSizeVirt(self.path('a.vhd')))
+
+    def test_garbage_raises(self):
+        f = open(self.path('a.vhd'), 'wb')
+        f.write('x' * 4096)
+        f.close()
+
+        self.assertRaises(vhdreader.VHDReadError,
+                          vhdreader.getSizeVirt, self.path('a.vhd'))
+
+
+class TestVhdutilFallback(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('vhdutil.ioretry')
+    def test_native_read_does_not_fork(self, mock_ioretry):
+        path = os.path.join(self.tmpdir, 'a.vhd')
+        write_vhd(path, 10 * ONE_MEGABYTE)
+
+        self.assertEquals(10 * ONE_MEGABYTE, vhdutil.getSizeVirt(path))
+        self.assertEquals(0, mock_ioretry.call_count)
+
+    @mock.patch('vhdutil.util.SMlog')
+    @mock.patch('vhdutil.ioretry')
+    def test_parse_error_falls_back_to_vhd_util(self, mock_ioretry, mock_log):
+        path = os.path.join(self.tmpdir, 'a.vhd')
+        mock_ioretry.return_value = '20\n'
+
+        self.assertEquals(20 * ONE_MEGABYTE, vhdutil.getSizeVirt(path))
+        mock_ioretry.assert_called_once_with(
+            [vhdutil.VHD_UTIL, 'query', vhdutil.OPT_LOG_ERR, '-v', '-n', path])
+
+    def test_get_vhd_info(self):
+        parent = os.path.join(self.tmpdir, 'parent.vhd')
+        child = os.path.join(self.tmpdir, 'child.vhd')
+        write_vhd(parent, 10 * ONE_MEGABYTE)
+        write_vhd(child, 10 * ONE_MEGABYTE, parent='./parent.vhd', hidden=1)
+        extract = lambda path: os.path.basename(path)[:-4]
+
+        info = vhdutil.getVHDInfo(child, extract)
+
+        self.assertEquals('child', info.uuid)
+        self.assertEquals('parent', info.parentUuid)
+        self.assertEquals(10 * ONE_MEGABYTE, info.sizeVirt)
+        self.assertEquals(1, info.hidden)
+
+
+class TestQueryMany(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.extract = lambda path: os.path.basename(path)[:-4]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_returns_info_for_every_path(self):
+        paths = []
+        for i in range(20):
+            path = os.path.join(self.tmpdir, 'vhd%d.vhd' % i)
+            write_vhd(path, (i + 1) * BLOCK_SIZE)
+            paths.append(path)
+
+        infos = vhdutil.queryMany(paths, [vhdutil.QUERY_SIZE_VIRT],
+                                  self.extract)
+
+        self.assertEquals(sorted(paths), sorted(infos.keys()))
+        for i, path in enumerate(paths):
+            self.assertEquals('vhd%d' % i, infos[path].uuid)
+            self.assertEquals((i + 1) * BLOCK_SIZE, infos[path].sizeVirt)
+
+    def test_parent_nocheck_does_not_need_parent(self):
+        child = os.path.join(self.tmpdir, 'child.vhd')
+        write_vhd(child, BLOCK_SIZE, parent='./gone.vhd')
+
+        infos = vhdutil.queryMany([child], [vhdutil.QUERY_PARENT_NOCHECK],
+                                  self.extract)
+
+        self.assertEquals(0, infos[child].error)
+        self.assertEquals('gone', infos[child].parentUuid)
+
+    @mock.patch('vhdutil.util.SMlog')
+    @mock.patch('vhdutil.ioretry')
+    def test_errors_are_reported_per_path(self, mock_ioretry, mock_log):
+        good = os.path.join(self.tmpdir, 'good.vhd')
+        bad = os.path.join(self.tmpdir, 'bad.vhd')
+        write_vhd(good, BLOCK_SIZE)
+        mock_ioretry.side_effect = vhdutil.util.CommandException(5)
+
+        infos = vhdutil.queryMany([good, bad], [vhdutil.QUERY_SIZE_VIRT],
+                                  self.extract)
+
+        self.assertEquals(0, infos[good].error)
+        self.assertTrue(infos[bad].error)
+
+    @mock.patch('vhdutil.util.SMlog')
+    def test_uuid_extraction_failure_sets_error(self, mock_log):
+        good = os.path.join(self.tmpdir, 'good.vhd')
+        bad = os.path.join(self.tmpdir, 'bad.vhd')
+        write_vhd(good, BLOCK_SIZE)
+        write_vhd(bad, BLOCK_SIZE)
+
+        def extract(path):
+            if path == bad:
+                raise ValueError('no uuid in %s' % path)
+            return self.extract(path)
+
+        infos = vhdutil.queryMany([good, bad], [vhdutil.QUERY_SIZE_VIRT],
+                                  extract)
+
+        self.assertEquals(0, infos[good].error)
+        self.assertEquals('good', infos[good].uuid)
+        self.assertTrue(infos[bad].error)
+        self.assertEquals(bad, infos[bad].path)
+
+    @mock.patch('vhdutil.check')
+    def test_check_failures_set_error(self, mock_check):
+        mock_check.side_effect = lambda path, ignore: path.endswith('ok.vhd')
+
+        infos = vhdutil.queryMany(['/a/ok.vhd', '/a/ko.vhd'],
+                                  [vhdutil.QUERY_CHECK], self.extract)
+
+        self.assertEquals(0, infos['/a/ok.vhd'].error)
+        self.assertTrue(infos['/a/ko.vhd'].error)
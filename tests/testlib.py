@@ -127,6 +127,7 @@ class TestContext(object):
             mock.patch('glob.glob', new=self.fake_glob),
             mock.patch('os.uname', new=self.fake_uname),
             mock.patch('subprocess.Popen', new=self.fake_popen),
+            mock.patch('util._Popen', new=self.fake_popen),
             mock.patch('os.rmdir', new=self.fake_rmdir),
             mock.patch('os.stat', new=self.fake_stat),
         ]
@@ -167,7 +168,8 @@ class TestContext(object):
         assert args[1] == '-d'
         return (0, args[2] + '-description', '')
 
-    def fake_popen(self, args, stdin, stdout, stderr, close_fds):
+    def fake_popen(self, args, stdin, stdout, stderr, close_fds,
+                   newGroup=False):
         import subprocess
         assert stdin == subprocess.PIPE
         assert stdout == subprocess.PIPE